@@ -29,6 +29,11 @@ MAX_WORDS = 3000  # maximum number of words in the document
 MAX_SENTENCES = 150  # maximum number of sentences in the document
 MAX_WORDS_IN_SENTENCE = 40  # maximum number of words per sentence in the document
 USE_END_SEQUENCE = True  # Whether or not to use the end of the sequence in the models
+EMBEDDINGS_CSV_EXPORT = False  # Whether or not to save the embeddings also in text format
+RECORDS_NUM_SHARDS = 8  # number of shard files of the binary records of the datasets
+RANDOM_ACCESS_WINDOW = 256  # lines read at once by the random access reader of the datasets
+GENERATOR_NUM_WORKERS = 4  # processes that generate the batches of word2vec and doc2vec
+INPUT_WAIT_STEPS = None  # steps between the traced steps to log the input wait, None to disable
 
 # word2vec
 
@@ -41,6 +46,7 @@ W2V_NEGATIVE_NUM_SAMPLES = 64  # number of negative examples to sample for train
 W2V_LEARNING_RATE_INITIAL = 0.01  # initial learning rate for gradient descent
 W2V_LEARNING_RATE_DECAY = 0.9  # decay of learning rate
 W2V_LEARNING_RATE_DECAY_STEPS = 100000  # steps to decay the learning rate
+W2V_VOCABULARY_COUNTING_CAPACITY = None  # max symbols counted at the same time to build the vocabulary, None for exact counts
 
 # doc2vec
 
@@ -51,12 +57,21 @@ D2V_NEGATIVE_NUM_SAMPLES = 64  # number of negative examples to sample for train
 D2V_LEARNING_RATE_INITIAL = 0.01  # initial learning rate for gradient descent
 D2V_LEARNING_RATE_DECAY = 0.9  # decay of learning rate
 D2V_LEARNING_RATE_DECAY_STEPS = 100000  # steps to decay the learning rate
+D2V_INFERENCE_EPOCHS = 10  # iterations over the new documents to infer their vectors
+D2V_INFERENCE_BATCH_SIZE = 4096  # windows per update when inferring vectors of new documents
+D2V_INFERENCE_LEARNING_RATE = 0.025  # initial learning rate to infer vectors of new documents
 
 D2V_DOC_EPOCHS = 10000  # iterations over the whole dataset
 D2V_DOC_BATCH_SIZE = 128  # batch size for the training
 D2V_DOC_LEARNING_RATE_INITIAL = 0.01  # initial learning rate for gradient descent
 D2V_DOC_LEARNING_RATE_DECAY = 0.95  # decay of learning rate
 D2V_DOC_LEARNING_RATE_DECAY_STEPS = 2000  # steps to decay the learning rate
+D2V_DOC_EVAL_BATCH_SIZE = 1024  # batch size to predict the classes of new documents
+D2V_DOC_FAST_LEARNING_RATE = 0.001  # learning rate of Adam in the fast trainer
+D2V_DOC_FAST_BATCH_SIZE = 512  # batch size in the fast trainer, 0 for the full batch
+D2V_DOC_FAST_MAX_EPOCHS = 2000  # maximum iterations over the dataset in the fast trainer
+D2V_DOC_FAST_PATIENCE = 50  # epochs without improvement in validation before stopping
+D2V_KNN_K = 20  # number of training documents used to predict the class with kNN
 
 # text classification
 
@@ -65,6 +80,14 @@ USE_LAST_WORKER_FOR_VALIDATION = True  # whether or not to use the last worker f
 TD_DATA_SENTENCE_REMOVE_PERCENTAGE = 0.05  # ratio of sentences to delete from the samples
 TC_EPOCHS = 1  # iterations over the whole dataset
 TC_BATCH_SIZE = 24  # batch size for the training
+TC_EVAL_BATCH_SIZE = 64  # batch size to predict the classes of the test sets
+TC_NATIVE_PARSING = True  # parse the dataset with tensorflow ops instead of a python function
+TC_RANDOM_ACCESS = True  # shuffle the whole training set every epoch reading the lines by offset
+TC_TRAIN_SHARDS = 16  # files of the training set, every distributed worker reads only some of them
+TC_CLASS_WEIGHTS = False  # balance the classes weighting the loss instead of sampling the documents
+TC_BALANCE_OVERSAMPLING = 2  # documents per class in a balanced epoch, times the largest class
+TC_BUCKET_BOUNDARIES = None  # lengths to group the documents in buckets for training, e.g. [300, 600, 1200, 2400]
+TC_TOKEN_BUDGET = None  # maximum tokens per batch with buckets, None to use TC_BATCH_SIZE
 TC_MODEL_HIDDEN = 200  # hidden GRUCells for the model
 TC_MODEL_LAYERS = 3  # number of layers of the model
 TC_MODEL_DROPOUT = 0.8  # dropout during training in the model
@@ -1,8 +1,10 @@
 import sys
+import logging
 import numpy as np
 import tensorflow as tf
 from tensorflow.python.training import training_util
 from .. import evaluator, metrics
+from ..evaluator import smooth_predictions, write_submission
 from ..configuration import *
 from .doc2vec_train_doc_prediction import doc2vec_prediction_model
 from .doc2vec_train_doc_prediction import DocPredictionDataset
@@ -68,15 +70,24 @@ class DocPredictionEval(evaluator.Evaluator):
 
 
 class DocPredictionInference(evaluator.Evaluator):
-    def __init__(self, dataset, log_dir=DIR_D2V_DOC_LOGDIR):
+    def __init__(self, dataset, log_dir=DIR_D2V_DOC_LOGDIR, submission_file=None):
+        """
+        :param DocPredictionDataset dataset: the dataset to predict
+        :param str log_dir: directory with the checkpoints
+        :param str submission_file: file where the predictions are written, by default
+        submission.csv in the output path
+        """
         config = tf.ConfigProto()
         config.gpu_options.allow_growth = True
+        output_path = os.path.join(log_dir, dataset.type)
         super(DocPredictionInference, self).__init__(checkpoints_dir=log_dir,
-                                                     output_path=os.path.join(log_dir,
-                                                                              dataset.type),
+                                                     output_path=output_path,
                                                      dataset=dataset,
                                                      singular_monitored_session_config=config,
                                                      infinite_loop=False)
+        if submission_file is None:
+            submission_file = os.path.join(output_path, 'submission.csv')
+        self.submission_file = submission_file
 
     def model(self, input_vectors, input_gene, input_variation, batch_size,
               embedding_size=EMBEDDINGS_SIZE, output_classes=9):
@@ -86,35 +97,30 @@ class DocPredictionInference(evaluator.Evaluator):
                                              None, batch_size,
                                              is_training=False, embedding_size=embedding_size,
                                              output_classes=output_classes)
-        global_step_increase = tf.assign_add(self.global_step, 1)
-        with tf.control_dependencies([global_step_increase]):
-            self.prediction = tf.nn.softmax(logits)
+        self.prediction = tf.nn.softmax(logits)
         return self.prediction
 
     def end(self, session):
-        pass
+        predictions = smooth_predictions(np.concatenate(self.predictions))
+        write_submission(self.submission_file, predictions)
+        logging.info('{} predictions written in {}'.format(len(predictions),
+                                                           self.submission_file))
 
     def create_graph(self, dataset_tensor, batch_size):
         input_vectors, input_gene, input_variation, _ = dataset_tensor
-        return self.model(input_vectors, input_gene, input_variation, batch_size)
+        # the last batch can be smaller than batch_size
+        return self.model(input_vectors, input_gene, input_variation, -1)
 
     def after_create_session(self, session, coord):
         super(DocPredictionInference, self).after_create_session(session, coord)
-        print('ID,class1,class2,class3,class4,class5,class6,class7,class8,class9')
+        self.predictions = []
 
     def step(self, session, graph_data, summary_op):
-        step, predictions = session.run([self.global_step, self.prediction])
-        predictions = predictions[0]
-        predictions = [p + 0.01 for p in predictions]  # penalize less the mistakes
-        sum = np.sum(predictions)
-        predictions = [p / sum for p in predictions]
-        print('{},{}'.format(step, ','.join(['{:.3f}'.format(x) for x in predictions])))
+        self.predictions.append(session.run(self.prediction))
         return None
 
 
 if __name__ == '__main__':
-    import logging
-
     logging.getLogger().setLevel(logging.INFO)
     if len(sys.argv) > 1 and sys.argv[1] == 'val':
         # get validation error
@@ -125,7 +131,7 @@ if __name__ == '__main__':
         # get validation error
         evaluator = DocPredictionInference(dataset=DocPredictionDataset(type='stage2_test'),
                                            log_dir=os.path.join(DIR_D2V_DOC_LOGDIR, 'val'))
-        evaluator.run()
+        evaluator.run(batch_size=D2V_DOC_EVAL_BATCH_SIZE)
     elif len(sys.argv) > 1 and sys.argv[1] == 'train':
         # get validation error
         evaluator = DocPredictionEval(dataset=DocPredictionDataset(type='train'),
@@ -0,0 +1,176 @@
+import sys
+import time
+import numpy as np
+import tensorflow as tf
+from ..configuration import *
+from ..task_spec import get_logs_path
+from ..embeddings import save_embeddings
+
+
+def _load_docs(filepath):
+    """
+    Loads the tokens of the documents of a doc2vec set file
+    :param str filepath: path of the set file
+    :return List[np.ndarray]: list with the int32 tokens of every document
+    """
+    docs = []
+    with open(filepath) as f:
+        for line in f:
+            docs.append(np.asarray(line.split('||')[3].split(), dtype=np.int32))
+    return docs
+
+
+class Doc2VecInference(object):
+    """
+    Infers the vectors of new documents with a trained doc2vec model. The word embeddings and the
+    NCE weights and biases are loaded once from the checkpoint of Doc2VecTrainer and they are
+    fixed, only the vectors of the documents are optimized. The loss is the same as in the training
+    (NCE with a log-uniform sampler), it is computed with numpy for all the windows of a group of
+    documents at the same time.
+    """
+
+    def __init__(self, checkpoints_dir=DIR_D2V_LOGDIR, context_size=D2V_CONTEXT_SIZE,
+                 num_negative_samples=D2V_NEGATIVE_NUM_SAMPLES, seed=None):
+        """
+        :param str checkpoints_dir: directory with the checkpoints of Doc2VecTrainer
+        :param int context_size: size of the context used in the training
+        :param int num_negative_samples: number of negative examples sampled in every update
+        :param int seed: seed for the random generator
+        """
+        checkpoint = tf.train.latest_checkpoint(get_logs_path(checkpoints_dir))
+        if checkpoint is None:
+            raise ValueError('No checkpoint in {}'.format(checkpoints_dir))
+        reader = tf.train.NewCheckpointReader(checkpoint)
+        self.word_embeddings = reader.get_tensor('word_embeddings').astype(np.float32)
+        nce_weights = reader.get_tensor('nce_weights').astype(np.float32)
+        self.nce_biases = reader.get_tensor('nce_biases').astype(np.float32)
+        self.vocabulary_size, self.embedding_size = self.word_embeddings.shape
+        # the input of the NCE is the concatenation of the words average and the doc vector
+        self.nce_words_weights = np.ascontiguousarray(nce_weights[:, :self.embedding_size])
+        self.nce_doc_weights = np.ascontiguousarray(nce_weights[:, self.embedding_size:])
+        self.context_size = context_size
+        self.num_negative_samples = num_negative_samples
+        self.random = np.random.RandomState(seed)
+
+    def _log_expected_count(self, classes, num_tries):
+        # expected count of the log-uniform sampler used by tf.nn.nce_loss, which samples unique
+        # classes: the probability of a class to appear at least once in num_tries draws
+        log_range = np.log(self.vocabulary_size + 1.0)
+        probability = (np.log(classes + 2.0) - np.log(classes + 1.0)) / log_range
+        return np.log(-np.expm1(num_tries * np.log1p(-probability)))
+
+    def _sample(self):
+        """
+        Samples unique classes with the log-uniform distribution as tf.nn.nce_loss does
+        :return (np.ndarray, int): the sampled classes and the number of draws needed to get them
+        """
+        log_range = np.log(self.vocabulary_size + 1.0)
+        sampled = []
+        seen = set()
+        num_tries = 0
+        while len(sampled) < self.num_negative_samples:
+            u = self.random.uniform(0.0, log_range, self.num_negative_samples)
+            draws = np.clip(np.floor(np.exp(u)).astype(np.int64) - 1, 0, self.vocabulary_size - 1)
+            for draw in draws:
+                num_tries += 1
+                if draw not in seen:
+                    seen.add(draw)
+                    sampled.append(draw)
+                    if len(sampled) == self.num_negative_samples:
+                        break
+        return np.asarray(sampled, dtype=np.int64), num_tries
+
+    def infer(self, docs, epochs=D2V_INFERENCE_EPOCHS, batch_size=D2V_INFERENCE_BATCH_SIZE,
+              learning_rate=D2V_INFERENCE_LEARNING_RATE, docs_per_group=512):
+        """
+        Infers the vectors of the documents
+        :param List[np.ndarray] docs: list with the tokens of every document
+        :param int epochs: iterations over the windows of the documents
+        :param int batch_size: number of windows in every update
+        :param float learning_rate: initial learning rate, it decays linearly during the epochs
+        :param int docs_per_group: number of documents optimized at the same time
+        :return np.ndarray: a matrix [len(docs), embedding_size] with the vectors of the docs.
+        Documents shorter than the context keep their random initial vector.
+        """
+        vectors = (self.random.rand(len(docs), self.embedding_size).astype(np.float32) - 0.5) / \
+                  self.embedding_size
+        for first_doc in range(0, len(docs), docs_per_group):
+            group = docs[first_doc:first_doc + docs_per_group]
+            vectors[first_doc:first_doc + len(group)] = \
+                self._infer_group(group, vectors[first_doc:first_doc + len(group)], epochs,
+                                  batch_size, learning_rate)
+        return vectors
+
+    def _infer_group(self, docs, vectors, epochs, batch_size, learning_rate):
+        lengths = np.asarray([len(d) for d in docs], dtype=np.int64)
+        num_windows = np.maximum(lengths - self.context_size - 1, 0)
+        total_windows = int(np.sum(num_windows))
+        if total_windows == 0:
+            return vectors
+        offsets = np.zeros(len(docs) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        tokens = np.concatenate(docs)
+        item_size = tokens.itemsize
+        contexts_view = np.lib.stride_tricks.as_strided(
+                tokens, shape=(len(tokens) - self.context_size + 1, self.context_size),
+                strides=(item_size, item_size))
+        # document and position in the tokens of every window
+        windows_doc = np.repeat(np.arange(len(docs)), num_windows)
+        windows_start = np.repeat(offsets[:-1] - np.cumsum(num_windows) + num_windows,
+                                  num_windows)
+        windows_position = windows_start + np.arange(total_windows)
+
+        updates = epochs * ((total_windows + batch_size - 1) // batch_size)
+        update = 0
+        for _ in range(epochs):
+            permutation = self.random.permutation(total_windows)
+            for first in range(0, total_windows, batch_size):
+                batch = permutation[first:first + batch_size]
+                lr = learning_rate * max(1.0 - float(update) / updates, 0.0001)
+                update += 1
+                self._update(vectors, windows_doc[batch], windows_position[batch], tokens,
+                             contexts_view, lr)
+        return vectors
+
+    def _update(self, vectors, doc_ids, positions, tokens, contexts_view, learning_rate):
+        words = np.mean(self.word_embeddings[contexts_view[positions]], axis=1)
+        docs = vectors[doc_ids]
+        labels = tokens[positions + self.context_size + 1]
+        sampled, num_tries = self._sample()
+
+        true_logits = np.sum(words * self.nce_words_weights[labels], axis=1) + \
+                      np.sum(docs * self.nce_doc_weights[labels], axis=1) + \
+                      self.nce_biases[labels] - self._log_expected_count(labels, num_tries)
+        sampled_logits = np.dot(words, self.nce_words_weights[sampled].T) + \
+                         np.dot(docs, self.nce_doc_weights[sampled].T) + \
+                         self.nce_biases[sampled] - self._log_expected_count(sampled, num_tries)
+        # gradients of the sigmoid cross entropy, the sampled labels equal to the true label are
+        # kept as in the training (tf.nn.nce_loss with remove_accidental_hits=False)
+        true_gradients = 1.0 / (1.0 + np.exp(-true_logits)) - 1.0
+        sampled_gradients = 1.0 / (1.0 + np.exp(-sampled_logits))
+        gradients = true_gradients[:, None] * self.nce_doc_weights[labels] + \
+                    np.dot(sampled_gradients, self.nce_doc_weights[sampled])
+        docs_gradients = np.zeros_like(vectors)
+        np.add.at(docs_gradients, doc_ids, gradients)
+        vectors -= learning_rate * docs_gradients
+
+
+if __name__ == '__main__':
+    import logging
+
+    logging.getLogger().setLevel(logging.INFO)
+    if len(sys.argv) > 1 and sys.argv[1] in ['val', 'stage2_test']:
+        dataset_type = sys.argv[1]
+        start = time.time()
+        inference = Doc2VecInference()
+        docs = _load_docs(os.path.join(DIR_DATA_DOC2VEC, '{}_set'.format(dataset_type)))
+        print('Model and {} documents loaded in {:0.2f} seconds'.format(len(docs),
+                                                                       time.time() - start))
+        start = time.time()
+        doc_vectors = inference.infer(docs)
+        print('Vectors inferred in {:0.2f} seconds'.format(time.time() - start))
+        embeddings_file = 'doc_eval_embeddings_{}_{}_{}'.format(dataset_type, VOCABULARY_SIZE,
+                                                                EMBEDDINGS_SIZE)
+        save_embeddings(os.path.join(DIR_DATA_DOC2VEC, embeddings_file), doc_vectors)
+    else:
+        print('Usage: python -m src.d2v.doc2vec_inference [val|stage2_test]')
@@ -0,0 +1,105 @@
+import sys
+import time
+import numpy as np
+from ..configuration import *
+from ..embeddings import load_embeddings, EmbeddingsIndex
+from ..evaluator import smooth_predictions, write_submission
+
+
+def _load_labels(filepath):
+    """
+    Loads the classes of the documents of a doc2vec set file
+    :param str filepath: path of the set file
+    :return np.ndarray: the classes of the documents starting from 0, -1 for the test sets
+    """
+    labels = []
+    with open(filepath) as f:
+        for line in f:
+            label = line.split('||')[0].strip()
+            labels.append(int(label) - 1 if label else -1)
+    return np.asarray(labels, dtype=np.int32)
+
+
+class DocKNNPrediction(object):
+    """
+    Predicts the class of the documents with the k nearest documents of the training set in the
+    doc2vec space. The index over the training vectors is built once and the queries are answered
+    in batches with blocked matrix multiplications. The probability of every class is the sum of
+    the cosine similarities of the neighbours of that class.
+    """
+
+    def __init__(self, vocabulary_size=VOCABULARY_SIZE, embedding_size=EMBEDDINGS_SIZE,
+                 output_classes=9, quantize=False):
+        """
+        :param int vocabulary_size: vocabulary size of the doc2vec model
+        :param int embedding_size: size of the document vectors
+        :param int output_classes: number of classes
+        :param bool quantize: whether to use the int8 quantized index
+        """
+        self.vocabulary_size = vocabulary_size
+        self.embedding_size = embedding_size
+        self.output_classes = output_classes
+        embeds_file = 'doc_embeddings_{}_{}'.format(vocabulary_size, embedding_size)
+        self.labels = _load_labels(os.path.join(DIR_DATA_DOC2VEC, 'train_set'))
+        self.index = EmbeddingsIndex(load_embeddings(os.path.join(DIR_DATA_DOC2VEC, embeds_file)),
+                                     quantize=quantize)
+        if self.index.size != len(self.labels):
+            raise ValueError('{} training vectors but {} training documents'
+                             .format(self.index.size, len(self.labels)))
+
+    def load_vectors(self, type):
+        """
+        Loads the inferred vectors of the documents of a set
+        :param str type: val, test or stage2_test
+        :return np.ndarray: a matrix with one vector per document
+        """
+        embeds_file = 'doc_eval_embeddings_{}_{}_{}'.format(type, self.vocabulary_size,
+                                                            self.embedding_size)
+        return load_embeddings(os.path.join(DIR_DATA_DOC2VEC, embeds_file))
+
+    def predict(self, vectors, k=D2V_KNN_K, batch_size=1024):
+        """
+        Predicts the probabilities of the classes of the documents
+        :param np.ndarray vectors: matrix with the vectors of the documents
+        :param int k: number of neighbours
+        :param int batch_size: number of documents queried at the same time
+        :return np.ndarray: a matrix [documents, classes] with the probabilities
+        """
+        predictions = np.zeros([len(vectors), self.output_classes], dtype=np.float64)
+        for start in range(0, len(vectors), batch_size):
+            indexes, similarities = self.index.query(vectors[start:start + batch_size], k=k)
+            rows = np.repeat(np.arange(indexes.shape[0]), indexes.shape[1])
+            np.add.at(predictions[start:start + batch_size],
+                      (rows, self.labels[indexes].reshape(-1)),
+                      np.maximum(similarities, 0.0).reshape(-1))
+        return smooth_predictions(predictions)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] in ['val', 'test', 'stage2_test']:
+        dataset_type = sys.argv[1]
+        if len(sys.argv) > 2:
+            submission_file = sys.argv[2]
+        else:
+            submission_file = os.path.join(DIR_DATA_DOC2VEC,
+                                           'submission_knn_{}.csv'.format(dataset_type))
+        start = time.time()
+        knn = DocKNNPrediction()
+        print('Index with {} documents built in {:0.3f} seconds'.format(knn.index.size,
+                                                                       time.time() - start))
+        vectors = knn.load_vectors(dataset_type)
+        start = time.time()
+        predictions = knn.predict(vectors)
+        elapsed = time.time() - start
+        print('{} queries in {:0.3f} seconds ({:0.3f} ms per query)'.format(
+                len(vectors), elapsed, elapsed * 1000 / len(vectors)))
+        if dataset_type == 'val':
+            labels = _load_labels(os.path.join(DIR_DATA_DOC2VEC, 'val_set'))
+            loss = -np.mean(np.log(predictions[np.arange(len(labels)), labels]))
+            accuracy = np.mean(np.argmax(predictions, axis=1) == labels)
+            print('Loss: {}  accuracy: {}'.format(loss, accuracy))
+        write_submission(submission_file, predictions)
+        print('{} predictions written in {}'.format(len(predictions), submission_file))
+    else:
+        print('Usage: python -m src.d2v.doc2vec_knn_prediction [val|test|stage2_test] '
+              '[submission_file]')
@@ -6,14 +6,18 @@ import random
 from tensorflow.python.training import training_util
 from tensorflow.contrib import layers
 from .. import trainer, metrics
-from ..tf_dataset_generator import TFDataSetGenerator
+from tensorflow.contrib.data import Dataset
 from ..configuration import *
 from ..rnn.text_classification_train import _load_embeddings
+from ..embeddings import load_embeddings
+from ..records import records_exist, Records
 
 
-class DocPredictionDataset(TFDataSetGenerator):
+class DocPredictionDataset(object):
     """
-    Custom dataset. We use it to feed the session.run method directly.
+    Custom dataset. The features of all the documents (document vector, gene vector and the mean of
+    the variant vectors) are precomputed in float32 matrices and read in the graph with a
+    tensorflow dataset, so there is no python code involved per example.
     """
 
     def __init__(self, type='train',
@@ -21,6 +25,7 @@ class DocPredictionDataset(TFDataSetGenerator):
                  embedding_size=EMBEDDINGS_SIZE,
                  balance_classes=False):
         self.type = type
+        self.name = type
         if type != 'train' and type != 'test' and type != 'stage2_test' and type != 'val':
             raise ValueError('Type must be train, test, stage2_test or val')
         docs_filename = '{}_set'.format(type)
@@ -35,72 +40,88 @@ class DocPredictionDataset(TFDataSetGenerator):
 
         self.docs_file = os.path.join(DIR_DATA_DOC2VEC, docs_filename)
         self.embeds_file = os.path.join(DIR_DATA_DOC2VEC, embeds_filename)
-        self.doc_genes = []
-        self.doc_variants = []
-        if type == 'train' or type == 'val':
-            self.doc_labels = []
+        if records_exist(self.docs_file):
+            records = Records(self.docs_file)
+            labels = records.classes
+            genes = records.genes
+            variants_length = np.diff(records.variant_offsets)
+            variants_ids = records.variants.astype(np.int64)
         else:
-            self.doc_labels = None
-        # pre load data in memory for the generator
-        with open(self.docs_file) as f:
-            for line in f.readlines():
-                sp = line.split('||')
-                if type == 'train' or type == 'val':
-                    self.doc_labels.append(int(sp[0].strip()))
-                gene = word_embeds[int(sp[1].strip())]
-                self.doc_genes.append(gene)
-                variant = np.zeros(embedding_size, dtype=np.float32)
-                v = [int(x) for x in sp[2].split()]
-                for x in v:
-                    variant += np.asarray(word_embeds[x], dtype=np.float32)
-                variant /= len(v)
-                self.doc_variants.append(variant)
-
-        output_types = (tf.float32, tf.float32, tf.float32, tf.int32)
-        with open(self.embeds_file) as f:
-            self.embeds = [l.split(',') for l in f.readlines()]
-            for i, line in enumerate(self.embeds):
-                self.embeds[i] = [float(e) for e in line]
+            labels = []
+            genes = []
+            variants = []
+            with open(self.docs_file) as f:
+                for line in f:
+                    sp = line.split('||')
+                    if type == 'train' or type == 'val':
+                        # subtract 1 to class as classes goes from 1 to 9 (both inclusive)
+                        labels.append(int(sp[0].strip()) - 1)
+                    else:
+                        labels.append(-1)
+                    genes.append(int(sp[1].strip()))
+                    variants.append([int(x) for x in sp[2].split()])
+            variants_length = np.asarray([len(v) for v in variants], dtype=np.int64)
+            variants_ids = np.asarray([x for v in variants for x in v], dtype=np.int64)
+
+        self.embeds = np.asarray(load_embeddings(self.embeds_file), dtype=np.float32)
+        self.doc_genes = np.asarray(word_embeds[np.asarray(genes, dtype=np.int64)],
+                                    dtype=np.float32)
+        # mean of the embeddings of the variant symbols
+        variants_segments = np.repeat(np.arange(len(variants_length)), variants_length)
+        self.doc_variants = np.zeros([len(variants_length), embedding_size], dtype=np.float32)
+        np.add.at(self.doc_variants, variants_segments, word_embeds[variants_ids])
+        self.doc_variants /= np.maximum(variants_length, 1)[:, None]
+        self.doc_labels = np.asarray(labels, dtype=np.int32)
+
         if type == 'train' and balance_classes:
             self._balance_classes()
 
-        super(DocPredictionDataset, self).__init__(name=type,
-                                                   generator=self._generator,
-                                                   output_types=output_types,
-                                                   min_queue_examples=1000,
-                                                   shuffle_size=2000)
-
     def _balance_classes(self):
-        dataset = zip(self.doc_labels, self.embeds)
         classes_group = {}
-        for d in dataset:
-            if d[0] not in classes_group:
-                classes_group[d[0]] = []
-            classes_group[d[0]].append(d)
+        for index, label in enumerate(self.doc_labels):
+            if label not in classes_group:
+                classes_group[label] = []
+            classes_group[label].append(index)
         max_in_class = np.max([len(v) for v in classes_group.values()]) * 2
-        new_dataset = []
-        for key, class_list in classes_group.iteritems():
+        indexes = []
+        for key, class_list in classes_group.items():
             random.shuffle(class_list)
             for index in range(max_in_class - len(class_list)):
                 class_list.append(class_list[index])
-            new_dataset.extend(class_list)
-
-        random.shuffle(new_dataset)
-        self.doc_labels, self.embeds = zip(*new_dataset)
-
-    def _generator(self):
-        for i in range(len(self.embeds)):
-            embeds = np.asarray(self.embeds[i], dtype=np.float32)
-            gene = np.asarray(self.doc_genes[i], dtype=np.float32)
-            variant = np.asarray(self.doc_variants[i], dtype=np.float32)
-            if self.doc_labels is None:
-                # evaluation set:
-                yield embeds, gene, variant, np.int32(-1)
-            else:
-                # train or validation set:
-                # subtract 1 to class as classes goes from 1 to 9 (both inclusive)
-                label = np.int32(int(self.doc_labels[i]) - 1)
-                yield embeds, gene, variant, label
+            indexes.extend(class_list)
+
+        random.shuffle(indexes)
+        self.embeds = self.embeds[indexes]
+        self.doc_genes = self.doc_genes[indexes]
+        self.doc_variants = self.doc_variants[indexes]
+        self.doc_labels = self.doc_labels[indexes]
+
+    def read(self, batch_size, num_epochs=1, shuffle=False, task_spec=None):
+        """
+        Reads the data and return a tuple of (document, gene, variant, label), the label is -1 for
+        the test sets. See TFDataSet.read()
+        """
+        dataset = Dataset.from_tensor_slices((self.embeds, self.doc_genes, self.doc_variants,
+                                              self.doc_labels))
+        if task_spec and task_spec.num_workers > 1:
+            # split the dataset in shards
+            # TODO in TF 1.4 use: dataset = dataset.shard(task_spec.num_workers, task_spec.index)
+            from tensorflow.python.ops import math_ops
+
+            def filter_fn(elem_index, _):
+                mod_result = math_ops.mod(elem_index, task_spec.num_workers)
+                return math_ops.equal(mod_result, task_spec.index)
+
+            dataset = dataset.enumerate().filter(filter_fn).map(lambda _, elem: elem)
+        if shuffle:
+            # all the dataset fits in the buffer, so it is a full shuffle in every epoch
+            dataset = dataset.shuffle(buffer_size=self.get_size())
+        dataset = dataset.repeat(num_epochs)
+        dataset = dataset.batch(batch_size)
+        return dataset.make_one_shot_iterator().get_next()
+
+    def get_size(self):
+        return len(self.doc_labels)
 
 
 def doc2vec_prediction_model(input_vectors, input_gene, input_variation, output_label, batch_size,
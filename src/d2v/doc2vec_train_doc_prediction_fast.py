@@ -0,0 +1,139 @@
+import sys
+import time
+import itertools
+import numpy as np
+import tensorflow as tf
+from tensorflow.python.training import training_util
+from ..configuration import *
+from ..task_spec import get_logs_path
+from .doc2vec_train_doc_prediction import doc2vec_prediction_model, DocPredictionDataset
+
+
+class DocPredictionFastTrainer(object):
+    """
+    Trains the prediction network of doc2vec in a single process with the whole dataset in memory.
+    The network is trained with Adam over large minibatches (or the full batch), the loss in the
+    validation set is computed after every epoch and the training stops when it does not improve.
+    The checkpoint of the best epoch is saved as model.ckpt-<step> in the log dir, so it can be
+    used by DocPredictionEval and DocPredictionInference.
+    """
+
+    def __init__(self, train_dataset, val_dataset, log_dir=DIR_D2V_DOC_LOGDIR,
+                 embedding_size=EMBEDDINGS_SIZE, output_classes=9, seed=None):
+        """
+        :param DocPredictionDataset train_dataset: the dataset to train the network
+        :param DocPredictionDataset val_dataset: the dataset for the early stopping
+        :param str log_dir: directory where the checkpoint is stored
+        :param int embedding_size: size of the embeddings of the documents and words
+        :param int output_classes: number of classes
+        :param int seed: seed for the random generators
+        """
+        self.train_dataset = train_dataset
+        self.val_dataset = val_dataset
+        self.log_dir = get_logs_path(log_dir)
+        self.embedding_size = embedding_size
+        self.output_classes = output_classes
+        self.seed = seed
+
+    def _create_graph(self, learning_rate):
+        self.global_step = training_util.get_or_create_global_step()
+        self.input_vectors = tf.placeholder(tf.float32, [None, self.embedding_size])
+        self.input_gene = tf.placeholder(tf.float32, [None, self.embedding_size])
+        self.input_variation = tf.placeholder(tf.float32, [None, self.embedding_size])
+        self.output_label = tf.placeholder(tf.int32, [None])
+        self.is_training = tf.placeholder_with_default(False, [])
+        # the same network is used for training and validation, dropout depends on is_training
+        logits, targets = doc2vec_prediction_model(self.input_vectors, self.input_gene,
+                                                   self.input_variation, self.output_label,
+                                                   batch_size=-1,
+                                                   is_training=self.is_training,
+                                                   embedding_size=self.embedding_size,
+                                                   output_classes=self.output_classes)
+        loss = tf.nn.softmax_cross_entropy_with_logits(labels=targets, logits=logits)
+        self.loss = tf.reduce_mean(loss)
+        self.loss_sum = tf.reduce_sum(loss)
+        self.optimizer = tf.train.AdamOptimizer(learning_rate).minimize(
+                self.loss, global_step=self.global_step)
+        # only the variables restored by the evaluator are saved
+        self.saver = tf.train.Saver(var_list=tf.trainable_variables() + [self.global_step])
+
+    def _feed(self, dataset, indexes):
+        return {
+            self.input_vectors: dataset.embeds[indexes],
+            self.input_gene: dataset.doc_genes[indexes],
+            self.input_variation: dataset.doc_variants[indexes],
+            self.output_label: dataset.doc_labels[indexes],
+        }
+
+    def _evaluate(self, session, dataset, batch_size=4096):
+        size = dataset.get_size()
+        loss = 0.0
+        for start in range(0, size, batch_size):
+            indexes = np.arange(start, min(start + batch_size, size))
+            loss += session.run(self.loss_sum, feed_dict=self._feed(dataset, indexes))
+        return loss / size
+
+    def train(self, learning_rate=D2V_DOC_FAST_LEARNING_RATE, batch_size=D2V_DOC_FAST_BATCH_SIZE,
+              max_epochs=D2V_DOC_FAST_MAX_EPOCHS, patience=D2V_DOC_FAST_PATIENCE, save=True):
+        """
+        Trains the network until the validation loss does not improve in patience epochs
+        :param float learning_rate: learning rate of Adam
+        :param int batch_size: size of the minibatches, 0 or less to use the full batch
+        :param int max_epochs: maximum number of epochs
+        :param int patience: epochs without improvement in the validation loss before stopping
+        :param bool save: whether to save the checkpoint of the best epoch
+        :return (float, int): the best validation loss and its epoch
+        """
+        train_size = self.train_dataset.get_size()
+        if batch_size <= 0:
+            batch_size = train_size
+        random = np.random.RandomState(self.seed)
+        best_loss, best_epoch = None, 0
+        with tf.Graph().as_default():
+            if self.seed is not None:
+                tf.set_random_seed(self.seed)
+            self._create_graph(learning_rate)
+            with tf.Session() as session:
+                session.run(tf.global_variables_initializer())
+                for epoch in range(1, max_epochs + 1):
+                    permutation = random.permutation(train_size)
+                    for start in range(0, train_size, batch_size):
+                        feed_dict = self._feed(self.train_dataset,
+                                               permutation[start:start + batch_size])
+                        feed_dict[self.is_training] = True
+                        session.run(self.optimizer, feed_dict=feed_dict)
+                    val_loss = self._evaluate(session, self.val_dataset)
+                    if best_loss is None or val_loss < best_loss:
+                        best_loss, best_epoch = val_loss, epoch
+                        if save:
+                            self.saver.save(session, os.path.join(self.log_dir, 'model.ckpt'),
+                                            global_step=self.global_step)
+                    elif epoch - best_epoch >= patience:
+                        break
+        return best_loss, best_epoch
+
+
+if __name__ == '__main__':
+    import logging
+
+    logging.getLogger().setLevel(logging.INFO)
+    train_set = DocPredictionDataset(type='train')
+    val_set = DocPredictionDataset(type='val')
+    trainer = DocPredictionFastTrainer(train_set, val_set)
+    if len(sys.argv) > 1 and sys.argv[1] == 'sweep':
+        # train with several combinations of the hyperparameters without saving the model
+        results = []
+        for lr, bs in itertools.product([0.0003, 0.001, 0.003], [128, 512, 0]):
+            start = time.time()
+            loss, epoch = trainer.train(learning_rate=lr, batch_size=bs, save=False)
+            results.append((loss, lr, bs, epoch))
+            logging.info('learning_rate: {}  batch_size: {}  val_loss: {:0.4f}  epoch: {}  '
+                         'seconds: {:0.1f}'.format(lr, bs, loss, epoch, time.time() - start))
+        loss, lr, bs, epoch = min(results)
+        logging.info('Best: learning_rate: {}  batch_size: {}  val_loss: {:0.4f}  epoch: {}'
+                     .format(lr, bs, loss, epoch))
+    else:
+        start = time.time()
+        loss, epoch = trainer.train()
+        logging.info('Best val_loss: {:0.4f} in epoch {}, trained in {:0.1f} seconds'
+                     .format(loss, epoch, time.time() - start))
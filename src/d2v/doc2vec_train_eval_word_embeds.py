@@ -1,5 +1,4 @@
 import tensorflow as tf
-import csv
 import time
 from datetime import timedelta
 import shutil
@@ -8,6 +7,7 @@ from tensorflow.contrib import layers
 from .. import trainer
 from .doc2vec_train_word_embeds import Doc2VecDataset
 from ..rnn.text_classification_train import _load_embeddings
+from ..embeddings import save_embeddings, embeddings_variable
 from tensorflow.python.training import training_util
 from ..configuration import *
 
@@ -46,14 +46,12 @@ class Doc2VecTrainerEval(trainer.Trainer):
         word_embeddings = _load_embeddings(vocabulary_size, embedding_size,
                                            filename_prefix='word_embeddings',
                                            from_dir=DIR_DATA_DOC2VEC)
-        self.word_embeddings = tf.constant(value=word_embeddings,
-                                           shape=[vocabulary_size, embedding_size],
-                                           dtype=tf.float32, name='word_embeddings')
+        self.word_embeddings = embeddings_variable(word_embeddings, name='word_embeddings')
         self.doc_embeddings = tf.get_variable(shape=[self.dataset.num_docs, embedding_size],
                                               initializer=layers.xavier_initializer(),
                                               dtype=tf.float32, name='doc_embeddings')
         words_embed = tf.nn.embedding_lookup(self.word_embeddings, input_words)
-        doc_embed = tf.nn.embedding_lookup(self.word_embeddings, input_doc)
+        doc_embed = tf.nn.embedding_lookup(self.doc_embeddings, input_doc)
         # average the words_embeds
         words_embed_average = tf.reduce_mean(words_embed, axis=1)
         embed = tf.concat([words_embed_average, doc_embed], axis=1)
@@ -86,28 +84,21 @@ class Doc2VecTrainerEval(trainer.Trainer):
         input_doc, input_word, output_label = dataset_tensor
         return self.model(input_doc, input_word, output_label, batch_size)
 
+    def create_hooks(self, graph_data):
+        embeddings_hook = trainer.EmbeddingsSnapshotHook(
+                {'doc': self.doc_embeddings}, save_fn=lambda e: self.save_embeddings(e['doc']),
+                first_save_secs=5 * 60, normalize=False)
+        return [], [embeddings_hook]
+
     def step(self, session, graph_data):
         if self.is_chief:
-            lr, _, loss, step, self.embeddings_docs = \
-                session.run([self.learning_rate, self.optimizer, self.loss, self.global_step,
-                             self.doc_embeddings])
+            lr, _, loss, step = session.run([self.learning_rate, self.optimizer, self.loss,
+                                             self.global_step])
             if time.time() > self.print_timestamp + 5 * 60:
                 self.print_timestamp = time.time()
                 elapsed_time = str(timedelta(seconds=time.time() - self.init_time))
                 m = 'step: {}  loss: {:0.4f}  learning_rate = {:0.6f}  elapsed seconds: {}'
                 print(m.format(step, loss, lr, elapsed_time))
-                current_time = time.time()
-                embeddings_file = 'doc_eval_embeddings_{}_{}_{}'.format(self.dataset.type,
-                                                                        VOCABULARY_SIZE,
-                                                                        EMBEDDINGS_SIZE)
-                embeddings_filepath = os.path.join(DIR_DATA_DOC2VEC, embeddings_file)
-                if not os.path.exists(embeddings_filepath):
-                    self.save_embeddings(self.embeddings_docs)
-                else:
-                    embeddings_file_timestamp = os.path.getmtime(embeddings_filepath)
-                    # save the embeddings every 30 minutes
-                    if current_time - embeddings_file_timestamp > 30 * 60:
-                        self.save_embeddings(self.embeddings_docs)
         else:
             session.run([self.optimizer])
 
@@ -115,21 +106,14 @@ class Doc2VecTrainerEval(trainer.Trainer):
         self.init_time = time.time()
         self.print_timestamp = time.time()
 
-    def end(self, session):
-        if self.is_chief:
-            self.save_embeddings(self.embeddings_docs)
-
     def save_embeddings(self, doc_embeddings):
-        print('Saving embeddings in text format...')
+        print('Saving embeddings...')
         embeddings_file = 'doc_eval_embeddings_{}_{}_{}'.format(self.dataset.type,
                                                                 VOCABULARY_SIZE, EMBEDDINGS_SIZE)
         embeddings_filepath = os.path.join(DIR_DATA_DOC2VEC, embeddings_file)
-        with open(embeddings_filepath, 'w') as f:
-            writer = csv.writer(f, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
-            writer.writerows(doc_embeddings)
-        # copy the embeddings file to the log dir so we can download it from tensorport
-        if os.path.exists(embeddings_filepath):
-            shutil.copy(embeddings_filepath, self.log_dir)
+        # copy the embeddings files to the log dir so we can download them from tensorport
+        for saved_file in save_embeddings(embeddings_filepath, doc_embeddings):
+            shutil.copy(saved_file, self.log_dir)
 
 
 if __name__ == '__main__':
@@ -1,5 +1,4 @@
 import tensorflow as tf
-import csv
 import time
 from datetime import timedelta
 import shutil
@@ -9,50 +8,152 @@ from tensorflow.contrib.tensorboard.plugins import projector
 from tensorflow.contrib import layers
 from .. import trainer
 from ..tf_dataset_generator import TFDataSetGenerator
+from ..embeddings import save_embeddings
+from ..records import records_exist, Records
 from ..configuration import *
 
 class Doc2VecDataset(TFDataSetGenerator):
     """
     Custom dataset. We use it to feed the session.run method directly.
+
+    The documents are stored in a single int32 array of tokens with the offsets of every document.
+    The generator visits the documents in round-robin, one window per document in every pass, and
+    generates the windows of several passes at once with numpy.
     """
 
     def __init__(self, type='train',
-                 context_size=D2V_CONTEXT_SIZE):
+                 context_size=D2V_CONTEXT_SIZE,
+                 passes_per_block=64,
+                 num_workers=GENERATOR_NUM_WORKERS,
+                 seed=None):
+        """
+        :param str type: type of set: train, val or stage2_test
+        :param int context_size: number of words in the context
+        :param int passes_per_block: number of round-robin passes over the documents generated
+        at once
+        :param int num_workers: number of processes that generate the windows
+        :param int seed: seed for the shuffling of the windows
+        """
         self.type = type
         self.context_size = context_size
+        self.passes_per_block = passes_per_block
         filename = '{}_set'.format(type)
         self.data_file = os.path.join(DIR_DATA_DOC2VEC, filename)
 
         # pre load data in memory for the generator
-        with open(self.data_file) as f:
-            # read lines and skip the class
-            self._data_lines = [l.split('||')[3].split() for l in f.readlines()]
-            # skip shorter lines
-            self._data_lines = [l for l in self._data_lines if len(l) > self.context_size]
-            for i, line in enumerate(self._data_lines):
-                self._data_lines[i] = [int(w) for w in line]
-        self.num_docs = len(self._data_lines)
+        docs = []
+        if records_exist(self.data_file):
+            records = Records(self.data_file)
+            for i in range(len(records)):
+                # skip shorter documents
+                if records.lengths[i] > self.context_size:
+                    docs.append(records.doc_tokens(i))
+        else:
+            with open(self.data_file) as f:
+                for line in f:
+                    # skip the class
+                    doc = np.asarray(line.split('||')[3].split(), dtype=np.int32)
+                    # skip shorter lines
+                    if len(doc) > self.context_size:
+                        docs.append(doc)
+        self.num_docs = len(docs)
+        self.lengths = np.asarray([len(d) for d in docs], dtype=np.int64)
+        self.offsets = np.zeros(self.num_docs + 1, dtype=np.int64)
+        np.cumsum(self.lengths, out=self.offsets[1:])
+        self.tokens = np.concatenate(docs) if docs else np.zeros(0, dtype=np.int32)
+        # number of (context, label) windows of every document
+        self.num_windows = np.maximum(self.lengths - self.context_size - 1, 0)
 
         output_types = (tf.int32, tf.int32, tf.int32)
         super(Doc2VecDataset, self).__init__(name=type,
-                                             generator=self._generator,
+                                             generator=self._generate_blocks,
                                              output_types=output_types,
                                              min_queue_examples=1000,
-                                             shuffle_size=20000)
+                                             shuffle_size=20000,
+                                             batched=True,
+                                             num_workers=num_workers,
+                                             seed=seed)
+
+    def _generate_blocks(self, shard_index=0, num_shards=1):
+        """
+        Generates the windows in blocks of several passes over the documents
+        :param int shard_index: index of the partition of the blocks to generate
+        :param int num_shards: number of partitions, the blocks are assigned to the partitions in
+        round-robin
+        :return: a generator of tuples (doc_ids, contexts, labels) of numpy arrays, the contexts
+        have dimension [block_size, context_size]
+        """
+        if len(self.tokens) < self.context_size:
+            return
+        item_size = self.tokens.itemsize
+        # view of all the contexts in the tokens without copying them
+        contexts_view = np.lib.stride_tricks.as_strided(
+                self.tokens, shape=(len(self.tokens) - self.context_size + 1, self.context_size),
+                strides=(item_size, item_size))
+        max_windows = int(np.max(self.num_windows)) if self.num_docs > 0 else 0
+        first_passes = range(0, max_windows, self.passes_per_block)
+        for first_pass in first_passes[shard_index::num_shards]:
+            passes = np.arange(first_pass, min(first_pass + self.passes_per_block, max_windows))
+            # row major order of nonzero keeps the order of the passes and the documents
+            pass_indexes, doc_ids = np.nonzero(self.num_windows[None, :] > passes[:, None])
+            positions = self.offsets[doc_ids] + passes[pass_indexes]
+            contexts = contexts_view[positions]
+            labels = self.tokens[positions + self.context_size + 1]
+            yield doc_ids.astype(np.int32), contexts, labels
 
     def _generator(self):
-        indexes = [0] * len(self._data_lines)
-        while any([i >= 0 for i in indexes]):
-            for doc_id in range(len(self._data_lines)):
-                line = self._data_lines[doc_id]
-                index = indexes[doc_id]
-                if index < 0 or index >= len(line) - self.context_size - 1:
-                    indexes[doc_id] = -1
-                    continue
-                context = line[index:index + self.context_size]
-                label = line[index + self.context_size + 1]
-                indexes[doc_id] += 1
-                yield np.int32(doc_id), np.asarray(context, dtype=np.int32), np.int32(label)
+        for doc_ids, contexts, labels in self._generate_blocks():
+            for i in range(len(doc_ids)):
+                yield doc_ids[i], contexts[i], labels[i]
+
+    def _count_num_records(self):
+        return int(np.sum(self.num_windows))
+
+
+def _lists_generator(data_lines, context_size):
+    """
+    Generator over lists of ints as it was implemented before the numpy Doc2VecDataset, it is only
+    used to compare the performance
+    """
+    indexes = [0] * len(data_lines)
+    while any([i >= 0 for i in indexes]):
+        for doc_id in range(len(data_lines)):
+            line = data_lines[doc_id]
+            index = indexes[doc_id]
+            if index < 0 or index >= len(line) - context_size - 1:
+                indexes[doc_id] = -1
+                continue
+            context = line[index:index + context_size]
+            label = line[index + context_size + 1]
+            indexes[doc_id] += 1
+            yield np.int32(doc_id), np.asarray(context, dtype=np.int32), np.int32(label)
+
+
+def benchmark_generator(dataset, num_elements=1000000):
+    """
+    Compares the throughput of the dataset generator against the generator over lists of ints and
+    checks both generate the same elements
+    :param Doc2VecDataset dataset: the dataset
+    :param int num_elements: number of elements to generate with every generator
+    """
+    data_lines = [dataset.tokens[dataset.offsets[i]:dataset.offsets[i + 1]].tolist()
+                  for i in range(dataset.num_docs)]
+    results = {}
+    for name, generator in [('lists', _lists_generator(data_lines, dataset.context_size)),
+                            ('numpy', dataset._generator())]:
+        elements = []
+        start = time.time()
+        for element in generator:
+            elements.append(element)
+            if len(elements) >= num_elements:
+                break
+        elapsed = time.time() - start
+        results[name] = elements
+        print('{} generator: {} elements in {:0.2f} seconds, {:0.0f} elements/second'.format(
+                name, len(elements), elapsed, len(elements) / elapsed))
+    same = all(a[0] == b[0] and a[2] == b[2] and np.array_equal(a[1], b[1])
+               for a, b in zip(results['lists'], results['numpy']))
+    print('Same elements: {}'.format(same and len(results['lists']) == len(results['numpy'])))
 
 
 class Doc2VecTrainer(trainer.Trainer):
@@ -92,7 +193,7 @@ class Doc2VecTrainer(trainer.Trainer):
                                               initializer=layers.xavier_initializer(),
                                               dtype=tf.float32, name='doc_embeddings')
         words_embed = tf.nn.embedding_lookup(self.word_embeddings, input_words)
-        doc_embed = tf.nn.embedding_lookup(self.word_embeddings, input_doc)
+        doc_embed = tf.nn.embedding_lookup(self.doc_embeddings, input_doc)
         # average the words_embeds
         words_embed_average = tf.reduce_mean(words_embed, axis=1)
         embed = tf.concat([words_embed_average, doc_embed], axis=1)
@@ -153,26 +254,22 @@ class Doc2VecTrainer(trainer.Trainer):
         input_doc, input_word, output_label = dataset_tensor
         return self.model(input_doc, input_word, output_label, batch_size)
 
+    def create_hooks(self, graph_data):
+        embeddings = {'word': self.word_embeddings, 'doc': self.doc_embeddings}
+        embeddings_hook = trainer.EmbeddingsSnapshotHook(
+                embeddings, save_fn=lambda e: self.save_embeddings(e['word'], e['doc']),
+                first_save_secs=5 * 60, normalize=False)
+        return [], [embeddings_hook]
+
     def step(self, session, graph_data):
         if self.is_chief:
-            lr, _, loss, step, self.embeddings_words, self.embeddings_docs = \
-                session.run([self.learning_rate, self.optimizer, self.loss, self.global_step,
-                             self.word_embeddings, self.doc_embeddings])
+            lr, _, loss, step = session.run([self.learning_rate, self.optimizer, self.loss,
+                                             self.global_step])
             if time.time() > self.print_timestamp + 5 * 60:
                 self.print_timestamp = time.time()
                 elapsed_time = str(timedelta(seconds=time.time() - self.init_time))
                 m = 'step: {}  loss: {:0.4f}  learning_rate = {:0.6f}  elapsed seconds: {}'
                 print(m.format(step, loss, lr, elapsed_time))
-                current_time = time.time()
-                embeddings_file = 'word_embeddings_{}_{}'.format(VOCABULARY_SIZE, EMBEDDINGS_SIZE)
-                embeddings_filepath = os.path.join(DIR_DATA_DOC2VEC, embeddings_file)
-                if not os.path.exists(embeddings_filepath):
-                    self.save_embeddings(self.embeddings_words, self.embeddings_docs)
-                else:
-                    embeddings_file_timestamp = os.path.getmtime(embeddings_filepath)
-                    # save the embeddings every 30 minutes
-                    if current_time - embeddings_file_timestamp > 30 * 60:
-                        self.save_embeddings(self.embeddings_words, self.embeddings_docs)
         else:
             session.run([self.optimizer])
 
@@ -180,26 +277,23 @@ class Doc2VecTrainer(trainer.Trainer):
         self.init_time = time.time()
         self.print_timestamp = time.time()
 
-    def end(self, session):
-        if self.is_chief:
-            self.save_embeddings(self.embeddings_words, self.embeddings_docs)
-
     def save_embeddings(self, word_embeddings, doc_embeddings):
-        print('Saving embeddings in text format...')
+        print('Saving embeddings...')
         for prefix, embeddings in zip(['word', 'doc'], [word_embeddings, doc_embeddings]):
             embeddings_file = '{}_embeddings_{}_{}'.format(prefix, VOCABULARY_SIZE, EMBEDDINGS_SIZE)
             embeddings_filepath = os.path.join(DIR_DATA_DOC2VEC, embeddings_file)
-            with open(embeddings_filepath, 'w') as f:
-                writer = csv.writer(f, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
-                writer.writerows(embeddings)
-            # copy the embeddings file to the log dir so we can download it from tensorport
-            if os.path.exists(embeddings_filepath):
-                shutil.copy(embeddings_filepath, self.log_dir)
+            # copy the embeddings files to the log dir so we can download them from tensorport
+            for saved_file in save_embeddings(embeddings_filepath, embeddings):
+                shutil.copy(saved_file, self.log_dir)
 
 
 if __name__ == '__main__':
     import logging
+    import sys
     logging.getLogger().setLevel(logging.INFO)
+    if len(sys.argv) > 1 and sys.argv[1] == 'benchmark':
+        benchmark_generator(Doc2VecDataset())
+        sys.exit(0)
     # start the training
     trainer = Doc2VecTrainer(dataset=Doc2VecDataset())
     trainer.run(epochs=D2V_EPOCHS, batch_size=D2V_BATCH_SIZE)
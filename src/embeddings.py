@@ -0,0 +1,246 @@
+import time
+import argparse
+import numpy as np
+import tensorflow as tf
+from .configuration import *
+
+
+def save_embeddings(filepath, embeddings, csv_export=EMBEDDINGS_CSV_EXPORT):
+    """
+    Saves the embeddings in binary format in the file filepath.npy. The file is written to a
+    temporal file first and then renamed, so the processes reading the file never see it
+    partially written. The text file is written before the binary one, so the binary file is
+    never older than the text file saved with it (see load_embeddings).
+    :param str filepath: path of the embeddings file without the extension
+    :param np.ndarray embeddings: matrix with one embedding per row
+    :param bool csv_export: whether to also save the embeddings as text in filepath, one row per
+    line with the values separated by commas
+    :return List[str]: the list of files written
+    """
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    npy_filepath = '{}.npy'.format(filepath)
+    files = [npy_filepath]
+    if csv_export:
+        np.savetxt(filepath, embeddings, delimiter=',', fmt='%.8g')
+        files.append(filepath)
+    tmp_filepath = '{}.tmp'.format(npy_filepath)
+    with open(tmp_filepath, 'wb') as f:
+        np.save(f, embeddings)
+    os.rename(tmp_filepath, npy_filepath)
+    return files
+
+
+def load_embeddings(filepath, mmap=True):
+    """
+    Loads an embeddings file. If the binary file filepath.npy exists and it is not older than the
+    text file it is memory mapped as read-only, so all the processes in the same host share the
+    same memory. Otherwise the embeddings are read from the text file filepath, one row per line
+    with the values separated by commas, so a text file written after the binary one (e.g. by an
+    older version of the training) is not shadowed by stale binary embeddings.
+    :param str filepath: path of the embeddings file without the extension
+    :param bool mmap: whether to memory map the binary file or read it into memory
+    :return np.ndarray: a float32 matrix with one embedding per row
+    """
+    npy_filepath = '{}.npy'.format(filepath)
+    if os.path.exists(npy_filepath) and (not os.path.exists(filepath) or
+                                         os.path.getmtime(npy_filepath) >=
+                                         os.path.getmtime(filepath)):
+        return np.load(npy_filepath, mmap_mode='r' if mmap else None)
+    return np.loadtxt(filepath, delimiter=',', dtype=np.float32, ndmin=2)
+
+
+def embeddings_variable(embeddings, name='embeddings', zeros_row=False):
+    """
+    Creates a non trainable local variable with the embeddings. The variable is initialized with a
+    py_func that reads the numpy array when the session initializes the local variables, so the
+    values are neither stored in the graph nor in the checkpoints (the savers only save the global
+    variables).
+    :param np.ndarray embeddings: matrix with one embedding per row, it can be memory mapped
+    :param str name: name of the variable
+    :param bool zeros_row: whether to add a row of zeros at the beginning of the embeddings, it is
+    used for the padding
+    :return tf.Variable: the variable with the embeddings
+    """
+    rows, dimension = embeddings.shape
+    if zeros_row:
+        rows += 1
+
+    def _initial_value():
+        values = np.asarray(embeddings, dtype=np.float32)
+        if zeros_row:
+            values = np.concatenate([np.zeros([1, dimension], dtype=np.float32), values])
+        return values
+
+    # the py_func runs in the process that creates the graph, so the variable is not placed in
+    # the parameter servers in distributed training
+    with tf.device(None):
+        initial_value = tf.py_func(_initial_value, [], tf.float32, stateful=False,
+                                   name='{}_initial_value'.format(name))
+        initial_value.set_shape([rows, dimension])
+        return tf.Variable(initial_value, trainable=False, name=name,
+                           collections=[tf.GraphKeys.LOCAL_VARIABLES])
+
+
+def normalize_embeddings(embeddings):
+    """
+    L2-normalizes the rows of the embeddings. Rows with norm 0 are kept as zeros.
+    :param np.ndarray embeddings: matrix with one embedding per row
+    :return np.ndarray: a contiguous float32 matrix with the normalized embeddings
+    """
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    norm = np.sqrt(np.sum(np.square(embeddings), axis=1, keepdims=True))
+    norm[norm == 0.0] = 1.0
+    return np.ascontiguousarray(embeddings / norm, dtype=np.float32)
+
+
+def _merge_top_k(scores, indexes, k):
+    """
+    Keeps the k best scores per row, the result is not sorted
+    :param np.ndarray scores: matrix [queries, candidates] with the scores
+    :param np.ndarray indexes: matrix [queries, candidates] with the indexes of the scores
+    :param int k: number of elements to keep
+    :return (np.ndarray, np.ndarray): a tuple with the scores and indexes of the top k
+    """
+    if scores.shape[1] <= k:
+        return scores, indexes
+    top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    rows = np.arange(scores.shape[0])[:, None]
+    return scores[rows, top], indexes[rows, top]
+
+
+class EmbeddingsIndex(object):
+    """
+    Index over a matrix of embeddings to answer batched top-k cosine similarity queries. The
+    embeddings are normalized once and the similarities are computed with blocked matrix
+    multiplications, so the memory used per query is bounded by the block size.
+
+    With quantize=True the index keeps an int8 copy of the normalized embeddings (4 times smaller)
+    which is used to select candidates, the candidates are re-ranked with the exact embeddings.
+    """
+
+    def __init__(self, embeddings, block_size=8192, quantize=False, rerank_factor=4):
+        """
+        :param np.ndarray embeddings: matrix with one embedding per row
+        :param int block_size: number of embeddings multiplied at once
+        :param bool quantize: whether to use an int8 quantized copy of the embeddings to find
+        the candidates
+        :param int rerank_factor: with quantize, number of candidates per result re-ranked with
+        the exact embeddings
+        """
+        self.block_size = block_size
+        self.quantize = quantize
+        self.rerank_factor = rerank_factor
+        self.embeddings = normalize_embeddings(embeddings)
+        self.size, self.dimension = self.embeddings.shape
+        if quantize:
+            # symmetric per-row quantization, normalized values are in [-1, 1]
+            scale = np.max(np.abs(self.embeddings), axis=1, keepdims=True) / 127.0
+            scale[scale == 0.0] = 1.0
+            self._quantized = np.round(self.embeddings / scale).astype(np.int8)
+            self._scale = scale.astype(np.float32).reshape(-1)
+
+    def query(self, vectors, k=10, exclude=None):
+        """
+        Finds the k most similar embeddings for every vector
+        :param np.ndarray vectors: matrix [queries, dimension] with the query vectors
+        :param int k: number of results per query
+        :param List[int] exclude: optional index to exclude from the results of every query (for
+        example the query itself), it must have one element per query or -1 to not exclude
+        :return (np.ndarray, np.ndarray): a tuple with the indexes and the cosine similarities,
+        both matrices with dimension [queries, k] sorted by similarity
+        """
+        queries = normalize_embeddings(np.atleast_2d(vectors))
+        k = min(k, self.size)
+        if self.quantize:
+            candidates = min(self.size, k * self.rerank_factor)
+            indexes, _ = self._search(queries, candidates, exclude, quantized=True)
+            rows = np.arange(queries.shape[0])[:, None]
+            scores = np.einsum('qd,qkd->qk', queries, self.embeddings[indexes])
+            scores, indexes = _merge_top_k(scores, indexes, k)
+            order = np.argsort(-scores, axis=1)
+            return indexes[rows, order], scores[rows, order]
+        return self._search(queries, k, exclude)
+
+    def query_indexes(self, indexes, k=10):
+        """
+        Finds the k most similar embeddings for embeddings already in the index, the embedding
+        itself is excluded from the results
+        :param List[int] indexes: rows of the index used as queries
+        :param int k: number of results per query
+        :return (np.ndarray, np.ndarray): see query()
+        """
+        indexes = np.asarray(indexes, dtype=np.int64)
+        return self.query(self.embeddings[indexes], k=k, exclude=indexes)
+
+    def _search(self, queries, k, exclude, quantized=False):
+        num_queries = queries.shape[0]
+        best_scores = np.full((num_queries, 0), -np.inf, dtype=np.float32)
+        best_indexes = np.zeros((num_queries, 0), dtype=np.int64)
+        if exclude is not None:
+            exclude = np.asarray(exclude, dtype=np.int64).reshape(-1, 1)
+        for start in range(0, self.size, self.block_size):
+            end = min(start + self.block_size, self.size)
+            if quantized:
+                block = self._quantized[start:end].astype(np.float32)
+                scores = np.dot(queries, block.T) * self._scale[start:end]
+            else:
+                scores = np.dot(queries, self.embeddings[start:end].T)
+            indexes = np.broadcast_to(np.arange(start, end), scores.shape)
+            if exclude is not None:
+                scores[indexes == exclude] = -np.inf
+            scores, indexes = _merge_top_k(scores, indexes, k)
+            best_scores = np.concatenate([best_scores, scores], axis=1)
+            best_indexes = np.concatenate([best_indexes, indexes], axis=1)
+            best_scores, best_indexes = _merge_top_k(best_scores, best_indexes, k)
+        rows = np.arange(num_queries)[:, None]
+        order = np.argsort(-best_scores, axis=1)
+        return best_indexes[rows, order], best_scores[rows, order]
+
+
+def _embeddings_filepath(embeddings_type, vocabulary_size=VOCABULARY_SIZE,
+                         embeddings_size=EMBEDDINGS_SIZE):
+    if embeddings_type == 'word2vec':
+        filename, directory = 'embeddings', DIR_DATA_WORD2VEC
+    elif embeddings_type == 'doc2vec_words':
+        filename, directory = 'word_embeddings', DIR_DATA_DOC2VEC
+    elif embeddings_type == 'doc2vec_docs':
+        filename, directory = 'doc_embeddings', DIR_DATA_DOC2VEC
+    else:
+        raise ValueError('Unknown embeddings type {}'.format(embeddings_type))
+    filename = '{}_{}_{}'.format(filename, vocabulary_size, embeddings_size)
+    return os.path.join(directory, filename)
+
+
+if __name__ == '__main__':
+    from .rnn.text_classification_process_data import load_word2vec_dict
+
+    parser = argparse.ArgumentParser(description='Nearest neighbours in the trained embeddings')
+    parser.add_argument('embeddings', choices=['word2vec', 'doc2vec_words', 'doc2vec_docs'])
+    parser.add_argument('queries', nargs='+',
+                        help='words for word embeddings or document ids for doc embeddings')
+    parser.add_argument('-k', dest='k', type=int, default=10)
+    parser.add_argument('--quantize', dest='quantize', action='store_true')
+    args = parser.parse_args()
+
+    start = time.time()
+    index = EmbeddingsIndex(load_embeddings(_embeddings_filepath(args.embeddings)),
+                            quantize=args.quantize)
+    print('Index with {} embeddings built in {:0.3f} seconds'.format(index.size,
+                                                                     time.time() - start))
+    if args.embeddings == 'doc2vec_docs':
+        query_ids = [int(q) for q in args.queries]
+        names = dict((i, str(i)) for i in range(index.size))
+    else:
+        symbols_dict = load_word2vec_dict('word2vec_dataset')
+        names = dict((v, k) for k, v in symbols_dict.items() if v != 0)
+        names[0] = '_UNKOWN_'
+        query_ids = [symbols_dict.get(q.lower(), 0) for q in args.queries]
+
+    start = time.time()
+    results, similarities = index.query_indexes(query_ids, k=args.k)
+    elapsed = time.time() - start
+    print('{} queries in {:0.3f} ms ({:0.3f} ms per query)'.format(
+            len(query_ids), elapsed * 1000, elapsed * 1000 / len(query_ids)))
+    for query, result, similarity in zip(args.queries, results, similarities):
+        print('{}: {}'.format(query, ', '.join(['{} ({:0.3f})'.format(names[r], s)
+                                                for r, s in zip(result, similarity)])))
@@ -3,6 +3,7 @@ import time
 from shutil import copyfile
 import os
 import glob
+import numpy as np
 import tensorflow as tf
 from tensorflow.python.training import session_run_hook, training_util
 from tensorflow.python.framework.errors_impl import OutOfRangeError
@@ -131,3 +132,32 @@ class Evaluator(session_run_hook.SessionRunHook):
         with open(os.path.join(self.output_path, 'checkpoint'), 'wb') as f:
             f.write('model_checkpoint_path: "{}"\n'.format(name))
             f.write('all_model_checkpoint_paths: "{}"\n'.format(name))
+
+
+def smooth_predictions(predictions, smoothing=0.01):
+    """
+    Adds a small value to all the probabilities and normalizes them again, so the mistakes are
+    penalized less in the log loss
+    :param np.ndarray predictions: matrix [documents, classes] with the probabilities
+    :param float smoothing: value added to every probability
+    :return np.ndarray: the smoothed probabilities
+    """
+    predictions = np.asarray(predictions, dtype=np.float64) + smoothing
+    return predictions / np.sum(predictions, axis=1, keepdims=True)
+
+
+def write_submission(filepath, predictions, buffer_size=1024 * 1024):
+    """
+    Writes the predictions in the format of the submission, the id of every document is its
+    position in the dataset starting from 1
+    :param str filepath: path of the submission file
+    :param np.ndarray predictions: matrix [documents, classes] with the probabilities
+    :param int buffer_size: size of the buffer of the writer
+    """
+    num_classes = predictions.shape[1]
+    header = ['ID'] + ['class{}'.format(i + 1) for i in range(num_classes)]
+    row_format = '{},' + ','.join(['{:.3f}'] * num_classes) + '\n'
+    with open(filepath, 'w', buffer_size) as f:
+        f.write(','.join(header) + '\n')
+        for i, prediction in enumerate(predictions):
+            f.write(row_format.format(i + 1, *prediction))
@@ -0,0 +1,180 @@
+import random
+import logging
+import traceback
+import multiprocessing
+import numpy as np
+from .tf_dataset_generator import _rebatch
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+def _multiprocessing_context():
+    """
+    :return: the multiprocessing context used to start the workers. The workers are started from a
+    forkserver process, forking the process of tensorflow could deadlock on the locks held by its
+    other threads. In python 2 there are no contexts and the workers are forked
+    """
+    if hasattr(multiprocessing, 'get_context'):
+        return multiprocessing.get_context('forkserver')
+    logging.warning('The generator workers are forked from a multithreaded process')
+    return multiprocessing
+
+
+def _worker(generator, shard_index, num_shards, num_epochs, batch_size, shuffle, seed, slots,
+            free_slots, full_slots):
+    """
+    Runs one partition of a blocks generator and writes its batches in the shared memory slots of
+    the worker. Sends ('batch', slot, metadata) for every batch written in a slot, ('data', arrays)
+    for the batches that do not fit in a slot, ('error', traceback) if the generator fails and
+    ('end', None) at the end.
+    """
+    try:
+        # a forked process has a copy of the random state of the parent, it is always reseeded so
+        # the workers do not generate the same numbers. With None the seed comes from the OS
+        worker_seed = None if seed is None else seed + shard_index
+        random.seed(worker_seed)
+        np.random.seed(worker_seed)
+        random_state = np.random.RandomState(worker_seed) if shuffle else None
+        buffers = [np.frombuffer(slot, dtype=np.uint8) for slot in slots]
+
+        def _blocks():
+            for _ in range(num_epochs):
+                for block in generator(shard_index=shard_index, num_shards=num_shards):
+                    yield block
+
+        for batch in _rebatch(_blocks(), batch_size, random_state):
+            arrays = [np.ascontiguousarray(array) for array in batch]
+            if sum(array.nbytes for array in arrays) > len(buffers[0]):
+                full_slots.put(('data', arrays))
+                continue
+            slot = free_slots.get()
+            metadata = []
+            offset = 0
+            for array in arrays:
+                buffers[slot][offset:offset + array.nbytes] = array.view(np.uint8).reshape(-1)
+                metadata.append((array.dtype.str, array.shape, offset))
+                offset += array.nbytes
+            full_slots.put(('batch', slot, metadata))
+    except Exception:
+        full_slots.put(('error', traceback.format_exc()))
+    else:
+        full_slots.put(('end', None))
+
+
+class GeneratorWorkers(object):
+    """
+    Runs a blocks generator in several processes. Every process runs a partition of the
+    generator, the generator is called with the arguments shard_index and num_shards and it must
+    yield only the blocks of its partition. The processes cut the blocks in batches and copy them
+    into a ring of shared memory slots, so only the metadata of the batches is pickled. The
+    batches are read from the workers in round-robin, so with a fixed seed the order of the
+    batches is always the same. The processes end after the last epoch or when the iteration is
+    stopped.
+
+    The processes are started from a forkserver and not forked from the tensorflow process (which
+    is multithreaded and iterates the batches from a py_func), so the generator is pickled and
+    sent to every process: it must be a function or a method of a picklable object, e.g. a method
+    of the dataset, and the data of the object is copied in every process. The random generators
+    random and np.random are reseeded in every process.
+    """
+
+    def __init__(self, generator, num_workers, batch_size, num_epochs=1, shuffle=False,
+                 seed=None, slots_per_worker=4, slot_bytes=4 * 1024 * 1024, shard_index=0,
+                 num_shards=1):
+        """
+        :param generator: a callable with the parameters shard_index and num_shards that returns
+        a generator of blocks, tuples of numpy arrays with the same first dimension
+        :param int num_workers: number of processes
+        :param int batch_size: size of the batches
+        :param int num_epochs: number of times every worker runs its partition
+        :param bool shuffle: whether to shuffle the rows of the blocks
+        :param int seed: seed of the random generators of the workers, every worker uses
+        seed + the index of its partition. None to seed every worker from the OS entropy
+        :param int slots_per_worker: number of batches buffered by every worker
+        :param int slot_bytes: size in bytes of every slot, larger batches are pickled
+        :param int shard_index: index of the partition of the generator run by these workers,
+        the partition is split again between the workers
+        :param int num_shards: number of partitions of the generator, e.g. one per machine
+        """
+        self.generator = generator
+        self.num_workers = num_workers
+        self.batch_size = batch_size
+        self.num_epochs = num_epochs
+        self.shuffle = shuffle
+        self.seed = seed
+        self.slots_per_worker = slots_per_worker
+        self.slot_bytes = slot_bytes
+        self.shard_index = shard_index
+        self.num_shards = num_shards
+
+    def __iter__(self):
+        processes = []
+        full_queues = []
+        context = _multiprocessing_context()
+        try:
+            for index in range(self.num_workers):
+                slots = [context.RawArray('b', self.slot_bytes)
+                         for _ in range(self.slots_per_worker)]
+                free_slots = context.Queue()
+                for slot in range(self.slots_per_worker):
+                    free_slots.put(slot)
+                full_slots = context.Queue()
+                process = context.Process(target=_worker,
+                                                  args=(self.generator,
+                                                        self.shard_index * self.num_workers + index,
+                                                        self.num_shards * self.num_workers,
+                                                        self.num_epochs, self.batch_size,
+                                                        self.shuffle, self.seed, slots,
+                                                        free_slots, full_slots))
+                process.daemon = True
+                process.start()
+                processes.append(process)
+                full_queues.append((full_slots, free_slots,
+                                    [np.frombuffer(slot, dtype=np.uint8) for slot in slots]))
+
+            active = list(range(self.num_workers))
+            while active:
+                for index in list(active):
+                    full_slots, free_slots, buffers = full_queues[index]
+                    message = self._get(full_slots, processes[index])
+                    if message[0] == 'end':
+                        active.remove(index)
+                    elif message[0] == 'error':
+                        raise RuntimeError('Generator worker {} failed:\n{}'
+                                           .format(index, message[1]))
+                    elif message[0] == 'data':
+                        yield tuple(message[1])
+                    else:
+                        _, slot, metadata = message
+                        batch = []
+                        for dtype, shape, offset in metadata:
+                            dtype = np.dtype(dtype)
+                            size = int(np.prod(shape)) * dtype.itemsize
+                            batch.append(buffers[slot][offset:offset + size].view(dtype)
+                                         .reshape(shape).copy())
+                        free_slots.put(slot)
+                        yield tuple(batch)
+            for process in processes:
+                process.join()
+        finally:
+            for process in processes:
+                if process.is_alive():
+                    process.terminate()
+                    process.join()
+
+    def _get(self, full_slots, process):
+        while True:
+            try:
+                return full_slots.get(timeout=1.0)
+            except queue.Empty:
+                if not process.is_alive():
+                    # the last messages could be still in the pipe
+                    try:
+                        return full_slots.get(timeout=1.0)
+                    except queue.Empty:
+                        pass
+                    raise RuntimeError('Generator worker ended unexpectedly with exit code {}'
+                                       .format(process.exitcode))
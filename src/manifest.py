@@ -0,0 +1,95 @@
+import numpy as np
+import tensorflow as tf
+
+
+def manifest_path(filepath):
+    return '{}.manifest.npz'.format(filepath)
+
+
+class Manifest(object):
+    """
+    Index of a data file with one record per line. It has the byte offset of every record, its
+    length in tokens (the tokens of the text for the lines with the format
+    class || gene || variant ids || token ids, all the tokens of the line otherwise), its class
+    (-1 if the record does not have one) and the histogram of the classes.
+    """
+
+    def __init__(self, offsets, lengths, classes, data_size, data_mtime=None):
+        """
+        :param np.ndarray offsets: byte offset of every record in the data file
+        :param np.ndarray lengths: number of tokens of every record
+        :param np.ndarray classes: class of every record, -1 for unknown
+        :param int data_size: size in bytes of the data file when the manifest was created
+        :param int data_mtime: modification time in nanoseconds of the data file when the manifest
+        was created
+        """
+        self.offsets = offsets
+        self.lengths = lengths
+        self.classes = classes
+        self.data_size = data_size
+        self.data_mtime = data_mtime
+        known_classes = classes[classes >= 0]
+        self.class_histogram = np.bincount(known_classes) if len(known_classes) > 0 \
+            else np.zeros(0, dtype=np.int64)
+
+    @property
+    def num_records(self):
+        return len(self.offsets)
+
+
+def create_manifest(filepath):
+    """
+    Creates the manifest of a data file with one record per line, the empty lines are skipped. The
+    manifest is saved next to the data file.
+    :param str filepath: path of the data file
+    :return Manifest: the manifest
+    """
+    data_mtime = tf.gfile.Stat(filepath).mtime_nsec
+    offsets = []
+    lengths = []
+    classes = []
+    offset = 0
+    with tf.gfile.GFile(filepath, 'rb') as f:
+        for line in f:
+            if line.strip():
+                fields = line.split(b'||')
+                if len(fields) > 3:
+                    lengths.append(len(fields[3].split()))
+                    example_class = fields[0].strip()
+                    classes.append(int(example_class) if example_class.isdigit() else -1)
+                else:
+                    lengths.append(len(fields[0].split()))
+                    classes.append(-1)
+                offsets.append(offset)
+            offset += len(line)
+    manifest = Manifest(offsets=np.asarray(offsets, dtype=np.int64),
+                        lengths=np.asarray(lengths, dtype=np.int32),
+                        classes=np.asarray(classes, dtype=np.int32),
+                        data_size=offset,
+                        data_mtime=data_mtime)
+    tmp_filepath = '{}.tmp'.format(manifest_path(filepath))
+    with tf.gfile.Open(tmp_filepath, 'wb') as f:
+        np.savez(f, offsets=manifest.offsets, lengths=manifest.lengths, classes=manifest.classes,
+                 data_size=np.int64(manifest.data_size), data_mtime=np.int64(data_mtime))
+    tf.gfile.Rename(tmp_filepath, manifest_path(filepath), overwrite=True)
+    return manifest
+
+
+def load_manifest(filepath):
+    """
+    Loads the manifest of a data file. It is created if it does not exist or if the data file
+    changed since the manifest was created (its size or its modification time are different).
+    :param str filepath: path of the data file
+    :return Manifest: the manifest
+    """
+    if tf.gfile.Exists(manifest_path(filepath)):
+        with tf.gfile.Open(manifest_path(filepath), 'rb') as f:
+            data = np.load(f)
+            data_mtime = int(data['data_mtime']) if 'data_mtime' in data.files else None
+            manifest = Manifest(offsets=data['offsets'], lengths=data['lengths'],
+                                classes=data['classes'], data_size=int(data['data_size']),
+                                data_mtime=data_mtime)
+        stat = tf.gfile.Stat(filepath)
+        if manifest.data_size == stat.length and manifest.data_mtime == stat.mtime_nsec:
+            return manifest
+    return create_manifest(filepath)
@@ -11,6 +11,7 @@ else:
 from bs4 import BeautifulSoup
 import unicodedata
 import copy
+import heapq
 import nltk
 import pandas as pd
 from .configuration import *
@@ -251,6 +252,49 @@ def group_count(elements, group=None):
     return group
 
 
+def space_saving_count(elements, capacity):
+    """
+    Approximate count of the elements with the Space-Saving algorithm. At most capacity elements are
+    kept in memory, when a new element arrives and the table is full it replaces the element with
+    the minimum count and inherits its count as error. Every element with a real count greater than
+    total/capacity is guaranteed to be in the result and the count of an element is never
+    underestimated: count - error <= real count <= count.
+    :param elements: iterable of str, it can be a generator so the elements are not kept in memory
+    :param int capacity: maximum number of elements counted at the same time
+    :return (Dict[str, int], Dict[str, int], int): a tuple with the estimated count of the elements,
+    the maximum overestimation of every count and the total number of elements
+    """
+    counts = {}
+    errors = {}
+    heap = []
+    total = 0
+    for e in elements:
+        total += 1
+        if e in counts:
+            counts[e] += 1
+            heapq.heappush(heap, (counts[e], e))
+        elif len(counts) < capacity:
+            counts[e] = 1
+            errors[e] = 0
+            heapq.heappush(heap, (1, e))
+        else:
+            # pop outdated entries of the heap until the real minimum is found
+            while True:
+                min_count, min_element = heapq.heappop(heap)
+                if counts.get(min_element, None) == min_count:
+                    break
+            del counts[min_element]
+            del errors[min_element]
+            counts[e] = min_count + 1
+            errors[e] = min_count
+            heapq.heappush(heap, (counts[e], e))
+        if len(heap) > capacity * 4:
+            # remove the outdated entries
+            heap = [(c, k) for k, c in counts.items()]
+            heapq.heapify(heap)
+    return counts, errors, total
+
+
 def show_stats(train_set, test_set):
     """
     Shows some statistics of the datasets
@@ -0,0 +1,256 @@
+import sys
+import json
+import logging
+import numpy as np
+import tensorflow as tf
+from .configuration import *
+
+RECORDS_VERSION = 2
+
+
+def load_sentence_split_symbol(vocabulary_size=VOCABULARY_SIZE):
+    """
+    Loads the id of the symbol used to split the sentences ('.') from the word2vec dictionary
+    :param int vocabulary_size: the size of the vocabulary of the dictionary
+    :return int: the id of the symbol or None if it is not in the dictionary
+    """
+    dict_filename = 'word2vec_dataset_{}_dict'.format(vocabulary_size)
+    dict_filepath = os.path.join(DIR_DATA_WORD2VEC, dict_filename)
+    with tf.gfile.FastGFile(dict_filepath, 'r') as f:
+        for line in f:
+            data = line.split()
+            if data[0] == '.':
+                return int(data[1])
+    return None
+
+
+def records_index_path(set_filepath):
+    return '{}_records.index'.format(set_filepath)
+
+
+def _source_stat(set_filepath):
+    """
+    :param str set_filepath: path of the text file of the set
+    :return dict: the size and modification time of the text file
+    """
+    stat = tf.gfile.Stat(set_filepath)
+    return {'size': stat.length, 'mtime_nsec': stat.mtime_nsec}
+
+
+def load_records_index(set_filepath):
+    """
+    :param str set_filepath: path of the text file of the set
+    :return dict: the index of the records of the set, see convert_to_records
+    """
+    with tf.gfile.Open(records_index_path(set_filepath), 'r') as f:
+        return json.loads(f.read())
+
+
+def records_exist(set_filepath):
+    """
+    :param str set_filepath: path of the text file of the set
+    :return bool: whether the records of the set were created from the current text file. The
+    records created from a previous version of the text file are ignored
+    """
+    if not tf.gfile.Exists(records_index_path(set_filepath)):
+        return False
+    index = load_records_index(set_filepath)
+    if index.get('version') != RECORDS_VERSION or \
+            index.get('source') != _source_stat(set_filepath):
+        logging.warning('The records of {} are stale, they are ignored. Run '
+                        'src.records to create them again'.format(set_filepath))
+        return False
+    return True
+
+
+def _sentences(tokens, sentence_split):
+    """
+    Finds the sentences of a document, the sentences are the runs of tokens between the split
+    symbols
+    :param np.ndarray tokens: the tokens of the document
+    :param int sentence_split: the id of the split symbol, if None the document is a sentence
+    :return (np.ndarray, np.ndarray): the start and end (exclusive) of every sentence
+    """
+    if sentence_split is None:
+        is_word = np.ones(len(tokens), dtype=np.bool_)
+    else:
+        is_word = tokens != sentence_split
+    changes = np.diff(np.concatenate([[0], is_word.astype(np.int8), [0]]))
+    return np.nonzero(changes == 1)[0], np.nonzero(changes == -1)[0]
+
+
+def _write_shard(filepath, docs):
+    tokens = [d['tokens'] for d in docs]
+    variants = [d['variant'] for d in docs]
+    starts = [d['sentences'][0] for d in docs]
+    ends = [d['sentences'][1] for d in docs]
+
+    def _offsets(arrays):
+        offsets = np.zeros(len(arrays) + 1, dtype=np.int64)
+        np.cumsum([len(a) for a in arrays], out=offsets[1:])
+        return offsets
+
+    def _concatenate(arrays, dtype):
+        return np.concatenate(arrays).astype(dtype) if arrays else np.zeros(0, dtype=dtype)
+
+    tmp_filepath = '{}.tmp'.format(filepath)
+    with tf.gfile.Open(tmp_filepath, 'wb') as f:
+        np.savez(f,
+                 tokens=_concatenate(tokens, np.uint16),
+                 token_offsets=_offsets(tokens),
+                 sentence_starts=_concatenate(starts, np.int32),
+                 sentence_ends=_concatenate(ends, np.int32),
+                 sentence_offsets=_offsets(starts),
+                 variants=_concatenate(variants, np.uint16),
+                 variant_offsets=_offsets(variants),
+                 genes=np.asarray([d['gene'] for d in docs], dtype=np.int32),
+                 classes=np.asarray([d['class'] for d in docs], dtype=np.int8),
+                 doc_ids=np.asarray([d['doc_id'] for d in docs], dtype=np.int64),
+                 lengths=np.asarray([len(t) for t in tokens], dtype=np.int32))
+    tf.gfile.Rename(tmp_filepath, filepath, overwrite=True)
+
+
+def convert_to_records(set_filepath, num_shards=RECORDS_NUM_SHARDS, sentence_split=None):
+    """
+    Converts a text file of a set (lines with: class || gene || variant ids || token ids) into
+    binary records. The records are split in num_shards files named
+    {set_filepath}_records-0000i-of-0000N and an index {set_filepath}_records.index with the
+    number of records of every shard. The index also has the size and modification time of the
+    text file, the records are ignored when the text file changes (see records_exist).
+
+    Every shard is a numpy npz file with the concatenated uint16 tokens and variant ids of the
+    documents and their offsets, the start and end of every sentence relative to the start of the
+    document, the gene id, the class (starting from 0, -1 for the test sets), the position of the
+    document in the text file and its number of tokens.
+    :param str set_filepath: path of the text file of the set
+    :param int num_shards: number of shard files
+    :param int sentence_split: the id of the symbol that splits the sentences
+    :return int: the number of records
+    """
+    source = _source_stat(set_filepath)
+    docs = []
+    with tf.gfile.FastGFile(set_filepath, 'r') as f:
+        for doc_id, line in enumerate(f):
+            example = line.split('||')
+            example_class = example[0].strip()
+            tokens = np.asarray(example[3].split(), dtype=np.int64)
+            variant = np.asarray(example[2].split(), dtype=np.int64)
+            if (len(tokens) > 0 and np.max(tokens) > np.iinfo(np.uint16).max) or \
+                    (len(variant) > 0 and np.max(variant) > np.iinfo(np.uint16).max):
+                raise ValueError('Token ids must fit in 16 bits, document {}'.format(doc_id))
+            docs.append({
+                'tokens': tokens,
+                'variant': variant,
+                'sentences': _sentences(tokens, sentence_split),
+                'gene': int(example[1].strip()),
+                'class': int(example_class) - 1 if example_class.isdigit() else -1,
+                'doc_id': doc_id,
+            })
+
+    directory, filename = os.path.split(set_filepath)
+    num_shards = max(1, min(num_shards, len(docs)))
+    shards = []
+    for shard in range(num_shards):
+        shard_docs = docs[len(docs) * shard // num_shards:len(docs) * (shard + 1) // num_shards]
+        shard_filename = '{}_records-{:05d}-of-{:05d}'.format(filename, shard, num_shards)
+        _write_shard(os.path.join(directory, shard_filename), shard_docs)
+        shards.append({'file': shard_filename, 'num_records': len(shard_docs)})
+
+    index = {
+        'version': RECORDS_VERSION,
+        'num_records': len(docs),
+        'sentence_split': sentence_split,
+        'source': source,
+        'shards': shards,
+    }
+    with tf.gfile.Open(records_index_path(set_filepath), 'w') as f:
+        f.write(json.dumps(index, indent=2))
+    return len(docs)
+
+
+class Records(object):
+    """
+    The records of a set loaded in memory. The arrays of the shards are concatenated, the
+    tokens of the document i are tokens[token_offsets[i]:token_offsets[i+1]] and the same for the
+    variants and the sentences.
+    """
+
+    def __init__(self, set_filepath, shard_index=0, num_shards=1):
+        """
+        :param str set_filepath: path of the text file of the set, the records must have been
+        created with convert_to_records
+        :param int shard_index: with num_shards, index of the subset of the shard files loaded
+        :param int num_shards: number of subsets of the shard files, the shard files are assigned
+        to the subsets in round-robin. By default all the shard files are loaded
+        """
+        self.index = load_records_index(set_filepath)
+        if self.index['version'] != RECORDS_VERSION:
+            raise ValueError('Version of the records {} not supported'
+                             .format(self.index['version']))
+        self.sentence_split = self.index['sentence_split']
+        directory = os.path.dirname(set_filepath)
+        shards = []
+        for shard in self.index['shards'][shard_index::num_shards]:
+            with tf.gfile.Open(os.path.join(directory, shard['file']), 'rb') as f:
+                data = np.load(f)
+                shards.append(dict((key, data[key]) for key in data.files))
+
+        def _concatenate(key):
+            return np.concatenate([s[key] for s in shards])
+
+        def _concatenate_offsets(key):
+            offsets = [np.zeros(1, dtype=np.int64)]
+            for s in shards:
+                offsets.append(s[key][1:] + offsets[-1][-1])
+            return np.concatenate(offsets)
+
+        self.tokens = _concatenate('tokens')
+        self.token_offsets = _concatenate_offsets('token_offsets')
+        self.sentence_starts = _concatenate('sentence_starts')
+        self.sentence_ends = _concatenate('sentence_ends')
+        self.sentence_offsets = _concatenate_offsets('sentence_offsets')
+        self.variants = _concatenate('variants')
+        self.variant_offsets = _concatenate_offsets('variant_offsets')
+        self.genes = _concatenate('genes')
+        self.classes = _concatenate('classes').astype(np.int32)
+        self.doc_ids = _concatenate('doc_ids')
+        self.lengths = _concatenate('lengths')
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def doc_tokens(self, i):
+        return self.tokens[self.token_offsets[i]:self.token_offsets[i + 1]].astype(np.int32)
+
+    def doc_variant(self, i):
+        return self.variants[self.variant_offsets[i]:self.variant_offsets[i + 1]].astype(np.int32)
+
+    def doc_sentences(self, i):
+        """
+        :param int i: index of the document
+        :return List[np.ndarray]: the tokens of every sentence of the document
+        """
+        tokens = self.doc_tokens(i)
+        sentences = slice(self.sentence_offsets[i], self.sentence_offsets[i + 1])
+        return [tokens[start:end] for start, end in zip(self.sentence_starts[sentences],
+                                                        self.sentence_ends[sentences])]
+
+
+if __name__ == '__main__':
+    import time
+
+    if len(sys.argv) > 1 and sys.argv[1] in ['text_classification', 'doc2vec']:
+        if sys.argv[1] == 'text_classification':
+            data_dir = DIR_DATA_TEXT_CLASSIFICATION
+        else:
+            data_dir = DIR_DATA_DOC2VEC
+        split_symbol = load_sentence_split_symbol()
+        for set_type in ['train', 'val', 'test', 'stage2_test']:
+            filepath = os.path.join(data_dir, '{}_set'.format(set_type))
+            if tf.gfile.Exists(filepath):
+                start = time.time()
+                records = convert_to_records(filepath, sentence_split=split_symbol)
+                print('{} records of {} converted in {:0.2f} seconds'.format(records, filepath,
+                                                                             time.time() - start))
+    else:
+        print('Usage: python -m src.records [text_classification|doc2vec]')
@@ -1,8 +1,14 @@
+import logging
+import multiprocessing
 import tensorflow as tf
 import numpy as np
 from itertools import groupby
+from tensorflow.contrib.data import Dataset
 from ..configuration import *
 from ..tf_dataset import TFDataSet
+from ..tf_dataset_generator import dataset_from_generator, prefetch_dataset
+from ..manifest import load_manifest
+from ..records import records_exist, Records, load_records_index, load_sentence_split_symbol
 
 
 def _padding(arr, pad, token=-1):
@@ -16,15 +22,176 @@ def _padding(arr, pad, token=-1):
         return arr
 
 
+def _padding_shape(values, length):
+    return tf.concat([[length], tf.shape(values)[1:]], axis=0)
+
+
+def balanced_sample(random, indexes, classes, oversampling=TC_BALANCE_OVERSAMPLING):
+    """
+    Samples the records of an epoch so all the classes have the same number of records, as many
+    as oversampling times the records of the largest class. The records of every class are
+    shuffled and repeated in turns, so all the records of a class are read before any of them is
+    repeated
+    :param np.random.RandomState random: the random generator
+    :param np.ndarray indexes: the indexes of the records
+    :param np.ndarray classes: the class of every record
+    :param float oversampling: records per class divided by the records of the largest class
+    :return np.ndarray: the shuffled indexes of the epoch
+    """
+    if len(indexes) == 0:
+        return indexes
+    _, inverse, counts = np.unique(classes, return_inverse=True, return_counts=True)
+    samples = balanced_samples_per_class(counts, oversampling)
+    epoch = [np.resize(random.permutation(indexes[inverse == c]), samples)
+             for c in range(len(counts))]
+    return random.permutation(np.concatenate(epoch))
+
+
+def balanced_samples_per_class(counts, oversampling=TC_BALANCE_OVERSAMPLING):
+    """
+    :param np.ndarray counts: number of records of every class
+    :param float oversampling: see balanced_sample
+    :return int: number of records of every class in a balanced epoch
+    """
+    return int(np.ceil(oversampling * np.max(counts)))
+
+
+def bucket_batch_sizes(bucket_boundaries, max_length, batch_size, token_budget=None):
+    """
+    Computes the batch size of every bucket and the size of the windows of group_by_window. The
+    batch sizes are divisors of the window size, so all the batches of a full window are complete
+    :param List[int] bucket_boundaries: boundaries of the lengths of the buckets
+    :param int max_length: maximum length of a document
+    :param int batch_size: the batch size used without token budget
+    :param int token_budget: maximum number of tokens in a batch, None to use batch_size
+    :return (List[int], int): the batch size of every bucket and the window size
+    """
+    if token_budget is None:
+        return [batch_size] * (len(bucket_boundaries) + 1), batch_size
+    upper_bounds = list(bucket_boundaries) + [max_length]
+    budget_sizes = [max(1, token_budget // length) for length in upper_bounds]
+    window_size = max(budget_sizes)
+    # the largest divisor of the window size that fits in the budget of every bucket
+    batch_sizes = [max(d for d in range(1, b + 1) if window_size % d == 0) for b in budget_sizes]
+    return batch_sizes, window_size
+
+
+def bucket_num_batches(counts, batch_sizes, window_size):
+    """
+    Number of batches created by group_by_window with the batch size of every bucket, the
+    elements of every bucket are batched in windows of window_size elements and the last window
+    of every bucket can be incomplete
+    :param List[int] counts: number of elements of every bucket
+    :param List[int] batch_sizes: batch size of every bucket
+    :param int window_size: size of the windows
+    :return int: the number of batches
+    """
+    batches = 0
+    for count, batch_size in zip(counts, batch_sizes):
+        full_windows, remaining = divmod(int(count), window_size)
+        batches += full_windows * int(np.ceil(float(window_size) / batch_size))
+        batches += int(np.ceil(float(remaining) / batch_size))
+    return batches
+
+
+def _sentences_kept(num_sentences, ratio):
+    """
+    Selects at random the sentences that are not removed, int(num_sentences * ratio) are removed
+    :param tf.Tensor num_sentences: the number of sentences
+    :param float ratio: ratio of sentences to remove
+    :return tf.Tensor: a bool tensor with num_sentences elements, true for the kept sentences
+    """
+    to_remove = tf.cast(tf.cast(num_sentences, tf.float32) * ratio, tf.int32)
+    removed = tf.random_shuffle(tf.range(num_sentences))[:to_remove]
+    removed_mask = tf.scatter_nd(tf.expand_dims(removed, 1), tf.ones_like(removed),
+                                 tf.expand_dims(num_sentences, 0))
+    return tf.equal(removed_mask, 0)
+
+
+def _remove_sentences(sequence, split_symbol, ratio):
+    """
+    Removes random sentences of the tokens of a document, every sentence is removed with its
+    split symbol
+    :param tf.Tensor sequence: the tokens of the document
+    :param int split_symbol: the id of the symbol that splits the sentences
+    :param float ratio: ratio of sentences to remove
+    :return tf.Tensor: the tokens of the kept sentences
+    """
+    is_word = tf.not_equal(sequence, split_symbol)
+    previous_is_word = tf.concat([[False], is_word], axis=0)[:-1]
+    starts = tf.logical_and(is_word, tf.logical_not(previous_is_word))
+    # the tokens before the first sentence have index 0, they are always kept
+    sentence_index = tf.cumsum(tf.cast(starts, tf.int32))
+    num_sentences = tf.reduce_sum(tf.cast(starts, tf.int32))
+    kept = tf.concat([[True], _sentences_kept(num_sentences, ratio)], axis=0)
+    return tf.boolean_mask(sequence, tf.gather(kept, sentence_index))
+
+
+def _remove_sentences_list(sequence, split_symbol, ratio):
+    """
+    Same as _remove_sentences for a list of tokens
+    """
+    sequence = np.asarray(sequence, dtype=np.int32)
+    is_word = sequence != split_symbol
+    previous_is_word = np.concatenate([[False], is_word])[:-1]
+    starts = np.logical_and(is_word, np.logical_not(previous_is_word))
+    sentence_index = np.cumsum(starts)
+    num_sentences = int(np.sum(starts))
+    kept = np.ones(num_sentences + 1, dtype=np.bool_)
+    kept[1 + np.random.permutation(num_sentences)[:int(num_sentences * ratio)]] = False
+    return list(sequence[kept[sentence_index]])
+
+
+def _pad_tensor(values, length):
+    """Truncates or pads with -1 the first dimension of the tensor up to length"""
+    values = values[:length]
+    padding = tf.fill(_padding_shape(values, length - tf.shape(values)[0]), -1)
+    return tf.concat([values, padding], axis=0)
+
+
+def _pad_tensor_reversed(values, length):
+    """
+    Reverses the first dimension of the tensor and truncates or pads it up to length. The tensor is
+    padded before it is reversed, so the padding goes first.
+    """
+    padding_length = tf.maximum(length - tf.shape(values)[0], 0)
+    padding = tf.fill(_padding_shape(values, padding_length), -1)
+    values = tf.concat([values, padding], axis=0)
+    return tf.reverse(values, axis=[0])[:length]
+
+
 class TextClassificationDataset(TFDataSet):
     """
     Helper class for the dataset. See dataset_filelines.DatasetFilelines for more details.
     """
 
-    def __init__(self, type='train', sentence_split=False):
+    def __init__(self, type='train', sentence_split=False, sort_by_length=False,
+                 native_parsing=TC_NATIVE_PARSING, use_records=True, bucket_boundaries=None,
+                 token_budget=None, random_access=TC_RANDOM_ACCESS, balance_classes=False,
+                 sentence_remove_ratio=0.0):
         """
         :param str type: type of set, either 'train' or 'test'
         :param bool sentence_split: whether to split the doc in sentences or use only words
+        :param bool sort_by_length: whether to read the documents sorted by their length, so the
+        batches have documents of similar length. The position of every read document in the
+        original set is stored in self.order
+        :param bool native_parsing: whether to parse the lines with tensorflow string ops, which
+        run in parallel, or with a python function
+        :param bool use_records: whether to read the binary records of the set instead of the text
+        file when they exist, see records.convert_to_records
+        :param List[int] bucket_boundaries: boundaries of the lengths (in tokens including the
+        padding of the sentences) to group the documents in buckets, every batch has documents of
+        only one bucket. By default the documents are not grouped
+        :param int token_budget: with bucket_boundaries, the maximum number of tokens in a batch.
+        The batch size of every bucket is the token budget divided by its maximum length instead of
+        the batch size of read()
+        :param bool random_access: whether to shuffle the whole text file every epoch reading the
+        documents by their offsets instead of using a shuffle buffer, see TFDataSet
+        :param bool balance_classes: whether to sample the documents of every epoch with the same
+        probability for all the classes when the data is shuffled, instead of reading every
+        document once. It needs the records or random_access
+        :param float sentence_remove_ratio: ratio of sentences removed at random from every
+        document every time it is read, 0 to keep all the sentences
         """
         data_files = os.path.join(DIR_DATA_TEXT_CLASSIFICATION, '{}_set'.format(type))
         if type == 'train' or type == 'val':
@@ -43,27 +210,385 @@ class TextClassificationDataset(TFDataSet):
             raise ValueError(
                     'Type can only be train, val, test or stage2_test but it is {}'.format(type))
         self.type = type
+        self.native_parsing = native_parsing
+        self.bucket_boundaries = bucket_boundaries
+        self.token_budget = token_budget
+        # the records are loaded the first time they are used, see the records property
+        self.records_index = None
+        self._records = None
+        self._records_path = data_files
+        if use_records and records_exist(data_files):
+            self.records_index = load_records_index(data_files)
+        self.order = None
+        if sort_by_length:
+            if self.records_index is not None:
+                self.order = np.argsort(self.records.lengths, kind='mergesort')
+            else:
+                data_files, self.order = self._sort_by_length(data_files)
+        self.balance_classes = balance_classes
+        self.sentence_remove_ratio = sentence_remove_ratio
         self.sentence_split = None
         if sentence_split:
-            dict_filename = 'word2vec_dataset_{}_dict'.format(VOCABULARY_SIZE)
-            dict_filepath = os.path.join(DIR_DATA_WORD2VEC, dict_filename)
-            with tf.gfile.FastGFile(dict_filepath, 'r') as f:
-                for line in f:
-                    data = line.split()
-                    symbol = data[0]
-                    if symbol == '.':
-                        self.sentence_split = int(data[1])
-                        break
+            self.sentence_split = load_sentence_split_symbol()
+            if self.records_index is not None and \
+                    self.records_index['sentence_split'] != self.sentence_split:
+                raise ValueError('The records of {} were created with a different sentence split '
+                                 'symbol'.format(data_files))
+        self.split_symbol = self.sentence_split
+        if sentence_remove_ratio > 0 and self.split_symbol is None:
+            self.split_symbol = load_sentence_split_symbol()
+        if balance_classes and self.records_index is None and not random_access:
+            raise ValueError('The classes can only be balanced with the records or random_access')
+
+        # the shards written by save_shards, only the training set is split in shards and the
+        # sorted copy of the set does not have shards
+        shards_pattern = None
+        if type == 'train' and self.order is None:
+            shards_pattern = '{}-?????-of-{:05d}'.format(data_files, TC_TRAIN_SHARDS)
 
         super(TextClassificationDataset, self).__init__(name=type,
                                                         data_files_pattern=data_files,
                                                         min_queue_examples=100,
-                                                        shuffle_size=10000)
+                                                        shuffle_size=10000,
+                                                        random_access=random_access,
+                                                        random_access_window=RANDOM_ACCESS_WINDOW,
+                                                        shards_pattern=shards_pattern)
         # TODO TF <= 1.2.0 have an issue with padding with more than one dimension
         #                                                 padded_shapes=padded_shape,
         #                                                 padded_values=padded_values)
 
+    @property
+    def records(self):
+        """
+        :return Records: all the records of the set, None if the set is read from the text file
+        """
+        if self._records is None and self.records_index is not None:
+            self._records = Records(self._records_path)
+        return self._records
+
+    def _worker_records(self, task_spec=None):
+        """
+        Selects the records read by a worker. In distributed training every worker loads only a
+        disjoint subset of the shard files of the records when there are enough shards, as
+        TFDataSet._worker_files does with the text files.
+        :param task_spec: the task spec of the training
+        :return (Records, bool): the records and whether they have to be split between the
+        workers
+        """
+        if task_spec is None or task_spec.num_workers <= 1:
+            return self.records, False
+        num_shards = len(self.records_index['shards'])
+        if num_shards >= task_spec.num_workers:
+            return Records(self._records_path, shard_index=task_spec.index,
+                           num_shards=task_spec.num_workers), False
+        logging.warning('{} records shards of {} for {} workers, splitting the records instead'
+                        .format(num_shards, self._records_path, task_spec.num_workers))
+        return self.records, True
+
+    def read(self, batch_size, num_epochs=1, shuffle=False, task_spec=None):
+        """
+        Reads the data from the records of the set if they exist, otherwise from the text file.
+        See TFDataSet.read()
+        """
+        if self.records_index is None:
+            return super(TextClassificationDataset, self).read(batch_size, num_epochs, shuffle,
+                                                               task_spec)
+        # the records stay in the memory of the process, the dataset only has the indexes and a
+        # py_func reads every document from the records (see _map_record)
+        records, shard_records = self._worker_records(task_spec)
+        indexes = np.arange(len(records), dtype=np.int32)
+        if self.order is not None and records is self._records:
+            # sorted by length
+            indexes = np.asarray(self.order, dtype=np.int32)
+        if shard_records:
+            indexes = indexes[task_spec.index::task_spec.num_workers]
+        if shuffle and self.balance_classes:
+            dataset = self._balanced_indexes(num_epochs, indexes, records.classes[indexes])
+        else:
+            dataset = Dataset.from_tensor_slices(indexes)
+            dataset = dataset.repeat(num_epochs)
+            if shuffle:
+                dataset = dataset.shuffle(buffer_size=len(indexes))
+        dataset = dataset.map(lambda index: self._map_record(index, records),
+                              # TODO in TF 1.4 use:
+                              # num_parallel_calls=multiprocessing.cpu_count() + 1,
+                              num_threads=multiprocessing.cpu_count() + 1,
+                              output_buffer_size=batch_size * multiprocessing.cpu_count() +
+                                                 self.min_queue_examples)
+        dataset = self._batch(dataset, batch_size)
+        dataset = prefetch_dataset(dataset, self.prefetch_batches)
+        return dataset.make_one_shot_iterator().get_next()
+
+    def _balanced_indexes(self, num_epochs, indexes, classes):
+        """
+        Creates a dataset with the indexes of the records sampled every epoch with the same
+        probability for all the classes, see balanced_sample
+        :param int num_epochs: the number of epochs
+        :param np.ndarray indexes: the indexes of the records read by this worker
+        :param np.ndarray classes: the classes of the records of indexes
+        :return Dataset: a dataset of int32 indexes
+        """
+
+        def _epochs():
+            random = np.random.RandomState()
+            for _ in range(num_epochs):
+                yield balanced_sample(random, indexes, classes)
+
+        dataset = dataset_from_generator(_epochs, tf.int32, tf.TensorShape([None]))
+        return dataset.flat_map(lambda epoch: Dataset.from_tensor_slices(epoch))
+
+    def _epoch_order(self, random, indexes, classes):
+        if self.balance_classes:
+            return balanced_sample(random, indexes, classes)
+        return super(TextClassificationDataset, self)._epoch_order(random, indexes, classes)
+
+    def _bucket_batch_sizes(self, batch_size):
+        """
+        :param int batch_size: the batch size used without token budget
+        :return (List[int], int): the batch size of every bucket and the window size, see
+        bucket_batch_sizes
+        """
+        if self.sentence_split is not None:
+            max_length = MAX_SENTENCES * MAX_WORDS_IN_SENTENCE
+        else:
+            max_length = MAX_WORDS
+        return bucket_batch_sizes(self.bucket_boundaries, max_length, batch_size,
+                                  self.token_budget)
+
+    def _bucket_lengths(self):
+        """
+        :return np.ndarray: the length of every document used to select its bucket (see _batch).
+        With sentence split the number of sentences comes from the records, without the records
+        it is estimated from the number of tokens
+        """
+        if self.records is not None:
+            lengths = self.records.lengths
+            sentences = np.diff(self.records.sentence_offsets)
+        else:
+            lengths = np.concatenate([load_manifest(f).lengths for f in self._list_files()])
+            sentences = (lengths + MAX_WORDS_IN_SENTENCE - 1) // MAX_WORDS_IN_SENTENCE
+        if self.sentence_split is not None:
+            return np.minimum(sentences, MAX_SENTENCES) * MAX_WORDS_IN_SENTENCE
+        return np.minimum(lengths, MAX_WORDS)
+
+    def _epoch_weights(self):
+        """
+        :return np.ndarray: the number of times every document is read in a shuffled epoch, on
+        average with balance_classes (see balanced_sample)
+        """
+        if self.records is not None:
+            classes = self.records.classes
+        else:
+            classes = np.concatenate([load_manifest(f).classes for f in self._list_files()])
+        if not self.balance_classes:
+            return np.ones(len(classes), dtype=np.float64)
+        _, inverse, counts = np.unique(classes, return_inverse=True, return_counts=True)
+        return float(balanced_samples_per_class(counts)) / counts[inverse]
+
+    def num_batches(self, batch_size, num_epochs=1):
+        """
+        Number of batches read in num_epochs when the dataset is shuffled, with balance_classes
+        every epoch has the documents sampled by balanced_sample. With bucket_boundaries the
+        batches of every bucket have a different size, the number of batches is computed with the
+        histogram of the lengths of the documents and it includes the incomplete batches of the
+        buckets. It is an estimation when the classes are balanced or the sentences are removed,
+        as the documents read are not exactly the ones in the set.
+        :param int batch_size: the batch size used without token budget
+        :param int num_epochs: number of epochs
+        :return int: the number of batches
+        """
+        weights = self._epoch_weights()
+        if self.bucket_boundaries is None:
+            return int(num_epochs * np.sum(weights) / batch_size)
+        batch_sizes, window_size = self._bucket_batch_sizes(batch_size)
+        buckets = np.searchsorted(self.bucket_boundaries, self._bucket_lengths(), side='right')
+        # the epochs are repeated before the batches, the windows go across the epochs
+        counts = num_epochs * np.bincount(buckets, weights=weights, minlength=len(batch_sizes))
+        return bucket_num_batches(np.round(counts), batch_sizes, window_size)
+
+    def _batch(self, dataset, batch_size):
+        if self.bucket_boundaries is None:
+            return super(TextClassificationDataset, self)._batch(dataset, batch_size)
+        batch_sizes, window_size = self._bucket_batch_sizes(batch_size)
+        boundaries = tf.constant(self.bucket_boundaries, dtype=tf.int64)
+        batch_sizes = tf.constant(batch_sizes, dtype=tf.int64)
+
+        def key_func(sequence_begin, *_):
+            mask = tf.greater_equal(sequence_begin, 0)
+            if self.sentence_split is not None:
+                # the sentences are padded to the same length
+                sentences = tf.reduce_sum(tf.cast(tf.reduce_any(mask, axis=1), tf.int64))
+                length = sentences * MAX_WORDS_IN_SENTENCE
+            else:
+                length = tf.reduce_sum(tf.cast(mask, tf.int64))
+            return tf.reduce_sum(tf.cast(tf.greater_equal(length, boundaries), tf.int64))
+
+        def reduce_func(key, window_dataset):
+            return window_dataset.batch(batch_sizes[key])
+
+        # TODO in TF 1.4 use:
+        # dataset.apply(tf.contrib.data.group_by_window(key_func, reduce_func, window_size))
+        return dataset.group_by_window(key_func, reduce_func, window_size)
+
+    def _read_record(self, records, index):
+        """
+        Reads a document from the records
+        :param Records records: the records
+        :param int index: index of the document in the records
+        :return (np.ndarray, ...): the tokens, variant, gene, class, sentence starts and sentence
+        ends of the document, all of them int32
+        """
+        sentences = slice(records.sentence_offsets[index], records.sentence_offsets[index + 1])
+        return (records.doc_tokens(index),
+                records.doc_variant(index),
+                np.asarray([records.genes[index]], dtype=np.int32),
+                np.asarray([records.classes[index]], dtype=np.int32),
+                records.sentence_starts[sentences].astype(np.int32),
+                records.sentence_ends[sentences].astype(np.int32))
+
+    def _map_record(self, index, records):
+        """
+        Creates the same outputs as _map_native from the records of a document. The records are
+        not embedded in the graph, a py_func reads the document from the records in memory.
+        """
+        variant_padding = 20
+
+        sequence, variant, gene, result_class, starts, ends = \
+            tf.py_func(lambda i: self._read_record(records, i), [index], [tf.int32] * 6,
+                       stateful=False)
+        sequence.set_shape([None])
+        variant.set_shape([None])
+        starts.set_shape([None])
+        ends.set_shape([None])
+        variant = tf.reshape(_pad_tensor(variant, variant_padding), [variant_padding])
+        gene = tf.reshape(gene, [1])
+        if self.sentence_split is not None:
+            # sentences from the precomputed boundaries
+            if self.sentence_remove_ratio > 0:
+                kept = _sentences_kept(tf.shape(starts)[0], self.sentence_remove_ratio)
+                starts = tf.boolean_mask(starts, kept)
+                ends = tf.boolean_mask(ends, kept)
+            lengths = tf.minimum(ends - starts, MAX_WORDS_IN_SENTENCE)
+            positions = tf.expand_dims(starts, 1) + tf.range(MAX_WORDS_IN_SENTENCE)
+            mask = tf.sequence_mask(lengths, MAX_WORDS_IN_SENTENCE)
+            words = tf.gather(sequence, tf.where(mask, positions, tf.zeros_like(positions)))
+            sentences = tf.where(mask, words, -tf.ones_like(words))
+            shape = [MAX_SENTENCES, MAX_WORDS_IN_SENTENCE]
+            sequence_begin = tf.reshape(_pad_tensor(sentences, MAX_SENTENCES), shape)
+            sequence_end = tf.reshape(_pad_tensor_reversed(sentences, MAX_SENTENCES), shape)
+        else:
+            if self.sentence_remove_ratio > 0:
+                sequence = _remove_sentences(sequence, self.split_symbol,
+                                             self.sentence_remove_ratio)
+            sequence_begin = tf.reshape(_pad_tensor(sequence, MAX_WORDS), [MAX_WORDS])
+            sequence_end = tf.reshape(_pad_tensor_reversed(sequence, MAX_WORDS), [MAX_WORDS])
+
+        if self.type == 'train' or self.type == 'val':
+            result_class = tf.reshape(result_class, [1])
+            return sequence_begin, sequence_end, gene, variant, result_class
+        else:
+            return sequence_begin, sequence_end, gene, variant
+
+    def get_size(self):
+        if self.records_index is not None:
+            return self.records_index['num_records']
+        return super(TextClassificationDataset, self).get_size()
+
+    def _sort_by_length(self, data_files):
+        """
+        Writes a copy of the data file with the documents sorted by their number of words next to
+        the data file, with the order of the documents. The copy is reused while it is newer than
+        the data file.
+        :param str data_files: the data file
+        :return (str, np.ndarray): the path of the sorted file and the position in the original file
+        of every document in the sorted file
+        """
+        sorted_filepath = '{}.sorted'.format(data_files)
+        order_filepath = '{}.order.npy'.format(sorted_filepath)
+        if tf.gfile.Exists(sorted_filepath) and tf.gfile.Exists(order_filepath) and \
+                tf.gfile.Stat(sorted_filepath).mtime_nsec >= tf.gfile.Stat(data_files).mtime_nsec:
+            with tf.gfile.Open(order_filepath, 'rb') as f:
+                return sorted_filepath, np.load(f)
+        with tf.gfile.FastGFile(data_files, 'r') as f:
+            lines = [line for line in f if line.strip()]
+        lengths = [len(line.split('||')[3].split()) for line in lines]
+        order = np.argsort(lengths, kind='mergesort')
+        with tf.gfile.Open(order_filepath, 'wb') as f:
+            np.save(f, order)
+        # the sorted file is written the last, it is not reused if the process dies before
+        tmp_filepath = '{}.tmp'.format(sorted_filepath)
+        with tf.gfile.Open(tmp_filepath, 'w') as f:
+            for index in order:
+                line = lines[index]
+                f.write(line if line.endswith('\n') else line + '\n')
+        tf.gfile.Rename(tmp_filepath, sorted_filepath, overwrite=True)
+        return sorted_filepath, order
+
     def _map(self, example_serialized):
+        if self.native_parsing:
+            return self._map_native(example_serialized)
+        return self._map_py_func(example_serialized)
+
+    def _map_native(self, example_serialized):
+        """
+        Parses the line with tensorflow ops only. The outputs are the same as the ones of
+        _map_py_func.
+        """
+        variant_padding = 20
+
+        def _ids(text):
+            words = tf.string_split([text], delimiter=' ').values
+            return tf.string_to_number(words, out_type=tf.int32)
+
+        def _sentences(sequence):
+            # a sentence starts in a word which is the first one or it is after a split symbol
+            is_word = tf.not_equal(sequence, self.sentence_split)
+            previous_is_word = tf.concat([[False], is_word], axis=0)[:-1]
+            starts = tf.logical_and(is_word, tf.logical_not(previous_is_word))
+            sentence_index = tf.cumsum(tf.cast(starts, tf.int32))
+            starts_positions = tf.cast(tf.where(starts)[:, 0], tf.int32)
+            starts_positions = tf.concat([[0], starts_positions], axis=0)
+            word_index = tf.range(tf.shape(sequence)[0]) - tf.gather(starts_positions,
+                                                                     sentence_index)
+            keep = tf.logical_and(is_word, word_index < MAX_WORDS_IN_SENTENCE)
+            indices = tf.stack([tf.boolean_mask(sentence_index - 1, keep),
+                                tf.boolean_mask(word_index, keep)], axis=1)
+            # scatter_nd fills with zeros, the ids are shifted by 1 to pad with -1
+            values = tf.boolean_mask(sequence, keep) + 1
+            shape = tf.stack([tf.shape(starts_positions)[0] - 1, MAX_WORDS_IN_SENTENCE])
+            return tf.scatter_nd(indices, values, shape) - 1
+
+        # the empty fields are kept, so an empty class or variant does not shift the next fields.
+        # The separator is '||', the fields are the even elements of the split by '|'
+        fields = tf.string_split([example_serialized], delimiter='|', skip_empty=False).values
+        check_fields = tf.Assert(tf.equal(tf.size(fields), 7),
+                                 ['Line without 4 fields separated by ||:', example_serialized])
+        with tf.control_dependencies([check_fields]):
+            fields = tf.identity(fields)[::2]
+        gene = tf.reshape(_ids(fields[1]), [1])
+        variant = tf.reshape(_pad_tensor(_ids(fields[2]), variant_padding), [variant_padding])
+        sequence = _ids(fields[3])
+        if self.sentence_remove_ratio > 0:
+            sequence = _remove_sentences(sequence, self.split_symbol, self.sentence_remove_ratio)
+        if self.sentence_split is not None:
+            sentences = _sentences(sequence)
+            shape = [MAX_SENTENCES, MAX_WORDS_IN_SENTENCE]
+            sequence_begin = tf.reshape(_pad_tensor(sentences, MAX_SENTENCES), shape)
+            sequence_end = tf.reshape(_pad_tensor_reversed(sentences, MAX_SENTENCES), shape)
+        else:
+            sequence_begin = tf.reshape(_pad_tensor(sequence, MAX_WORDS), [MAX_WORDS])
+            sequence_end = tf.reshape(_pad_tensor_reversed(sequence, MAX_WORDS), [MAX_WORDS])
+
+        if self.type == 'train' or self.type == 'val':
+            # first class is 1, last one is 9
+            result_class = tf.reshape(_ids(fields[0]) - 1, [1])
+            return sequence_begin, sequence_end, gene, variant, result_class
+        elif self.type == 'test' or self.type == 'stage2_test':
+            return sequence_begin, sequence_end, gene, variant
+        else:
+            raise ValueError()
+
+    def _map_py_func(self, example_serialized):
         variant_padding = 20
         sentence_padding = [-1] * MAX_WORDS_IN_SENTENCE
 
@@ -73,6 +598,9 @@ class TextClassificationDataset(TFDataSet):
             example_gene = np.int32(example_serialized[1].strip())
             example_variant = list([np.int32(w) for w in example_serialized[2].strip().split()])
             sequence = list([np.int32(w) for w in example_serialized[3].strip().split()])
+            if self.sentence_remove_ratio > 0:
+                sequence = _remove_sentences_list(sequence, self.split_symbol,
+                                                  self.sentence_remove_ratio)
 
             example_variant = _padding(example_variant, variant_padding)
 
@@ -1,16 +1,15 @@
 import tensorflow as tf
 import tensorflow.contrib.layers as layers
 from ..configuration import *
+from ..embeddings import embeddings_variable
 from .text_classification_model_simple import ModelSimple
 from .text_classification_train import main
 
 
 class ModelHAN(ModelSimple):
     def _create_embeddings(self, embeddings):
-        embeddings_dimension = len(embeddings[0])
-        embeddings = [[0.0] * embeddings_dimension] + embeddings
-        embeddings = tf.constant(embeddings, name='embeddings', dtype=tf.float32)
-        return embeddings
+        # first vector is a zeros vector used for padding
+        return embeddings_variable(embeddings, name='embeddings', zeros_row=True)
 
     def _embed_sequence_with_length(self, embeddings, input_text):
         # calculate max length of the input_text
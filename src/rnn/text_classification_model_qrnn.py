@@ -1,113 +1,99 @@
+import sys
+import time
+import numpy as np
 import tensorflow as tf
-from tensorflow.contrib.layers.python.layers import layers
 from ..configuration import *
 from .text_classification_model_simple import ModelSimple
 from .text_classification_train import main
 
 # QRNN from https://github.com/icoxfog417/tensorflow_qrnn MIT license
 
-class QRNN():
 
-    def __init__(self, in_size, size, conv_size=2):
-        self.kernel = None
-        self.batch_size = -1
-        self.conv_size = conv_size
-        self.c = None
-        self.h = None
-        self._x = None
-        if conv_size == 1:
-            self.kernel = QRNNLinear(in_size, size)
-        elif conv_size == 2:
-            self.kernel = QRNNWithPrevious(in_size, size)
-        else:
-            self.kernel = QRNNConvolution(in_size, size, conv_size)
-
-    def _step(self, f, z, o):
-        with tf.variable_scope("fo-Pool"):
-            # f,z,o is batch_size x size
-            f = tf.sigmoid(f)
-            z = tf.tanh(z)
-            o = tf.sigmoid(o)
-            self.c = tf.multiply(f, self.c) + tf.multiply(1 - f, z)
-            self.h = tf.multiply(o, self.c)  # h is size vector
-
-        return self.h
-
-    def forward(self, x):
-        length = lambda mx: int(mx.get_shape()[0])
-
-        with tf.variable_scope("QRNN/Forward"):
-            if self.c is None:
-                # init context cell
-                self.c = tf.zeros([length(x), self.kernel.size], dtype=tf.float32)
-
-            if self.conv_size <= 2:
-                # x is batch_size x sentence_length x word_length
-                # -> now, transpose it to sentence_length x batch_size x word_length
-                _x = tf.transpose(x, [1, 0, 2])
-
-                for i in range(length(_x)):
-                    t = _x[i] # t is batch_size x word_length matrix
-                    f, z, o = self.kernel.forward(t)
-                    self._step(f, z, o)
-            else:
-                c_f, c_z, c_o = self.kernel.conv(x)
-                for i in range(length(c_f)):
-                    f, z, o = c_f[i], c_z[i], c_o[i]
-                    self._step(f, z, o)
-
-        return self.h
-
-
-class QRNNLinear():
-
-    def __init__(self, in_size, size):
-        self.in_size = in_size
-        self.size = size
-        self._weight_size = self.size * 3  # z, f, o
-        with tf.variable_scope("QRNN/Variable/Linear"):
-            initializer = tf.random_normal_initializer()
-            self.W = tf.get_variable("W", [self.in_size, self._weight_size], initializer=initializer)
-            self.b = tf.get_variable("b", [self._weight_size], initializer=initializer)
-
-    def forward(self, t):
-        # x is batch_size x word_length matrix
-        _weighted = tf.matmul(t, self.W)
-        _weighted = tf.add(_weighted, self.b)
-
-        # now, _weighted is batch_size x weight_size
-        f, z, o = tf.split(1, 3, _weighted)  # split to f, z, o. each matrix is batch_size x size
-        return f, z, o
-
-
-class QRNNWithPrevious():
+def fo_pooling(f, z, o, sequence_length=None):
+    """
+    fo-pooling of the QRNN over the whole sequence with a single tf.scan. The gates are computed
+    for all the timesteps before the scan, the scan only runs the recurrence of the cell:
+    c_t = f_t * c_t-1 + (1 - f_t) * z_t. The cell is not updated after the end of every
+    sequence.
+    :param tf.Tensor f: forget gate (before the sigmoid) [batch_size, length, size]
+    :param tf.Tensor z: candidate (before the tanh) [batch_size, length, size]
+    :param tf.Tensor o: output gate (before the sigmoid) [batch_size, length, size]
+    :param tf.Tensor sequence_length: length of every sequence [batch_size], None if all the
+    sequences use the whole length
+    :return tf.Tensor: the hidden states h_t = o_t * c_t [batch_size, length, size]
+    """
+    with tf.variable_scope('fo-Pool'):
+        f = tf.sigmoid(f)
+        z = tf.tanh(z)
+        o = tf.sigmoid(o)
+        if sequence_length is not None:
+            # f = 1 keeps the cell in the padding
+            mask = tf.sequence_mask(sequence_length, tf.shape(f)[1], dtype=tf.float32)
+            mask = tf.expand_dims(mask, 2)
+            f = f * mask + (1.0 - mask)
+        # the scan runs over the first dimension, the time
+        f_t = tf.transpose(f, [1, 0, 2])
+        z_t = tf.transpose((1.0 - f) * z, [1, 0, 2])
+        c_0 = tf.zeros_like(f_t[0])
+        c = tf.scan(lambda c, fz: fz[0] * c + fz[1], (f_t, z_t), initializer=c_0)
+        return o * tf.transpose(c, [1, 0, 2])
+
+
+def fo_pooling_unrolled(f, z, o, sequence_length=None):
+    """
+    Same as fo_pooling but with a python loop over the timesteps, as the QRNN was implemented
+    before. The length of the sequences must be known when the graph is built. It is only used to
+    compare the performance.
+    """
+    with tf.variable_scope('fo-Pool'):
+        f = tf.sigmoid(f)
+        z = tf.tanh(z)
+        o = tf.sigmoid(o)
+        if sequence_length is not None:
+            mask = tf.sequence_mask(sequence_length, tf.shape(f)[1], dtype=tf.float32)
+            mask = tf.expand_dims(mask, 2)
+            f = f * mask + (1.0 - mask)
+        c = tf.zeros_like(f[:, 0])
+        outputs = []
+        for i in range(int(f.get_shape()[1])):
+            c = tf.multiply(f[:, i], c) + tf.multiply(1 - f[:, i], z[:, i])
+            outputs.append(tf.multiply(o[:, i], c))
+        return tf.stack(outputs, axis=1)
+
+
+class QRNN(object):
+    """
+    A layer of QRNN: a convolution over the sequence computes the gates of all the timesteps at
+    the same time and the fo-pooling runs the recurrence.
+    """
 
-    def __init__(self, in_size, size):
+    def __init__(self, in_size, size, conv_size=2, unrolled=False):
+        """
+        :param int in_size: size of the inputs
+        :param int size: size of the hidden state
+        :param int conv_size: width of the convolution, 1 for a linear layer
+        :param bool unrolled: whether to use fo_pooling_unrolled, only to compare the performance
+        """
         self.in_size = in_size
         self.size = size
-        self._weight_size = self.size * 3  # z, f, o
-        self._previous = None
-        with tf.variable_scope("QRNN/Variable/WithPrevious"):
-            initializer = tf.random_normal_initializer()
-            self.W = tf.get_variable("W", [self.in_size, self._weight_size], initializer=initializer)
-            self.V = tf.get_variable("V", [self.in_size, self._weight_size], initializer=initializer)
-            self.b = tf.get_variable("b", [self._weight_size], initializer=initializer)
-
-    def forward(self, t):
-        if self._previous is None:
-            self._previous = tf.get_variable("previous", [t.get_shape()[0], self.in_size], initializer=tf.random_normal_initializer())
-
-        _current = tf.matmul(t, self.W)
-        _previous = tf.matmul(self._previous, self.V)
-        _previous = tf.add(_previous, self.b)
-        _weighted = tf.add(_current, _previous)
+        self.conv_size = conv_size
+        self.unrolled = unrolled
+        self.kernel = QRNNConvolution(in_size, size, conv_size)
 
-        f, z, o = tf.split(1, 3, _weighted)  # split to f, z, o. each matrix is batch_size x size
-        self._previous = t
-        return f, z, o
+    def forward(self, x, sequence_length=None):
+        """
+        :param tf.Tensor x: the inputs [batch_size, length, in_size]
+        :param tf.Tensor sequence_length: the length of every sequence [batch_size]
+        :return tf.Tensor: the hidden states [batch_size, length, size]
+        """
+        with tf.variable_scope('QRNN/Forward'):
+            f, z, o = self.kernel.conv(x)
+            if self.unrolled:
+                return fo_pooling_unrolled(f, z, o, sequence_length)
+            return fo_pooling(f, z, o, sequence_length)
 
 
-class QRNNConvolution():
+class QRNNConvolution(object):
 
     def __init__(self, in_size, size, conv_size):
         self.in_size = in_size
@@ -115,36 +101,90 @@ class QRNNConvolution():
         self.conv_size = conv_size
         self._weight_size = self.size * 3  # z, f, o
 
-        with tf.variable_scope("QRNN/Variable/Convolution"):
+        with tf.variable_scope('QRNN/Variable/Convolution'):
             initializer = tf.random_normal_initializer()
-            self.conv_filter = tf.get_variable("conv_filter", [conv_size, in_size, self._weight_size], initializer=initializer)
+            self.conv_filter = tf.get_variable('conv_filter',
+                                               [conv_size, in_size, self._weight_size],
+                                               initializer=initializer)
 
     def conv(self, x):
-        # !! x is batch_size x sentence_length x word_length(=channel) !!
-        _weighted = tf.nn.conv1d(x, self.conv_filter, stride=1, padding="SAME", data_format="NHWC")
-
-        # _weighted is batch_size x conved_size x output_channel
-        _w = tf.transpose(_weighted, [1, 0, 2])  # conved_size x  batch_size x output_channel
-        _ws = tf.split(_w, 3, axis=2) # make 3(f, z, o) conved_size x  batch_size x size
+        # x is batch_size x sentence_length x word_length(=channel)
+        _weighted = tf.nn.conv1d(x, self.conv_filter, stride=1, padding='SAME',
+                                 data_format='NHWC')
+        # _weighted is batch_size x sentence_length x output_channel
+        return tf.split(_weighted, 3, axis=2)  # f, z, o: batch_size x sentence_length x size
 
-        return _ws
 
 class ModelQRNN(ModelSimple):
     """
-    A QRNN model
+    A QRNN model. The layers only have the convolution filter (QRNN/Variable/Convolution), the
+    checkpoints of the previous version with the linear and the previous state kernels of the
+    gates can not be restored and the model has to be trained again.
     """
 
     def rnn(self, sequence, sequence_length, max_length, dropout, batch_size, training,
-            cnn_layers=TC_QRNN_CNN_LAYERS, cnn_filters=TC_QRNN_CNN_FILTERS):
-
-        sequence = tf.reshape(sequence, [batch_size, MAX_WORDS, EMBEDDINGS_SIZE])
-        cnn = sequence
-        qrnn = QRNN(in_size=EMBEDDINGS_SIZE, size=MAX_WORDS, conv_size=5)
-        for _ in range(cnn_layers):
-            cnn = qrnn.forward(cnn)
-
-        return cnn
+            cnn_layers=TC_QRNN_CNN_LAYERS, cnn_filters=TC_QRNN_CNN_FILTERS, conv_size=5):
+        output = sequence
+        in_size = EMBEDDINGS_SIZE
+        for layer in range(cnn_layers):
+            with tf.variable_scope('layer_{}'.format(layer)):
+                qrnn = QRNN(in_size=in_size, size=cnn_filters, conv_size=conv_size)
+                output = qrnn.forward(output, sequence_length)
+            in_size = cnn_filters
+
+        # get the last output of every sequence, the first one of the empty sequences so the index
+        # does not fall in the previous sequence
+        output = tf.reshape(output, [batch_size * max_length, cnn_filters])
+        last = tf.maximum(sequence_length - 1, 0)
+        indexes = tf.range(batch_size) * max_length + last
+        return tf.gather(output, indexes)
+
+
+def benchmark(batch_size=TC_BATCH_SIZE, length=MAX_WORDS, cnn_layers=TC_QRNN_CNN_LAYERS,
+              cnn_filters=TC_QRNN_CNN_FILTERS, conv_size=5, steps=10):
+    """
+    Compares the time to build the graph and to run a training step of the QRNN layers with
+    fo_pooling and with fo_pooling_unrolled
+    :param int batch_size: batch size
+    :param int length: length of the sequences
+    :param int cnn_layers: number of QRNN layers
+    :param int cnn_filters: size of the hidden state
+    :param int conv_size: width of the convolutions
+    :param int steps: number of training steps measured
+    """
+    random = np.random.RandomState(0)
+    sequence = random.rand(batch_size, length, EMBEDDINGS_SIZE).astype(np.float32)
+    sequence_length = random.randint(length // 2, length + 1, batch_size).astype(np.int32)
+    for unrolled in [False, True]:
+        with tf.Graph().as_default():
+            start = time.time()
+            inputs = tf.constant(sequence)
+            lengths = tf.constant(sequence_length)
+            output = inputs
+            in_size = EMBEDDINGS_SIZE
+            for layer in range(cnn_layers):
+                with tf.variable_scope('layer_{}'.format(layer)):
+                    qrnn = QRNN(in_size=in_size, size=cnn_filters, conv_size=conv_size,
+                                unrolled=unrolled)
+                    output = qrnn.forward(output, lengths)
+                in_size = cnn_filters
+            loss = tf.reduce_mean(output)
+            optimizer = tf.train.GradientDescentOptimizer(0.01).minimize(loss)
+            build_time = time.time() - start
+            num_nodes = len(tf.get_default_graph().as_graph_def().node)
+            with tf.Session() as session:
+                session.run(tf.global_variables_initializer())
+                session.run(optimizer)  # warm up
+                start = time.time()
+                for _ in range(steps):
+                    session.run(optimizer)
+                step_time = (time.time() - start) / steps
+        print('{}: graph nodes: {}  build seconds: {:0.2f}  seconds per step: {:0.4f}'.format(
+                'unrolled' if unrolled else 'scan', num_nodes, build_time, step_time))
 
 
 if __name__ == '__main__':
-    main(ModelQRNN(), 'qrnn', sentence_split=True, batch_size=TC_BATCH_SIZE)
+    if len(sys.argv) > 1 and sys.argv[1] == 'benchmark':
+        benchmark()
+    else:
+        main(ModelQRNN(), 'qrnn', batch_size=TC_BATCH_SIZE)
@@ -2,6 +2,7 @@ import tensorflow as tf
 from tensorflow.contrib import slim
 import tensorflow.contrib.layers as layers
 from ..configuration import *
+from ..embeddings import embeddings_variable
 from .text_classification_train import main
 
 
@@ -120,9 +121,7 @@ class ModelSimple(object):
         # create the embeddings
 
         # first vector is a zeros vector used for padding
-        embeddings_dimension = len(embeddings[0])
-        embeddings = [[0.0] * embeddings_dimension] + embeddings
-        embeddings = tf.constant(embeddings, name='embeddings', dtype=tf.float32)
+        embeddings = embeddings_variable(embeddings, name='embeddings', zeros_row=True)
         # this means we need to add 1 to the input_text
         input_text_begin = tf.add(input_text_begin, 1)
         if input_text_end is not None:
@@ -161,15 +160,20 @@ class ModelSimple(object):
         targets = tf.squeeze(targets, axis=1)
         return targets
 
-    def loss(self, targets, graph_data):
+    def loss(self, targets, graph_data, class_weights=None):
         """
         Calculates the softmax cross entropy loss
         :param tf.Tensor logits: logits output of the model
         :param tf.Tensor targets: targets with the one hot encoding labels
+        :param List[float] class_weights: weight of the loss of every class, None to weight all
+        the examples the same
         :return tf.Tensor : a tensor with the loss value
         """
         logits = graph_data['logits']
         loss = tf.nn.softmax_cross_entropy_with_logits(labels=targets, logits=logits)
+        if class_weights is not None:
+            weights = tf.constant(class_weights, dtype=tf.float32)
+            loss *= tf.reduce_sum(tf.cast(targets, tf.float32) * weights, axis=1)
         return tf.reduce_mean(loss)
 
     def optimize(self, loss, global_step,
@@ -1,8 +1,9 @@
 import numpy as np
 import io
-import random
+import glob
 from ..preprocess_data import load_csv_dataset
 from ..configuration import *
+from ..manifest import create_manifest, manifest_path
 
 
 def load_word2vec_dict(filename, vocabulary_size=VOCABULARY_SIZE):
@@ -63,56 +64,15 @@ def transform_words_in_ids(dataset, symbols_dict):
             datasample.gene = symbols_dict[datasample.gene.lower()]
 
 
-def balance_class(dataset):
-    """
-    Balance the classes to a target value of number of elements per class. This method only
-    replicates the samples in the class until if matchs the final_num
-    :param List[DataSample] dataset: dataset of DataSample
-    :param final_num: target number of elements per class
-    :return List[DataSample]: the new dataset with the repeated samples. It is also shuffled
-    """
-    classes_group = {}
-    for d in dataset:
-        if d.real_class not in classes_group:
-            classes_group[d.real_class] = []
-        classes_group[d.real_class].append(d)
-    classes_string = ", ".join(
-            ["{}:{}".format(k, len(classes_group[k])) for k in sorted(classes_group.keys())])
-    print("{} different classes: {}".format(len(classes_group), classes_string))
-    max_in_class = np.max([len(v) for v in classes_group.values()]) * 2
-    new_dataset = []
-    for key, class_list in classes_group.iteritems():
-        random.shuffle(class_list)
-        for index in range(max_in_class - len(class_list)):
-            class_list.append(class_list[index].__copy__())
-        new_dataset.extend(class_list)
-
-    random.shuffle(new_dataset)
-    return new_dataset
-
-
-def remove_random_sentences(dataset, ratio_to_remove=TD_DATA_SENTENCE_REMOVE_PERCENTAGE):
-    """
-    Removes random sentences of the text in the dataset. This method along with balance_class are a
-    way to augmentate the dataset.
-    :param List[DataSample] dataset: dataset of DataSample
-    :param float ratio_to_remove: ratio of sentences to be removed from each sample in the dataset
-    :return List[DataSample]: the dataset with the removed sentences
-    """
-    for sample in dataset:
-        to_remove = int(len(sample.text) * ratio_to_remove)
-        text = sample.text
-        for _ in range(to_remove):
-            text.pop(random.randint(0, len(text) - 1))
-    return dataset
-
-
-def save_text_classification_dataset(filename, dataset, dir=DIR_DATA_TEXT_CLASSIFICATION):
+def save_text_classification_dataset(filename, dataset, dir=DIR_DATA_TEXT_CLASSIFICATION,
+                                     num_shards=1):
     """
     Saves the dataset. The sentences are stored in one single line, so they can processed better
     when they are read for training or test
     :param str filename: filename where to store the dataset
     :param List[DataSample] dataset: the dataset of DataSample
+    :param int num_shards: if greater than 1 the dataset is also split in num_shards files, see
+    save_shards
     """
     with open(os.path.join(dir, filename), 'wb') as file:
         for data in dataset:
@@ -123,6 +83,49 @@ def save_text_classification_dataset(filename, dataset, dir=DIR_DATA_TEXT_CLASSI
                 for word in sentence:
                     file.write('{} '.format(word))
             file.write('\n')
+    create_manifest(os.path.join(dir, filename))
+    if num_shards > 1:
+        save_shards(os.path.join(dir, filename), num_shards)
+    else:
+        # the shards of a previous version of the dataset are not valid anymore
+        remove_shards(os.path.join(dir, filename))
+
+
+def save_shards(filepath, num_shards):
+    """
+    Splits a dataset file in num_shards files named {filepath}-0000i-of-0000N, the lines are
+    assigned to the shards in round-robin so all the shards have a similar size and distribution
+    of classes. In distributed training every worker reads only some of the shards. The shards
+    of a previous split with a different number of shards are deleted.
+    :param str filepath: path of the dataset file
+    :param int num_shards: number of shards
+    """
+    shard_paths = ['{}-{:05d}-of-{:05d}'.format(filepath, shard, num_shards)
+                   for shard in range(num_shards)]
+    remove_shards(filepath, keep=shard_paths)
+    shard_files = [open(path, 'wb') for path in shard_paths]
+    try:
+        with open(filepath, 'rb') as file:
+            for i, line in enumerate(line for line in file if line.strip()):
+                shard_files[i % num_shards].write(line)
+    finally:
+        for shard_file in shard_files:
+            shard_file.close()
+    for path in shard_paths:
+        create_manifest(path)
+
+
+def remove_shards(filepath, keep=()):
+    """
+    Deletes the shards of a dataset file written by save_shards and their manifests
+    :param str filepath: path of the dataset file
+    :param List[str] keep: paths of the shards that are not deleted
+    """
+    for path in glob.glob('{}-?????-of-?????'.format(filepath)):
+        if path not in keep:
+            os.remove(path)
+            if os.path.exists(manifest_path(path)):
+                os.remove(manifest_path(path))
 
 
 def data_stats(train_set, test_set):
@@ -182,11 +185,8 @@ if __name__ == '__main__':
     transform_words_in_ids(test_set, word_dict)
     print('Calculating statistics...')
     data_stats(train_set, test_set)
-    print('Balancing classes...')
-    train_set = balance_class(train_set)
-    print('Removing random sentences...')
-    train_set = remove_random_sentences(train_set)
+    # the classes are balanced and the sentences removed when the training set is read
     print('Saving final training dataset...')
-    save_text_classification_dataset('train_set', train_set)
+    save_text_classification_dataset('train_set', train_set, num_shards=TC_TRAIN_SHARDS)
     print('Generating samples for test set...')
     save_text_classification_dataset('test_set', test_set)
@@ -1,5 +1,4 @@
 import tensorflow as tf
-import csv
 import time
 from datetime import timedelta
 import sys
@@ -10,18 +9,58 @@ from tensorflow.python.ops import variables as tf_variables
 from ..configuration import *
 from .. import trainer, evaluator, metrics
 from ..task_spec import get_task_spec
+from ..embeddings import load_embeddings
+from ..manifest import load_manifest
 from .text_classification_dataset import TextClassificationDataset
 
 
 def _load_embeddings(vocabulary_size, embeddings_size,
                      filename_prefix='embeddings', from_dir=DIR_DATA_WORD2VEC):
-    embeddings = []
     embeddings_file = '{}_{}_{}'.format(filename_prefix, vocabulary_size, embeddings_size)
-    with open(os.path.join(from_dir, embeddings_file), 'r') as file:
-        reader = csv.reader(file, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
-        for row in reader:
-            embeddings.append([float(r) for r in row])
-    return embeddings
+    return load_embeddings(os.path.join(from_dir, embeddings_file))
+
+
+def _padding_stats(input_text):
+    """
+    Counts the tokens of a batch and the tokens processed by the model, which are the tokens of
+    the batch after removing the padding common to all the documents
+    :param tf.Tensor input_text: the batch of documents, padded with -1. It can be of words
+    [batch_size, words] or sentences [batch_size, sentences, words]
+    :return (tf.Tensor, tf.Tensor): the number of tokens and the number of processed tokens
+    """
+    mask = tf.greater_equal(input_text, 0)
+    tokens = tf.reduce_sum(tf.cast(mask, tf.int64))
+    batch_size = tf.cast(tf.shape(input_text)[0], tf.int64)
+    if input_text.get_shape().ndims == 3:
+        batch_size *= tf.cast(tf.shape(input_text)[2], tf.int64)
+        mask = tf.reduce_any(mask, axis=2)
+    lengths = tf.reduce_sum(tf.cast(mask, tf.int64), axis=1)
+    return tokens, batch_size * tf.reduce_max(lengths)
+
+
+def _cpu_time():
+    """
+    :return float: user and system seconds of cpu used by this process
+    """
+    times = os.times()
+    return times[0] + times[1]
+
+
+def class_weights(manifest, output_classes=9):
+    """
+    Computes weights for the loss of every class inversely proportional to the number of examples
+    of the class, so all the classes contribute the same to the loss. The mean weight of the
+    examples is 1.
+    :param Manifest manifest: the manifest of the training set
+    :param int output_classes: number of classes
+    :return List[float]: the weight of every class
+    """
+    # first class is 1, last one is 9
+    counts = np.zeros(output_classes, dtype=np.float64)
+    histogram = manifest.class_histogram[1:output_classes + 1]
+    counts[:len(histogram)] = histogram
+    weights = np.sum(counts) / (output_classes * np.maximum(counts, 1))
+    return list(weights)
 
 
 class TextClassificationTrainer(trainer.Trainer):
@@ -31,9 +70,10 @@ class TextClassificationTrainer(trainer.Trainer):
     """
 
     def __init__(self, dataset, text_classification_model, log_dir=DIR_TC_LOGDIR,
-                 use_end_sequence=False, task_spec=None, max_steps=None):
+                 use_end_sequence=False, task_spec=None, max_steps=None, class_weights=None):
         self.text_classification_model = text_classification_model
         self.use_end_sequence = use_end_sequence
+        self.class_weights = class_weights
         config = tf.ConfigProto()
         config.gpu_options.allow_growth = True
         super(TextClassificationTrainer, self).__init__(log_dir=log_dir, dataset=dataset,
@@ -57,7 +97,8 @@ class TextClassificationTrainer(trainer.Trainer):
 
         # loss
         targets = self.text_classification_model.targets(expected_labels, output_classes)
-        self.loss = self.text_classification_model.loss(targets, outputs)
+        self.loss = self.text_classification_model.loss(targets, outputs,
+                                                        class_weights=self.class_weights)
         tf.summary.scalar('loss', self.loss)
 
         # learning rate
@@ -68,6 +109,7 @@ class TextClassificationTrainer(trainer.Trainer):
 
         # metrics
         self.metrics = metrics.single_label(outputs['prediction'], targets)
+        self.tokens, self.padded_tokens = _padding_stats(input_text_begin)
 
         # saver to save the model
         self.saver = tf.train.Saver()
@@ -80,23 +122,39 @@ class TextClassificationTrainer(trainer.Trainer):
         input_text_begin, input_text_end, gene, variation, expected_labels = dataset_tensor
         if not self.use_end_sequence:
             input_text_end = None
+        # the batches can have different sizes when the dataset groups the documents in buckets
+        batch_size = tf.shape(input_text_begin)[0]
         return self.model(input_text_begin, input_text_end, gene, variation, expected_labels, batch_size)
 
     def step(self, session, graph_data):
-        lr, _, loss, step, metrics = \
+        lr, _, loss, step, metrics, tokens, padded_tokens = \
             session.run([self.learning_rate, self.optimizer, self.loss, self.global_step,
-                         self.metrics])
-        if self.is_chief and time.time() > self.print_timestamp + 5 * 60:
+                         self.metrics, self.tokens, self.padded_tokens])
+        if not self.is_chief:
+            return
+        self.period_tokens += tokens
+        self.period_padded_tokens += padded_tokens
+        if time.time() > self.print_timestamp + 5 * 60:
+            period_time = time.time() - self.print_timestamp
             self.print_timestamp = time.time()
             elapsed_time = str(timedelta(seconds=time.time() - self.init_time))
+            padding = 1.0 - float(self.period_tokens) / max(self.period_padded_tokens, 1)
+            cpu_hours = (_cpu_time() - self.init_cpu_time) / 3600.0
             m = 'step: {}  loss: {:0.4f}  learning_rate = {:0.6f}  elapsed seconds: {}  ' \
-                'precision: {}  recall: {}  accuracy: {}'
+                'precision: {}  recall: {}  accuracy: {}  padding: {:0.1%}  tokens/sec: {:0.0f}  ' \
+                'cpu hours: {:0.3f}'
             logging.info(m.format(step, loss, lr, elapsed_time,
-                                  metrics['precision'], metrics['recall'], metrics['accuracy']))
+                                  metrics['precision'], metrics['recall'], metrics['accuracy'],
+                                  padding, self.period_tokens / period_time, cpu_hours))
+            self.period_tokens = 0
+            self.period_padded_tokens = 0
 
     def after_create_session(self, session, coord):
         self.init_time = time.time()
+        self.init_cpu_time = _cpu_time()
         self.print_timestamp = time.time()
+        self.period_tokens = 0
+        self.period_padded_tokens = 0
 
 
 class TextClassificationTest(evaluator.Evaluator):
@@ -188,7 +246,17 @@ class TextClassificationEval(evaluator.Evaluator):
     """Evaluator for text classification"""
 
     def __init__(self, dataset, text_classification_model, output_path, log_dir=DIR_TC_LOGDIR,
-                 use_end_sequence=False):
+                 use_end_sequence=False, submission_file=None):
+        """
+        :param TextClassificationDataset dataset: the dataset to predict, if it was sorted by
+        length the predictions are written in the original order
+        :param ModelSimple text_classification_model: the model
+        :param str output_path: path where to store the summary data
+        :param str log_dir: directory with the checkpoints
+        :param bool use_end_sequence: whether to use or not the end of the sequences in the model
+        :param str submission_file: file where the predictions are written, by default
+        submission.csv in the output path
+        """
         self.use_end_sequence = use_end_sequence
         config = tf.ConfigProto()
         config.gpu_options.allow_growth = True
@@ -198,6 +266,9 @@ class TextClassificationEval(evaluator.Evaluator):
                                                      singular_monitored_session_config=config)
         self.dataset = dataset
         self.text_classification_model = text_classification_model
+        if submission_file is None:
+            submission_file = os.path.join(output_path, 'submission.csv')
+        self.submission_file = submission_file
 
     def model(self, input_text_begin, input_text_end, gene, variation, batch_size,
               vocabulary_size=VOCABULARY_SIZE, embeddings_size=EMBEDDINGS_SIZE, output_classes=9):
@@ -205,15 +276,13 @@ class TextClassificationEval(evaluator.Evaluator):
         embeddings = _load_embeddings(vocabulary_size, embeddings_size)
         # global step
         self.global_step = training_util.get_or_create_global_step()
-        self.global_step = tf.assign_add(self.global_step, 1)
         # model
-        with tf.control_dependencies([self.global_step]):
-            with slim.arg_scope(self.text_classification_model.model_arg_scope()):
-                self.outputs = self.text_classification_model.model(input_text_begin, input_text_end,
-                                                                    gene, variation, output_classes,
-                                                                    embeddings=embeddings,
-                                                                    batch_size=batch_size,
-                                                                    training=False)
+        with slim.arg_scope(self.text_classification_model.model_arg_scope()):
+            self.outputs = self.text_classification_model.model(input_text_begin, input_text_end,
+                                                                gene, variation, output_classes,
+                                                                embeddings=embeddings,
+                                                                batch_size=batch_size,
+                                                                training=False)
         # restore only the trainable variables
         self.saver = tf.train.Saver(var_list=tf_variables.trainable_variables())
         return self.outputs
@@ -222,21 +291,32 @@ class TextClassificationEval(evaluator.Evaluator):
         input_text_begin, input_text_end, gene, variation = dataset_tensor
         if not self.use_end_sequence:
             input_text_end = None
+        # the last batch can be smaller than batch_size
+        batch_size = tf.shape(input_text_begin)[0]
         return self.model(input_text_begin, input_text_end, gene, variation, batch_size)
 
     def after_create_session(self, session, coord):
         super(TextClassificationEval, self).after_create_session(session, coord)
-        print('ID,class1,class2,class3,class4,class5,class6,class7,class8,class9')
+        self.predictions = []
 
     def step(self, session, graph_data, summary_op):
-        step, predictions = session.run([self.global_step, self.outputs['prediction']])
-        predictions = predictions[0]
-        predictions = [p + 0.01 for p in predictions]  # penalize less the mistakes
-        sum = np.sum(predictions)
-        predictions = [p / sum for p in predictions]
-        print('{},{}'.format(step, ','.join(['{:.3f}'.format(x) for x in predictions])))
+        self.predictions.append(session.run(self.outputs['prediction']))
         return None
 
+    def end(self, session):
+        super(TextClassificationEval, self).end(session)
+        predictions = np.concatenate(self.predictions)
+        order = getattr(self.dataset, 'order', None)
+        if order is not None:
+            # restore the original order of the documents
+            sorted_predictions = predictions
+            predictions = np.empty_like(sorted_predictions)
+            predictions[order] = sorted_predictions
+        predictions = evaluator.smooth_predictions(predictions)
+        evaluator.write_submission(self.submission_file, predictions)
+        logging.info('{} predictions written in {}'.format(len(predictions),
+                                                           self.submission_file))
+
 
 import logging
 
@@ -270,20 +350,22 @@ def main(model, name, sentence_split=False, end_sequence=USE_END_SEQUENCE, batch
         tester.run()
     elif len(sys.argv) > 1 and sys.argv[1] == 'eval':
         # evaluate the data of the test dataset. We submit this output to kaggle
-        dataset = TextClassificationDataset(type='test', sentence_split=sentence_split)
+        dataset = TextClassificationDataset(type='test', sentence_split=sentence_split,
+                                            sort_by_length=True)
         evaluator = TextClassificationEval(dataset=dataset, text_classification_model=model,
                                            log_dir=log_dir,
                                            output_path=os.path.join(log_dir, 'test'),
                                            use_end_sequence=end_sequence)
-        evaluator.run()
+        evaluator.run(batch_size=TC_EVAL_BATCH_SIZE)
     elif len(sys.argv) > 1 and sys.argv[1] == 'eval_stage2':
         # evaluate the data of the test dataset. We submit this output to kaggle
-        dataset = TextClassificationDataset(type='stage2_test', sentence_split=sentence_split)
+        dataset = TextClassificationDataset(type='stage2_test', sentence_split=sentence_split,
+                                            sort_by_length=True)
         evaluator = TextClassificationEval(dataset=dataset, text_classification_model=model,
                                            log_dir=log_dir,
                                            output_path=os.path.join(log_dir, 'test_stage2'),
                                            use_end_sequence=end_sequence)
-        evaluator.run()
+        evaluator.run(batch_size=TC_EVAL_BATCH_SIZE)
     else:
         # training
         task_spec = get_task_spec(with_evaluator=USE_LAST_WORKER_FOR_VALIDATION)
@@ -291,8 +373,16 @@ def main(model, name, sentence_split=False, end_sequence=USE_END_SEQUENCE, batch
             # join if it is a parameters server and do nothing else
             return
 
-        with(tf.gfile.Open(os.path.join(DIR_DATA_TEXT_CLASSIFICATION, 'train_set'))) as f:
-            max_steps = int(TC_EPOCHS * len(f.readlines()) / batch_size)
+        # the sentences are removed every epoch and the classes are balanced either with the
+        # weights of the loss or sampling the documents
+        remove_ratio = TD_DATA_SENTENCE_REMOVE_PERCENTAGE
+        train_dataset = TextClassificationDataset(type='train', sentence_split=sentence_split,
+                                                  bucket_boundaries=TC_BUCKET_BOUNDARIES,
+                                                  token_budget=TC_TOKEN_BUDGET,
+                                                  balance_classes=not TC_CLASS_WEIGHTS,
+                                                  sentence_remove_ratio=remove_ratio)
+        # with a token budget the batch size depends on the bucket of the documents
+        max_steps = train_dataset.num_batches(batch_size, TC_EPOCHS)
 
         if task_spec.is_evaluator():
             dataset = TextClassificationDataset(type='val', sentence_split=sentence_split)
@@ -304,8 +394,11 @@ def main(model, name, sentence_split=False, end_sequence=USE_END_SEQUENCE, batch
                                             max_steps=max_steps)
             tester.run()
         else:
-            dataset = TextClassificationDataset(type='train', sentence_split=sentence_split)
-            trainer = TextClassificationTrainer(dataset=dataset, text_classification_model=model,
+            train_manifest = load_manifest(os.path.join(DIR_DATA_TEXT_CLASSIFICATION, 'train_set'))
+            weights = class_weights(train_manifest) if TC_CLASS_WEIGHTS else None
+            trainer = TextClassificationTrainer(dataset=train_dataset,
+                                                text_classification_model=model,
                                                 log_dir=log_dir, use_end_sequence=end_sequence,
-                                                task_spec=task_spec, max_steps=max_steps)
+                                                task_spec=task_spec, max_steps=max_steps,
+                                                class_weights=weights)
             trainer.run(epochs=TC_EPOCHS, batch_size=batch_size)
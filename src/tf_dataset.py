@@ -1,15 +1,22 @@
+import os
+import mmap
+import logging
 import multiprocessing
+import numpy as np
 import tensorflow as tf
 from tensorflow.contrib.data import TextLineDataset
 from tensorflow.contrib.data import Dataset
-from tensorflow.python.framework.errors_impl import OutOfRangeError
+from .manifest import load_manifest
+from .tf_dataset_generator import dataset_from_generator, prefetch_dataset
 
 
 class TFDataSet(object):
     """Abstract class that helps to work with TensorFlow Datasets"""
 
     def __init__(self, name, data_files_pattern, dataset_class=TextLineDataset,
-                 min_queue_examples=0, shuffle_size=None, padded_shapes=None, padded_values=None):
+                 min_queue_examples=0, shuffle_size=None, padded_shapes=None, padded_values=None,
+                 random_access=False, random_access_window=256, prefetch_batches=2,
+                 shards_pattern=None):
         """
         :param name: name of the dataset.
         :param str data_files_pattern: pattern of the data files
@@ -21,6 +28,16 @@ class TFDataSet(object):
         proportional to the ram of the computer
         :param List[tf.Tensor] padded_shapes: shape for padding the batch
         :param tf.Tensor padded_values: values for the padding
+        :param bool random_access: whether to shuffle the lines of the files reading them by their
+        offsets in a global random order every epoch, instead of using a shuffle buffer. Only
+        for TextLineDataset
+        :param int random_access_window: with random_access, number of lines read at once
+        :param int prefetch_batches: number of batches prepared in background while the model
+        consumes the current one, 0 to not prefetch
+        :param str shards_pattern: pattern of the shard files with the same data as the data
+        files. In distributed training every worker reads only its shard files if there are at
+        least as many shards as workers, otherwise the workers read all the data files and skip
+        the records of the other workers
         """
         self.name = name
         self.data_files_pattern = data_files_pattern
@@ -29,6 +46,10 @@ class TFDataSet(object):
         self.shuffle_size = shuffle_size
         self.padded_shapes = padded_shapes
         self.padded_values = padded_values
+        self.random_access = random_access
+        self.random_access_window = random_access_window
+        self.prefetch_batches = prefetch_batches
+        self.shards_pattern = shards_pattern
         self._size = None
 
     def read(self, batch_size, num_epochs=1, shuffle=False, task_spec=None):
@@ -41,32 +62,25 @@ class TFDataSet(object):
         distributed training or not
         :return: The result of calling dataset.make_one_shot_iterator().get_next()
         """
-        # create the dataset of files with the data
-        # TODO in TF 1.3 use:  dataset = Dataset.list_files(self.data_files_pattern)
-        from tensorflow.python.ops import gen_io_ops
+        if shuffle and self.random_access:
+            # shuffled, sharded and repeated by the reader
+            dataset = self._random_access_dataset(num_epochs, task_spec)
+            return self._process(dataset, batch_size)
 
-        dataset = Dataset.from_tensor_slices(gen_io_ops.matching_files(self.data_files_pattern))
+        # create the dataset of files with the data
+        files, shard_records = self._worker_files(task_spec)
         if shuffle:
-            # read one sample per file
-            # TODO in TF 1.3 use:
-            # dataset = dataset.interleave(self.dataset_class,
-            #                              # number of readers the same as number of CPUs
-            #                              cycle_length=multiprocessing.cpu_count() + 1,
-            #                              # block size is 1 to get directly a flat map
-            #                              block_length=1)
-            files = self._read_files_once(dataset)
             import random
 
             random.shuffle(files)
-            dataset = self.dataset_class(files)
+            dataset = self._interleave_files(files)
         else:
             # reads files sequentially
-            files = self._read_files_once(dataset)
             dataset = self.dataset_class(files)
         # set the number of epochs
         dataset = dataset.repeat(num_epochs)
 
-        if task_spec and task_spec.num_workers > 1:
+        if shard_records:
             # split the dataset in shards
             # TODO in TF 1.4 use: dataset = dataset.shard(task_spec.num_workers, task_spec.index)
             from tensorflow.python.ops import math_ops
@@ -83,6 +97,15 @@ class TFDataSet(object):
                 raise ValueError('shuffle_size has not been set')
             dataset = dataset.shuffle(buffer_size=self.shuffle_size)
 
+        return self._process(dataset, batch_size)
+
+    def _process(self, dataset, batch_size):
+        """
+        Maps the examples read from the files and groups them in batches
+        :param dataset: the dataset with the examples read from the files
+        :param batch_size: the batch size
+        :return: The result of calling dataset.make_one_shot_iterator().get_next()
+        """
         # process each example. We check the method is defined in the child class:
         if self._flat_map.__func__ not in TFDataSet.__dict__.values():
             dataset = dataset.flat_map(self._flat_map)
@@ -94,12 +117,42 @@ class TFDataSet(object):
                                   # buffer the data as CPUs * batch_size + minimum_size
                                   output_buffer_size=batch_size * multiprocessing.cpu_count() +
                                                      self.min_queue_examples)
-        if self.padded_shapes is not None:
-            dataset = dataset.padded_batch(batch_size, self.padded_shapes, self.padded_values)
-        else:
-            dataset = dataset.batch(batch_size)
+        dataset = self._batch(dataset, batch_size)
+        dataset = prefetch_dataset(dataset, self.prefetch_batches)
         return dataset.make_one_shot_iterator().get_next()
 
+    def _interleave_files(self, files):
+        """
+        Reads the files in parallel taking one example of every file in turns. With versions of
+        TensorFlow without interleave the files are read sequentially
+        :param List[str] files: the files
+        :return Dataset: the dataset with the examples of the files
+        """
+        if len(files) <= 1 or not hasattr(Dataset, 'interleave'):
+            # TODO in TF 1.3 use the interleave below
+            return self.dataset_class(files)
+        # number of readers the same as number of CPUs
+        cycle_length = min(len(files), multiprocessing.cpu_count() + 1)
+        files_dataset = Dataset.from_tensor_slices(tf.constant(files, dtype=tf.string))
+        if hasattr(tf.contrib.data, 'parallel_interleave'):
+            # TF >= 1.4 reads the files of the cycle in parallel threads
+            return files_dataset.apply(tf.contrib.data.parallel_interleave(
+                    self.dataset_class, cycle_length=cycle_length, block_length=1))
+        # block size is 1 to get directly a flat map
+        return files_dataset.interleave(self.dataset_class, cycle_length=cycle_length,
+                                        block_length=1)
+
+    def _batch(self, dataset, batch_size):
+        """
+        Groups the examples of the dataset in batches
+        :param dataset: the dataset with the examples
+        :param batch_size: the batch size
+        :return: the dataset with the batches
+        """
+        if self.padded_shapes is not None:
+            return dataset.padded_batch(batch_size, self.padded_shapes, self.padded_values)
+        return dataset.batch(batch_size)
+
     # TODO remove features in TF 1.3
     def _flat_map(self, example_serialized, features=None):
         """
@@ -145,46 +198,125 @@ class TFDataSet(object):
         """
         pass
 
-    def _read_files_once(self, dataset):
-        files = []
-        with tf.Graph().as_default():
-            filename = dataset.make_one_shot_iterator().get_next()
+    def _random_access_dataset(self, num_epochs, task_spec=None, seed=None):
+        """
+        Creates a dataset with the lines of the files in a different random order every epoch.
+        The lines are read by their offsets in the manifests of the files, the memory used only
+        depends on random_access_window and not on the size of the dataset. The generator yields
+        the lines of a window at once, so the py_func runs once per window and not per line.
+        :param int num_epochs: the number of epochs to read the dataset
+        :param task_spec: the task spec of the training, every worker reads a different subset
+        of the lines
+        :param int seed: seed for the random order
+        :return Dataset: a dataset of strings
+        """
+        files, shard_records = self._worker_files(task_spec)
+        manifests = [load_manifest(f) for f in files]
+        files = [f for f, m in zip(files, manifests) if m.num_records > 0]
+        manifests = [m for m in manifests if m.num_records > 0]
+        file_ids = np.concatenate([np.full(m.num_records, i, dtype=np.int32)
+                                   for i, m in enumerate(manifests)])
+        starts = np.concatenate([m.offsets for m in manifests])
+        ends = np.concatenate([np.append(m.offsets[1:], m.data_size) for m in manifests])
+        classes = np.concatenate([m.classes for m in manifests])
+        indexes = np.arange(len(starts))
+        if shard_records:
+            indexes = indexes[task_spec.index::task_spec.num_workers]
+        classes = classes[indexes]
+        window = self.random_access_window
+
+        def _generator():
+            random = np.random.RandomState(seed)
+            readers = [_OffsetReader(f) for f in files]
             try:
-                with tf.Session() as sess:
-                    while True:
-                        d = sess.run(filename)
-                        files.append(d)
-            except OutOfRangeError:
-                pass
-        return files
+                for _ in range(num_epochs):
+                    permutation = self._epoch_order(random, indexes, classes)
+                    for first in range(0, len(permutation), window):
+                        block = permutation[first:first + window]
+                        # read the window in the order of the files and yield it in random order
+                        lines = {}
+                        for i in sorted(block, key=lambda i: (file_ids[i], starts[i])):
+                            lines[i] = readers[file_ids[i]].read(starts[i], ends[i])
+                        yield np.asarray([lines[i] for i in block], dtype=object)
+            finally:
+                for reader in readers:
+                    reader.close()
 
-    def _count_num_records(self):
+        dataset = dataset_from_generator(_generator, tf.string, tf.TensorShape([None]))
+        return dataset.flat_map(lambda lines: Dataset.from_tensor_slices(lines))
+
+    def _epoch_order(self, random, indexes, classes):
         """
-        Counts the number of non-empty lines (the data samples) from the data_files. This function
-        is called from get_size the first time.
-        :return int: the number of non-empty lines in the data_files
+        Order in which the records are read in one epoch by the random access reader. By default
+        a permutation of the records, subclasses can override it to sample the records.
+        :param np.random.RandomState random: the random generator
+        :param np.ndarray indexes: the indexes of the records read by this worker
+        :param np.ndarray classes: the classes of the records in the manifests, -1 if unknown
+        :return np.ndarray: the indexes of the records to read in the epoch
         """
-        # TODO in TF 1.3 use: dataset = Dataset.list_files(self.data_files_pattern).repeat(1)
-        from tensorflow.python.ops import gen_io_ops
+        return random.permutation(indexes)
 
-        dataset = Dataset.from_tensor_slices(
-                gen_io_ops.matching_files(self.data_files_pattern)).repeat(1)
+    def _list_files(self):
+        """
+        :return List[str]: the sorted list of the files that match the data_files_pattern
+        """
+        return sorted(tf.gfile.Glob(self.data_files_pattern))
 
-        files = self._read_files_once(dataset)
-        with tf.Graph().as_default():
-            dataset = self.dataset_class(files).repeat(1)
-            samples = 0
-            try:
-                next_element = dataset.make_one_shot_iterator().get_next()
-                with tf.Session() as sess:
-                    while True:
-                        sess.run(next_element)
-                        samples += 1
-            except:
-                pass
-        return samples
+    def _worker_files(self, task_spec=None):
+        """
+        Selects the files read by a worker. In distributed training every worker reads a
+        disjoint subset of the shard files when there are enough shards.
+        :param task_spec: the task spec of the training
+        :return (List[str], bool): the files and whether the records of the files have to be
+        split between the workers
+        """
+        if task_spec is None or task_spec.num_workers <= 1:
+            return self._list_files(), False
+        if self.shards_pattern is not None:
+            shards = sorted(tf.gfile.Glob(self.shards_pattern))
+            if len(shards) >= task_spec.num_workers:
+                return shards[task_spec.index::task_spec.num_workers], False
+            logging.warning('{} shards of {} for {} workers, splitting the records instead'
+                            .format(len(shards), self.name, task_spec.num_workers))
+        return self._list_files(), True
+
+    def _count_num_records(self):
+        """
+        Counts the number of non-empty lines (the data samples) from the data_files with the
+        manifests of the files. This function is called from get_size the first time.
+        :return int: the number of non-empty lines in the data_files
+        """
+        return sum([load_manifest(f).num_records for f in self._list_files()])
 
     def get_size(self):
         if self._size is None:
             self._size = self._count_num_records()
         return self._size
+
+
+class _OffsetReader(object):
+    """
+    Reads the lines of a file by their byte offsets. Local files are memory mapped, the rest are
+    read with tf.gfile
+    """
+
+    def __init__(self, filepath):
+        self.map = None
+        if '://' not in filepath and os.path.getsize(filepath) > 0:
+            self.file = open(filepath, 'rb')
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self.file = tf.gfile.GFile(filepath, 'rb')
+
+    def read(self, start, end):
+        if self.map is not None:
+            line = self.map[start:end]
+        else:
+            self.file.seek(start)
+            line = self.file.read(end - start)
+        return line.rstrip(b'\r\n')
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+        self.file.close()
@@ -1,4 +1,5 @@
 import multiprocessing
+import numpy as np
 import tensorflow as tf
 from tensorflow.contrib.data import Dataset
 
@@ -31,11 +32,122 @@ class _GeneratorState(object):
         del self._iterators[iterator_id]
 
 
+# from TensorFlow 1.4
+def dataset_from_generator(generator, output_types, output_shapes=None):
+    """
+    Creates a dataset whose elements are generated by the generator, it is a copy of
+    Dataset.from_generator of TensorFlow 1.4
+    :param generator: a callable that returns the generator
+    :param output_types: the types of the elements of the generator
+    :param output_shapes: the shapes of the elements of the generator, by default unknown
+    :return Dataset: the dataset
+    """
+    generator_state = _GeneratorState(generator)
+    if output_shapes is None:
+        output_shapes = nest.map_structure(lambda _: tensor_shape.TensorShape(None), output_types)
+    flattened_types = nest.flatten(output_types)
+    flattened_shapes = nest.flatten(output_shapes)
+
+    def get_iterator_id_map_fn(dummy):
+        return script_ops.py_func(generator_state.get_next_id, [], tf.int64, stateful=True)
+
+    def generator_map_fn(iterator_id_t):
+        def generator_py_func(iterator_id):
+            try:
+                values = next(generator_state.get_iterator(iterator_id))
+            except StopIteration:
+                generator_state.iterator_completed(iterator_id)
+                raise StopIteration("Iteration finished.")
+            ret_arrays = [script_ops.FuncRegistry._convert(ret) for ret in
+                nest.flatten_up_to(output_types, values)]
+            for (ret_array, expected_dtype, expected_shape) in zip(ret_arrays, flattened_types,
+                    flattened_shapes):
+                if ret_array.dtype != expected_dtype.as_numpy_dtype:
+                    raise TypeError(
+                            "`generator` yielded an element of type %s where an element "
+                            "of type %s was expected." % (
+                            ret_array.dtype, expected_dtype.as_numpy_dtype))
+                if not expected_shape.is_compatible_with(ret_array.shape):
+                    raise ValueError(
+                            "`generator` yielded an element of shape %s where an element "
+                            "of shape %s was expected." % (ret_array.shape, expected_shape))
+            return ret_arrays
+
+        flat_values = script_ops.py_func(generator_py_func, [iterator_id_t], flattened_types,
+                                         stateful=True)
+        for ret_t, shape in zip(flat_values, flattened_shapes):
+            ret_t.set_shape(shape)
+        return nest.pack_sequence_as(output_types, flat_values)
+
+    def flat_map_fn(iterator_id_t):
+        repeated_id = Dataset.from_tensors(iterator_id_t).repeat(None)
+        return repeated_id.map(generator_map_fn)
+
+    id_dataset = Dataset.from_tensors(0).map(get_iterator_id_map_fn)
+    return id_dataset.flat_map(flat_map_fn)
+
+
+def prefetch_dataset(dataset, buffer_size):
+    """
+    Prefetches the elements of the dataset in a background thread, so the consumer of the
+    dataset does not wait while the next elements are prepared
+    :param Dataset dataset: the dataset
+    :param int buffer_size: number of elements to prefetch, 0 or None to not prefetch
+    :return Dataset: the dataset with the prefetched elements
+    """
+    if not buffer_size:
+        return dataset
+    if hasattr(dataset, 'prefetch'):
+        return dataset.prefetch(buffer_size)
+
+    # TODO in TF 1.4 use: dataset = dataset.prefetch(buffer_size)
+    def _identity(*elements):
+        return elements[0] if len(elements) == 1 else elements
+
+    return dataset.map(_identity, num_threads=1, output_buffer_size=buffer_size)
+
+
+def _rebatch(blocks, batch_size, random=None):
+    """
+    Cuts the blocks of a generator in batches of the same size, only the last batch can be
+    smaller
+    :param blocks: generator of tuples of numpy arrays with the same first dimension
+    :param int batch_size: the size of the batches
+    :param np.random.RandomState random: if not None the rows of every block are shuffled
+    :return: a generator of tuples of numpy arrays with batch_size rows
+    """
+    pending = []
+    pending_size = 0
+    for block in blocks:
+        block_size = len(block[0])
+        if block_size == 0:
+            continue
+        if random is not None:
+            permutation = random.permutation(block_size)
+            block = tuple(array[permutation] for array in block)
+        pending.append(block)
+        pending_size += block_size
+        if pending_size >= batch_size:
+            if len(pending) > 1:
+                data = tuple(np.concatenate(arrays) for arrays in zip(*pending))
+            else:
+                data = pending[0]
+            full_size = pending_size - pending_size % batch_size
+            for start in range(0, full_size, batch_size):
+                yield tuple(array[start:start + batch_size] for array in data)
+            pending = [tuple(array[full_size:] for array in data)] if full_size < pending_size \
+                else []
+            pending_size -= full_size
+    if pending_size > 0:
+        yield tuple(np.concatenate(arrays) for arrays in zip(*pending))
+
+
 class TFDataSetGenerator(object):
     """Abstract class that helps to work with TensorFlow Datasets"""
 
     def __init__(self, name, generator, output_types, output_shapes=None, min_queue_examples=0,
-                 shuffle_size=None, padded_shapes=None, padded_values=None):
+                 shuffle_size=None, padded_shapes=None, padded_values=None, prefetch_batches=2,
+                 batched=False, num_workers=1, seed=None):
         """
         :param name: name of the dataset.
         :param generator generator: generator of elements in of the dataset
@@ -47,6 +159,18 @@ class TFDataSetGenerator(object):
         proportional to the ram of the computer
         :param List[tf.Tensor] padded_shapes: shape for padding the batch
         :param tf.Tensor padded_values: values for the padding
+        :param int prefetch_batches: number of batches prepared in background while the model
+        consumes the current one, 0 to not prefetch
+        :param bool batched: whether the generator yields blocks of elements instead of single
+        elements. Every block is a tuple of numpy arrays with the same first dimension, the
+        elements of the block are the rows of the arrays. The blocks are cut in batches in
+        python, so there is only one call to the generator per batch
+        :param int num_workers: with batched, number of processes that run the generator, see
+        GeneratorWorkers. The generators of blocks must have the parameters shard_index and
+        num_shards and generate only the blocks of that partition, it is used to split the data
+        between the processes and the distributed workers
+        :param int seed: seed to shuffle the blocks, with num_workers > 1 also the seed of the
+        random generators of the workers
         """
         if not callable(generator):
             raise TypeError("`generator` must be callable.")
@@ -58,6 +182,13 @@ class TFDataSetGenerator(object):
         self.shuffle_size = shuffle_size
         self.padded_shapes = padded_shapes
         self.padded_values = padded_values
+        self.prefetch_batches = prefetch_batches
+        self.batched = batched
+        self.num_workers = num_workers
+        self.seed = seed
+        if num_workers > 1 and not batched:
+            raise ValueError('Only the generators of blocks can run in several workers')
+        self._size = None
 
     def read(self, batch_size, num_epochs=1, shuffle=False, task_spec=None):
         """
@@ -77,52 +208,10 @@ class TFDataSetGenerator(object):
                 for item in self.generator():
                     yield item
 
-        generator_state = _GeneratorState(_epochs)
-        output_types = self.output_types
-        output_shapes = self.output_shapes
-        output_shapes = nest.map_structure(lambda _: tensor_shape.TensorShape(None), output_types)
-        flattened_types = nest.flatten(output_types)
-        flattened_shapes = nest.flatten(output_shapes)
-
-        def get_iterator_id_map_fn(dummy):
-            return script_ops.py_func(generator_state.get_next_id, [], tf.int64, stateful=True)
-
-        def generator_map_fn(iterator_id_t):
-            def generator_py_func(iterator_id):
-                try:
-                    values = next(generator_state.get_iterator(iterator_id))
-                except StopIteration:
-                    generator_state.iterator_completed(iterator_id)
-                    raise StopIteration("Iteration finished.")
-                ret_arrays = [script_ops.FuncRegistry._convert(ret) for ret in
-                    nest.flatten_up_to(output_types, values)]
-                for (ret_array, expected_dtype, expected_shape) in zip(ret_arrays, flattened_types,
-                        flattened_shapes):
-                    if ret_array.dtype != expected_dtype.as_numpy_dtype:
-                        raise TypeError(
-                                "`generator` yielded an element of type %s where an element "
-                                "of type %s was expected." % (
-                                ret_array.dtype, expected_dtype.as_numpy_dtype))
-                    if not expected_shape.is_compatible_with(ret_array.shape):
-                        raise ValueError(
-                                "`generator` yielded an element of shape %s where an element "
-                                "of shape %s was expected." % (ret_array.shape, expected_shape))
-                return ret_arrays
-
-            flat_values = script_ops.py_func(generator_py_func, [iterator_id_t], self.output_types,
-                                             stateful=True)
-            if output_shapes is not None:
-                for ret_t, shape in zip(flat_values, flattened_shapes):
-                    ret_t.set_shape(shape)
-            return nest.pack_sequence_as(output_types, flat_values)
-
-        def flat_map_fn(iterator_id_t):
-            repeated_id = Dataset.from_tensors(iterator_id_t).repeat(None)
-            return repeated_id.map(generator_map_fn)
-
-        id_dataset = Dataset.from_tensors(0).map(get_iterator_id_map_fn)
-        dataset = id_dataset.flat_map(flat_map_fn)
-        ############################################################################################
+        if self.batched:
+            return self._read_batched(num_epochs, batch_size, shuffle, task_spec)
+
+        dataset = dataset_from_generator(_epochs, self.output_types)
 
         # set the number of epochs
         # FIXME repeat doesn't work with generators
@@ -158,6 +247,62 @@ class TFDataSetGenerator(object):
             dataset = dataset.padded_batch(batch_size, self.padded_shapes, self.padded_values)
         else:
             dataset = dataset.batch(batch_size)
+        dataset = prefetch_dataset(dataset, self.prefetch_batches)
+        return dataset.make_one_shot_iterator().get_next()
+
+    def _read_batched(self, num_epochs, batch_size, shuffle, task_spec):
+        """
+        Reads the data of a generator of blocks, see read(). The blocks are cut in batches of
+        batch_size elements, shuffling the elements of the blocks when shuffle is true, and the
+        batches are shuffled in a buffer of shuffle_size elements. The batches are split in
+        elements again only if the dataset maps or pads them.
+        """
+        # every distributed worker only generates its own partition of the blocks
+        if task_spec and task_spec.num_workers > 1:
+            shard_index, num_shards = task_spec.index, task_spec.num_workers
+        else:
+            shard_index, num_shards = 0, 1
+        if self.num_workers > 1:
+            from .generator_workers import GeneratorWorkers
+
+            def _batches():
+                return iter(GeneratorWorkers(self.generator, self.num_workers, batch_size,
+                                             num_epochs=num_epochs, shuffle=shuffle,
+                                             seed=self.seed, shard_index=shard_index,
+                                             num_shards=num_shards))
+        else:
+            seed = None if self.seed is None else self.seed + shard_index
+            random = np.random.RandomState(seed) if shuffle else None
+
+            def _blocks():
+                for _ in range(num_epochs):
+                    for block in self.generator(shard_index=shard_index, num_shards=num_shards):
+                        yield block
+
+            def _batches():
+                return _rebatch(_blocks(), batch_size, random)
+
+        dataset = dataset_from_generator(_batches, self.output_types)
+
+        if shuffle:
+            # shuffle the batches
+            if self.shuffle_size is None:
+                raise ValueError('shuffle_size has not been set')
+            dataset = dataset.shuffle(buffer_size=max(1, self.shuffle_size // batch_size))
+
+        if self._map.__func__ not in TFDataSetGenerator.__dict__.values() or self.padded_shapes:
+            # split the batches in elements to map and pad them
+            dataset = dataset.flat_map(lambda *batch: Dataset.from_tensor_slices(batch))
+            if self._map.__func__ not in TFDataSetGenerator.__dict__.values():
+                dataset = dataset.map(self._map,
+                                      num_threads=multiprocessing.cpu_count() + 1,
+                                      output_buffer_size=batch_size * multiprocessing.cpu_count() +
+                                                         self.min_queue_examples)
+            if self.padded_shapes:
+                dataset = dataset.padded_batch(batch_size, self.padded_shapes, self.padded_values)
+            else:
+                dataset = dataset.batch(batch_size)
+        dataset = prefetch_dataset(dataset, self.prefetch_batches)
         return dataset.make_one_shot_iterator().get_next()
 
     # TODO remove features in TF 1.3
@@ -169,9 +314,9 @@ class TFDataSetGenerator(object):
 
     def _count_num_records(self):
         """
-        Counts the number of non-empty lines (the data samples) from the data_files. This function
-        is called from get_size the first time.
-        :return int: the number of non-empty lines in the data_files
+        Counts the number of elements of the generator running it once. This function is called
+        from get_size the first time, subclasses that know their size should override it.
+        :return int: the number of elements of the generator
         """
         samples = 0
         try:
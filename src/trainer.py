@@ -1,9 +1,12 @@
 import logging
 import time
+import threading
 import tensorflow as tf
 from tensorflow.python.training import session_run_hook
 from tensorflow.python.training.basic_session_run_hooks import StopAtStepHook
 from .task_spec import get_task_spec, get_logs_path
+from .configuration import INPUT_WAIT_STEPS
+from .embeddings import normalize_embeddings
 
 
 class Trainer(session_run_hook.SessionRunHook):
@@ -14,7 +17,8 @@ class Trainer(session_run_hook.SessionRunHook):
 
     def __init__(self, log_dir, max_time=None, num_steps=None, max_steps=None,
                  save_checkpoint_secs=600, save_summaries_steps=100, log_step_count_steps=100,
-                 monitored_training_session_config=None, task_spec=None, dataset=None):
+                 monitored_training_session_config=None, task_spec=None, dataset=None,
+                 input_wait_steps=INPUT_WAIT_STEPS):
         """
         :param str log_dir: directory where logs are stored
         :param int max_time: max time to run the training, by default isNone to run indefinitely
@@ -27,6 +31,8 @@ class Trainer(session_run_hook.SessionRunHook):
         :param tf.ConfigProto monitored_training_session_config: an instance of tf.ConfigProto,
         the configuration for the monitored training session
         :param TFDataSet dataset: the dataset for this trainer
+        :param int input_wait_steps: steps between the steps traced in the chief to log how long
+        the training waits for the input (see InputWaitHook), None to not trace any step
         """
         self.log_dir = get_logs_path(log_dir)
         self.save_checkpoint_secs = save_checkpoint_secs
@@ -42,6 +48,7 @@ class Trainer(session_run_hook.SessionRunHook):
         else:
             self.task_spec = task_spec
         self.dataset = dataset
+        self.input_wait_steps = input_wait_steps
 
     def run(self, batch_size, epochs):
         """
@@ -86,6 +93,9 @@ class Trainer(session_run_hook.SessionRunHook):
             if chief_only_hooks is None:
                 chief_only_hooks = []
             chief_only_hooks.append(self)
+            if self.dataset is not None and self.input_wait_steps:
+                # the traced steps are slower, only the chief traces them
+                chief_only_hooks.append(InputWaitHook(every_n_steps=self.input_wait_steps))
             if self.max_time and self.max_time > 0:
                 hooks.append(StopAtTimeHook(self.max_time))
             if (self.max_steps or self.num_steps) and (self.max_steps > 0 or self.num_steps > 0):
@@ -148,3 +158,106 @@ class StopAtTimeHook(session_run_hook.SessionRunHook):
     def after_run(self, run_context, run_values):
         if time.time() > self._end_time:
             run_context.request_stop()
+
+
+class InputWaitHook(session_run_hook.SessionRunHook):
+    """
+    Hook that measures how long the training steps wait for the input pipeline. Every n steps the
+    step is traced and the time spent in the IteratorGetNext ops is compared with the duration of
+    the step. A wait close to 0 means the input is prepared while the model computes the previous
+    step, otherwise the input pipeline is the bottleneck.
+    """
+
+    def __init__(self, every_n_steps=100, op_type='IteratorGetNext'):
+        """
+        :param int every_n_steps: steps between the traced steps
+        :param str op_type: type of the ops that read the input
+        """
+        self._every_n_steps = every_n_steps
+        self._op_type = op_type
+
+    def begin(self):
+        self._step = 0
+        self._traced = False
+        self._input_ops = set(op.name for op in tf.get_default_graph().get_operations()
+                              if op.type == self._op_type)
+
+    def before_run(self, run_context):
+        self._step += 1
+        self._traced = len(self._input_ops) > 0 and self._step % self._every_n_steps == 0
+        if self._traced:
+            self._start = time.time()
+            options = tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE)
+            return session_run_hook.SessionRunArgs(None, options=options)
+        return None
+
+    def after_run(self, run_context, run_values):
+        if not self._traced:
+            return
+        step_time = time.time() - self._start
+        wait_micros = 0
+        for device_stats in run_values.run_metadata.step_stats.dev_stats:
+            for node_stats in device_stats.node_stats:
+                if node_stats.node_name in self._input_ops:
+                    wait_micros += node_stats.all_end_rel_micros
+        wait_time = wait_micros / 1000000.0
+        logging.info('input wait: {:0.4f} seconds of a step of {:0.4f} seconds ({:0.1f}%)'
+                     .format(wait_time, step_time, 100.0 * wait_time / max(step_time, 1e-6)))
+
+
+class EmbeddingsSnapshotHook(session_run_hook.SessionRunHook):
+    """
+    Hook that saves snapshots of embeddings periodically. The embeddings are only fetched in the
+    steps when a snapshot is due, the rest of the steps run as in a worker. The embeddings are
+    normalized and saved in a background thread so the training is not blocked while the files
+    are written. A last snapshot is saved when the session ends.
+    """
+
+    def __init__(self, embeddings, save_fn, save_secs=30 * 60, first_save_secs=None,
+                 normalize=True):
+        """
+        :param Dict[str,tf.Tensor] embeddings: the tensors with the embeddings to save
+        :param save_fn: function called with a dictionary with the same keys as embeddings and
+        the values of the embeddings as numpy arrays. It is called from a background thread
+        :param int save_secs: seconds between snapshots
+        :param int first_save_secs: seconds until the first snapshot, by default save_secs
+        :param bool normalize: whether to L2-normalize the rows of the embeddings before saving
+        them
+        """
+        self._embeddings = embeddings
+        self._save_fn = save_fn
+        self._save_secs = save_secs
+        self._first_save_secs = save_secs if first_save_secs is None else first_save_secs
+        self._normalize = normalize
+        self._thread = None
+
+    def begin(self):
+        self._next_save = time.time() + self._first_save_secs
+
+    def before_run(self, run_context):
+        if time.time() >= self._next_save:
+            return session_run_hook.SessionRunArgs(self._embeddings)
+        return None
+
+    def after_run(self, run_context, run_values):
+        if run_values.results:
+            self._next_save = time.time() + self._save_secs
+            self._wait()
+            self._thread = threading.Thread(target=self._save, args=(run_values.results,))
+            self._thread.daemon = True
+            self._thread.start()
+
+    def end(self, session):
+        self._wait()
+        self._save(session.run(self._embeddings))
+
+    def _wait(self):
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _save(self, embeddings):
+        if self._normalize:
+            embeddings = dict((key, normalize_embeddings(value))
+                              for key, value in embeddings.items())
+        self._save_fn(embeddings)
@@ -1,63 +1,188 @@
 import re
 import io
+import sys
+import numpy as np
 from ..configuration import *
 from ..preprocess_data import load_csv_wikipedia_gen, load_csv_dataset, group_count
+from ..preprocess_data import space_saving_count
 
 
-def load_word2vec_data(filename, vocabulary_size=VOCABULARY_SIZE):
+class EncodedText(object):
     """
-    Loads the word2vec data: the dictionary file with the relation of the word with its int id,
-    the dataset as a list of list of ids and a dictionary with the frequency of the words in
-    the dataset.
-    :param str filename: name of the file with the word2vec dataset, the dictionary file and the
-    frequency file are generated with the suffixes _dict and _count based on this fiename
-    :return (Dict[str,int], List[List[int]], Dict[int,float]: a tuple with a dictionary for the
-    symbols and a list of sentences where each sentence is a list of int and a dictionary with
-    the frequencies of the words
+    Lazy view of the encoded word2vec dataset. The file is read every time the object is iterated,
+    so the corpus is only loaded when it is used.
+    """
+
+    def __init__(self, filepath):
+        """
+        :param str filepath: path of the file with the encoded text, one sentence per line
+        """
+        self.filepath = filepath
+
+    def __iter__(self):
+        with open(self.filepath, 'r') as f:
+            for line in f:
+                yield [int(word) for word in line.split()]
+
+
+def _create_word2vec_metadata(filename, metadata_filepath):
+    """
+    Creates the binary metadata file from the dictionary and the count files of the dataset
+    :param str filename: name of the dataset including the vocabulary size
+    :param str metadata_filepath: path of the metadata file
     """
-    filename = '{}_{}'.format(filename, vocabulary_size)
     filename_dict = '{}_dict'.format(filename)
     filename_count = '{}_count'.format(filename)
-    with open(os.path.join(DIR_DATA_WORD2VEC, filename_dict), 'r') as f:
-        symbols_dict = { }
-        for line in f.readlines():
+    symbols_dict = {}
+    with io.open(os.path.join(DIR_DATA_WORD2VEC, filename_dict), 'r', encoding='utf8') as f:
+        for line in f:
             data = line.split()
-            symbol = data[0]
-            encoded = int(data[1])
-            symbols_dict[symbol] = encoded
-    encoded_text = []
-    with open(os.path.join(DIR_DATA_WORD2VEC, filename), 'r') as f:
-        for line in f.readlines():
-            encoded_text.append([int(word) for word in line.split()])
-    total_count = 0
-    with open(os.path.join(DIR_DATA_WORD2VEC, filename_count), 'r') as f:
-        word_frequency_dict = { }
-        for line in f.readlines():
+            symbols_dict[data[0]] = int(data[1])
+    symbols_count = {}
+    with io.open(os.path.join(DIR_DATA_WORD2VEC, filename_count), 'r', encoding='utf8') as f:
+        for line in f:
             line = line.strip()
             if len(line) > 0:
                 data = line.split(' = ')
-                symbol = symbols_dict[data[0].strip()]
-                count = int(data[1].strip())
-                if symbol in symbols_dict:
-                    word_frequency_dict[symbol] += count
-                else:
-                    word_frequency_dict[symbol] = count
-                total_count += count
-    for key in word_frequency_dict.keys():
-        word_frequency_dict[key] = float(word_frequency_dict[key]) / total_count
+                symbols_count[data[0].strip()] = int(data[1].strip())
+    symbols = sorted(symbols_dict.keys())
+    np.savez(metadata_filepath,
+             symbols=np.asarray(symbols),
+             ids=np.asarray([symbols_dict[s] for s in symbols], dtype=np.int32),
+             counts=np.asarray([symbols_count.get(s, 0) for s in symbols], dtype=np.int64))
 
+
+def load_word2vec_metadata(filename, vocabulary_size=VOCABULARY_SIZE):
+    """
+    Loads the vocabulary of the word2vec dataset without loading the dataset. The data is read from
+    a binary metadata file, it is created from the dictionary and count files the first time.
+    :param str filename: name of the file with the word2vec dataset
+    :param int vocabulary_size: size of the vocabulary
+    :return (Dict[str,int], Dict[int,int], Dict[int,float]): a tuple with a dictionary for the
+    symbols, a dictionary with the count of every id and a dictionary with the frequencies of the
+    ids
+    """
+    filename = '{}_{}'.format(filename, vocabulary_size)
+    metadata_filepath = os.path.join(DIR_DATA_WORD2VEC, '{}_meta.npz'.format(filename))
+    dict_filepath = os.path.join(DIR_DATA_WORD2VEC, '{}_dict'.format(filename))
+    if not os.path.exists(metadata_filepath) or \
+            os.path.getmtime(metadata_filepath) < os.path.getmtime(dict_filepath):
+        _create_word2vec_metadata(filename, metadata_filepath)
+    with np.load(metadata_filepath) as metadata:
+        symbols = metadata['symbols']
+        ids = metadata['ids']
+        counts = metadata['counts']
+    symbols_dict = dict(zip(symbols.tolist(), ids.tolist()))
+    # all the unknown symbols share the id 0
+    ids_count = np.bincount(ids, weights=counts)
+    total_count = float(np.sum(counts))
+    symbols_count = {}
+    word_frequency_dict = {}
+    for symbol_id in np.unique(ids).tolist():
+        symbols_count[symbol_id] = int(ids_count[symbol_id])
+        word_frequency_dict[symbol_id] = ids_count[symbol_id] / total_count
+    return symbols_dict, symbols_count, word_frequency_dict
+
+
+def load_word2vec_data(filename, vocabulary_size=VOCABULARY_SIZE):
+    """
+    Loads the word2vec data: the dictionary file with the relation of the word with its int id,
+    the dataset as a list of list of ids and a dictionary with the frequency of the words in
+    the dataset.
+    :param str filename: name of the file with the word2vec dataset, the dictionary file and the
+    frequency file are generated with the suffixes _dict and _count based on this fiename
+    :return (Dict[str,int], EncodedText, Dict[int,float]: a tuple with a dictionary for the
+    symbols, an iterable of sentences where each sentence is a list of int and a dictionary with
+    the frequencies of the words. The sentences are read from the file when they are iterated.
+    """
+    symbols_dict, _, word_frequency_dict = load_word2vec_metadata(filename, vocabulary_size)
+    encoded_text = EncodedText(os.path.join(DIR_DATA_WORD2VEC,
+                                            '{}_{}'.format(filename, vocabulary_size)))
     return symbols_dict, encoded_text, word_frequency_dict
 
 
-def load_or_create_dataset_word2vec(filename, text_samples, vocabulary_size=VOCABULARY_SIZE):
+def _text_lines(text_samples):
+    """
+    Splits the text samples in sentences of lower case words, a dot is added at the end of every
+    sentence. The sentences are generated one by one, so the corpus is never in memory.
+    :param List[str] text_samples: list of texts
+    :return: a generator of sentences where each sentence is a list of words
+    """
+    for text_sample in text_samples:
+        sentences = re.split('\n|\s\.\s', text_sample.lower())
+        for sentence in sentences:
+            words = sentence.split()
+            if len(words) > 0:
+                words.append('.')
+                words = list([word.strip().lower() for word in words])
+                yield words
+
+
+def count_symbols(text_lines, counting_capacity=None):
+    """
+    Counts the symbols in the text lines
+    :param text_lines: iterable of sentences where each sentence is a list of words
+    :param int counting_capacity: if None the symbols are counted exactly, otherwise the maximum
+    number of symbols kept in memory while counting, see space_saving_count
+    :return List[(str, int)]: list of symbols with their count ordered by count
+    """
+    if counting_capacity is None:
+        symbols_count = group_count(text_lines)
+    else:
+        words = (word for sentence in text_lines for word in sentence)
+        symbols_count, errors, total = space_saving_count(words, counting_capacity)
+        print('Approximate count with capacity {}, max error per symbol: {} of {} symbols'.format(
+                counting_capacity, max(errors.values()) if errors else 0, total))
+    return sorted(symbols_count.items(), key=lambda x: x[1], reverse=True)
+
+
+def verify_approximate_count(text_samples, vocabulary_size=VOCABULARY_SIZE,
+                             counting_capacity=VOCABULARY_SIZE * 5):
+    """
+    Compares the vocabulary obtained with the approximate count against the exact one and prints
+    the differences
+    :param List[str] text_samples: list of texts
+    :param int vocabulary_size: size of the vocabulary
+    :param int counting_capacity: capacity for the approximate count
+    """
+    exact_count = group_count(_text_lines(text_samples))
+    words = (word for sentence in _text_lines(text_samples) for word in sentence)
+    approximate_count, errors, total = space_saving_count(words, counting_capacity)
+    exact_vocabulary = sorted(exact_count.items(), key=lambda x: x[1], reverse=True)
+    exact_vocabulary = set([s for s, _ in exact_vocabulary[:vocabulary_size - 1]])
+    approximate_vocabulary = sorted(approximate_count.items(), key=lambda x: x[1], reverse=True)
+    approximate_vocabulary = [s for s, _ in approximate_vocabulary[:vocabulary_size - 1]]
+    # a symbol is guaranteed to be in the vocabulary if its lower bound is greater than the upper
+    # bound of the first symbol out of the vocabulary
+    sorted_counts = sorted(approximate_count.values(), reverse=True)
+    threshold = sorted_counts[vocabulary_size - 1] if len(sorted_counts) >= vocabulary_size else 0
+    guaranteed = [s for s in approximate_vocabulary
+                  if approximate_count[s] - errors[s] > threshold]
+    count_errors = [approximate_count[s] - exact_count[s] for s in approximate_vocabulary]
+    print('Total symbols: {}  distinct symbols: {}'.format(total, len(exact_count)))
+    print('Counting capacity: {}  theoretical max error: {:0.1f}'.format(
+            counting_capacity, float(total) / counting_capacity))
+    print('Vocabulary overlap: {} of {}'.format(
+            len(exact_vocabulary.intersection(approximate_vocabulary)), len(exact_vocabulary)))
+    print('Symbols guaranteed in the vocabulary: {}'.format(len(guaranteed)))
+    print('Max count error: {}  mean count error: {:0.3f}'.format(
+            max(count_errors), float(sum(count_errors)) / len(count_errors)))
+
+
+def load_or_create_dataset_word2vec(filename, text_samples, vocabulary_size=VOCABULARY_SIZE,
+                                    counting_capacity=W2V_VOCABULARY_COUNTING_CAPACITY):
     """
     Loads the dataset for word2vec or creates it from the text_samples if the file doesn't exits.
     Three files are generated: dictionary file, word frequency file and dataset file. The dataset
     file already contains the ids instead of the words. The vocabulary is truncated to fit the
     vocabulary size, the less frequent words are transformed into the unknown id (the number 0)
     :param str filename: filename prefix of the dataset
-    :param List[List[str]] text_samples: list of list of words
+    :param List[str] text_samples: list of texts, they are split in sentences of words and
+    streamed twice (to count the symbols and to encode them), so the sentences are never all in
+    memory
     :param int vocabulary_size: the final size of the vocabulary
+    :param int counting_capacity: if None the symbols are counted exactly, otherwise the maximum
+    number of symbols kept in memory while counting the vocabulary
     :return (Dict[str,int], List[List[int]], Dict[int,float]: a tuple with a dictionary for the
     symbols and a list of sentences where each sentence is a list of int and a dictionary with
     the frequencies of the words
@@ -67,17 +192,7 @@ def load_or_create_dataset_word2vec(filename, text_samples, vocabulary_size=VOCA
     filename_count = '{}_count'.format(filename_vocabulary)
     filename_tsv = '{}.tsv'.format(filename_vocabulary)
     if not os.path.exists(os.path.join(DIR_DATA_WORD2VEC, filename_vocabulary)):
-        text_lines = []
-        for text_sample in text_samples:
-            sentences = re.split('\n|\s\.\s', text_sample.lower())
-            for sentence in sentences:
-                words = sentence.split()
-                if len(words) > 0:
-                    words.append('.')
-                    words = list([word.strip().lower() for word in words])
-                    text_lines.append(words)
-        symbols_count = group_count(text_lines)
-        symbols_ordered_by_count = sorted(symbols_count.items(), key=lambda x: x[1], reverse=True)
+        symbols_ordered_by_count = count_symbols(_text_lines(text_samples), counting_capacity)
         total_symbols = len(symbols_ordered_by_count)
         print('Total symbols: {}'.format(total_symbols))
         print('Vocabulary size: {}'.format(vocabulary_size))
@@ -90,40 +205,50 @@ def load_or_create_dataset_word2vec(filename, text_samples, vocabulary_size=VOCA
         for symbol, _ in known_symbols:
             symbols_dict[symbol] = counter
             counter += 1
-        encoded_text = []
-
-        words_count = 0
-        for sentence in text_lines:
-            words_count += len(sentence)
-            encoded_sentence = []
-            for word in sentence:
-                encoded_sentence.append(symbols_dict[word])
-            if len(encoded_sentence) > 0:
-                encoded_text.append(encoded_sentence)
-        print('Total sentences: {}'.format(len(text_lines)))
-        print('Total words: {}'.format(words_count))
-        print('words/sentences: {}'.format(float(words_count) / float(len(text_lines))))
 
         with io.open(os.path.join(DIR_DATA_WORD2VEC, filename_dict), 'w', encoding='utf8') as f:
             for symbol in sorted(symbols_dict.keys()):
                 f.write(u'{} {}\n'.format(symbol, symbols_dict[symbol]))
+
+        words_count = 0
+        sentences_count = 0
+        # symbols evicted by the approximate count are not in the dictionary, they are unknown
+        evicted_count = 0
+        evicted_symbols = set()
         with io.open(os.path.join(DIR_DATA_WORD2VEC, filename_vocabulary), 'w',
                      encoding='utf8') as f:
-            for sentence in encoded_text:
-                f.write(u' '.join(str(word) for word in sentence))
+            for sentence in _text_lines(text_samples):
+                sentences_count += 1
+                words_count += len(sentence)
+                encoded_sentence = []
+                for word in sentence:
+                    if word in symbols_dict:
+                        encoded_sentence.append(symbols_dict[word])
+                    else:
+                        encoded_sentence.append(0)
+                        evicted_count += 1
+                        evicted_symbols.add(word)
+                f.write(u' '.join(str(word) for word in encoded_sentence))
                 f.write(u'\n')
+        print('Total sentences: {}'.format(sentences_count))
+        print('Total words: {}'.format(words_count))
+        print('words/sentences: {}'.format(float(words_count) / max(sentences_count, 1)))
+        if evicted_count > 0:
+            print('{} occurrences of {} symbols evicted by the approximate count encoded as '
+                  'unknown'.format(evicted_count, len(evicted_symbols)))
+
         with io.open(os.path.join(DIR_DATA_WORD2VEC, filename_count), 'w', encoding='utf8') as f:
             for symbol, count in symbols_ordered_by_count:
                 f.write(u'{} = {}\n'.format(symbol, count))
         with io.open(os.path.join(DIR_DATA_WORD2VEC, filename_tsv), 'w', encoding='utf8') as f:
             f.write(u'word\tcount\tid\n')
-            f.write(u'_UNKOWN_\t{}\t0\n'.format(len(unknown_symbols)))
+            f.write(u'_UNKOWN_\t{}\t0\n'.format(len(unknown_symbols) + len(evicted_symbols)))
             pos = 1
             for symbol, count in known_symbols:
                 f.write(u'{}\t{}\t{}\n'.format(symbol, count, pos))
                 pos += 1
 
-    return load_word2vec_data(filename)
+    return load_word2vec_data(filename, vocabulary_size)
 
 
 if __name__ == '__main__':
@@ -133,5 +258,9 @@ if __name__ == '__main__':
     train_set = load_csv_dataset('train_set_numbers_parsed')
     genes_articles = load_csv_wikipedia_gen('wikipedia_mutations_parsed')
     word2vec_text = [s.text for s in genes_articles] + [s.text for s in train_set]
+    if len(sys.argv) > 1 and sys.argv[1] == 'verify_count':
+        print('Comparing approximate and exact counts...')
+        verify_approximate_count(word2vec_text)
+        sys.exit(0)
     symbols_dict, word2vec_encoded_text, word_frequency = load_or_create_dataset_word2vec(
         'word2vec_dataset', word2vec_text)
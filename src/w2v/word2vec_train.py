@@ -2,7 +2,6 @@ import tensorflow as tf
 import math
 import numpy as np
 import random
-import csv
 import time
 from datetime import timedelta
 import shutil
@@ -11,22 +10,25 @@ from tensorflow.contrib.tensorboard.plugins import projector
 from tensorflow.contrib import layers
 from .. import trainer
 from ..tf_dataset_generator import TFDataSetGenerator
-from ..w2v.word2vec_process_data import load_word2vec_data
+from ..embeddings import save_embeddings
+from ..w2v.word2vec_process_data import load_word2vec_metadata
 from ..configuration import *
 
 
 class Word2VecDataset(TFDataSetGenerator):
     def __init__(self, vocabulary_size=VOCABULARY_SIZE,
                  window_adjacent_words=W2V_WINDOW_ADJACENT_WORDS,
-                 close_words_size=W2V_CLOSE_WORDS_SIZE, window_close_words=W2V_WINDOW_CLOSE_WORDS):
+                 close_words_size=W2V_CLOSE_WORDS_SIZE, window_close_words=W2V_WINDOW_CLOSE_WORDS,
+                 num_workers=GENERATOR_NUM_WORKERS, seed=None, lines_per_block=256):
         filename = 'word2vec_dataset_{}'.format(vocabulary_size)
         self.data_file = os.path.join(DIR_DATA_WORD2VEC, filename)
         self.window_adjacent_words = window_adjacent_words
         self.close_words_size = close_words_size
         self.window_close_words = window_close_words
+        self.lines_per_block = lines_per_block
 
-        _, _, word_frequency_dict = load_word2vec_data('word2vec_dataset',
-                                                       vocabulary_size=vocabulary_size)
+        _, _, word_frequency_dict = load_word2vec_metadata('word2vec_dataset',
+                                                           vocabulary_size=vocabulary_size)
         self.probabilities_dict = { }
         unknown_count = 0
         for k, v in word_frequency_dict.items():
@@ -36,32 +38,99 @@ class Word2VecDataset(TFDataSetGenerator):
                 unknown_count += v
         self.probabilities_dict[0] = -math.log(unknown_count)
         output_types = (tf.int32, tf.int32)
-        super(Word2VecDataset, self).__init__(name='train', generator=self._generator,
+        super(Word2VecDataset, self).__init__(name='train', generator=self._generate_blocks,
                                               output_types=output_types, min_queue_examples=1000,
-                                              shuffle_size=100000)
+                                              shuffle_size=100000, batched=True,
+                                              num_workers=num_workers, seed=seed)
+
+    def _generate_blocks(self, shard_index=0, num_shards=1):
+        """
+        Generates the pairs of the lines of the dataset file in blocks of lines_per_block lines,
+        so the pairs shuffled together in a block come from many lines
+        :param int shard_index: index of the partition of the lines to generate
+        :param int num_shards: number of partitions, the lines are assigned to the partitions in
+        round-robin
+        :return: a generator of tuples (labels, words) of numpy arrays
+        """
+        labels = []
+        words = []
+        lines = 0
+        with open(self.data_file) as f:
+            for i, l in enumerate(f):
+                if i % num_shards != shard_index:
+                    continue
+                line_labels, line_words = self._line_pairs([int(w) for w in l.split()])
+                labels.extend(line_labels)
+                words.extend(line_words)
+                lines += 1
+                if lines == self.lines_per_block:
+                    yield np.asarray(labels, dtype=np.int32), np.asarray(words, dtype=np.int32)
+                    labels = []
+                    words = []
+                    lines = 0
+        if len(labels) > 0:
+            yield np.asarray(labels, dtype=np.int32), np.asarray(words, dtype=np.int32)
 
     def _generator(self):
         with open(self.data_file) as f:
             for l in f:
-                text_line = [int(w) for w in l.split()]
-                probabilities_tl = [self.probabilities_dict[w] for w in text_line]
-                len_text_line = len(text_line)
-                for i, word in enumerate(text_line):
-                    aw_min = max(0, i - self.window_adjacent_words)
-                    aw_max = min(len_text_line, i + self.window_adjacent_words + 1)
-                    adjacent_words = text_line[aw_min:i] + text_line[i + 1:aw_max]
-
-                    nsw_min = max(0, min(aw_min, i - self.window_close_words))
-                    nsw_max = min(len_text_line, max(aw_max, i + self.window_close_words + 1))
-                    close_words = text_line[nsw_min:aw_min] + text_line[aw_max:nsw_max]
-
-                    prob = probabilities_tl[nsw_min:aw_min] + probabilities_tl[aw_max:nsw_max]
-                    close_words_selected = self._select_random_labels(close_words,
-                                                                      self.close_words_size, prob)
-
-                    context = adjacent_words + close_words_selected
-                    for label in context:
-                        yield np.int32(label), np.int32(word)
+                labels, words = self._line_pairs([int(w) for w in l.split()])
+                for label, word in zip(labels, words):
+                    yield np.int32(label), np.int32(word)
+
+    def _count_num_records(self):
+        """
+        Counts the pairs of the dataset from the lengths of the lines, without running the
+        generator. The number of pairs of a word only depends on its position in the line, see
+        _line_pairs.
+        :return int: the number of (label, word) pairs of the dataset
+        """
+        pairs_by_length = { }
+        samples = 0
+        with open(self.data_file) as f:
+            for l in f:
+                length = len(l.split())
+                if length not in pairs_by_length:
+                    positions = np.arange(length)
+                    aw_min = np.maximum(0, positions - self.window_adjacent_words)
+                    aw_max = np.minimum(length, positions + self.window_adjacent_words + 1)
+                    close_min = positions - self.window_close_words
+                    close_max = positions + self.window_close_words + 1
+                    nsw_min = np.maximum(0, np.minimum(aw_min, close_min))
+                    nsw_max = np.minimum(length, np.maximum(aw_max, close_max))
+                    close_words = (nsw_max - nsw_min) - (aw_max - aw_min)
+                    pairs = (aw_max - aw_min - 1) + np.minimum(close_words, self.close_words_size)
+                    pairs_by_length[length] = int(np.sum(pairs))
+                samples += pairs_by_length[length]
+        return samples
+
+    def _line_pairs(self, text_line):
+        """
+        Creates the (label, word) pairs of a line
+        :param List[int] text_line: the ids of the words of the line
+        :return (List[int], List[int]): the labels and the words of the pairs
+        """
+        labels = []
+        words = []
+        probabilities_tl = [self.probabilities_dict[w] for w in text_line]
+        len_text_line = len(text_line)
+        for i, word in enumerate(text_line):
+            aw_min = max(0, i - self.window_adjacent_words)
+            aw_max = min(len_text_line, i + self.window_adjacent_words + 1)
+            adjacent_words = text_line[aw_min:i] + text_line[i + 1:aw_max]
+
+            nsw_min = max(0, min(aw_min, i - self.window_close_words))
+            nsw_max = min(len_text_line, max(aw_max, i + self.window_close_words + 1))
+            close_words = text_line[nsw_min:aw_min] + text_line[aw_max:nsw_max]
+
+            prob = probabilities_tl[nsw_min:aw_min] + probabilities_tl[aw_max:nsw_max]
+            close_words_selected = self._select_random_labels(close_words,
+                                                              self.close_words_size, prob)
+
+            context = adjacent_words + close_words_selected
+            labels.extend(context)
+            words.extend([word] * len(context))
+        return labels, words
 
     def _select_random_labels(self, labels, num_labels, probabilities):
         """
@@ -157,36 +226,29 @@ class Word2VecTrainer(trainer.Trainer):
         summary_writer = tf.summary.FileWriter(self.log_dir)
         projector.visualize_embeddings(summary_writer, config)
 
-        # normalize the embeddings to save them
-        norm = tf.sqrt(tf.reduce_sum(tf.square(self.embeddings), 1, keep_dims=True))
-        self.normalized_embeddings = self.embeddings / norm
-
         return None
 
     def create_graph(self, dataset_tensor, batch_size):
         input_label, output_word = dataset_tensor
         return self.model(input_label, output_word, batch_size)
 
+    def create_hooks(self, graph_data):
+        # the embeddings are normalized when the snapshot is saved
+        embeddings_hook = trainer.EmbeddingsSnapshotHook(
+                {'embeddings': self.embeddings},
+                save_fn=lambda e: self.save_embeddings(e['embeddings']),
+                first_save_secs=5 * 60)
+        return [], [embeddings_hook]
+
     def step(self, session, graph_data):
         if self.is_chief:
-            lr, _, loss, step, self.embeddings = session.run(
-                    [self.learning_rate, self.optimizer, self.loss, self.global_step,
-                     self.normalized_embeddings])
+            lr, _, loss, step = session.run([self.learning_rate, self.optimizer, self.loss,
+                                             self.global_step])
             if time.time() > self.print_timestamp + 5 * 60:
                 self.print_timestamp = time.time()
                 elapsed_time = str(timedelta(seconds=time.time() - self.init_time))
                 m = 'step: {}  loss: {:0.4f}  learning_rate = {:0.6f}  elapsed seconds: {}'
                 print(m.format(step, loss, lr, elapsed_time))
-                current_time = time.time()
-                embeddings_file = 'embeddings_{}_{}'.format(VOCABULARY_SIZE, EMBEDDINGS_SIZE)
-                embeddings_filepath = os.path.join(DIR_DATA_WORD2VEC, embeddings_file)
-                if not os.path.exists(embeddings_filepath):
-                    self.save_embeddings(self.embeddings)
-                else:
-                    embeddings_file_timestamp = os.path.getmtime(embeddings_filepath)
-                    # save the embeddings every 30 minutes
-                    if current_time - embeddings_file_timestamp > 30 * 60:
-                        self.save_embeddings(self.embeddings)
         else:
             session.run([self.optimizer])
 
@@ -194,20 +256,13 @@ class Word2VecTrainer(trainer.Trainer):
         self.init_time = time.time()
         self.print_timestamp = time.time()
 
-    def end(self, session):
-        if self.is_chief:
-            self.save_embeddings(self.embeddings)
-
     def save_embeddings(self, normalized_embeddings):
-        print('Saving embeddings in text format...')
+        print('Saving embeddings...')
         embeddings_file = 'embeddings_{}_{}'.format(VOCABULARY_SIZE, EMBEDDINGS_SIZE)
         embeddings_filepath = os.path.join(DIR_DATA_WORD2VEC, embeddings_file)
-        with open(embeddings_filepath, 'w') as file:
-            writer = csv.writer(file, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
-            writer.writerows(normalized_embeddings)
-        # copy the embeddings file to the log dir so we can download it from tensorport
-        if os.path.exists(embeddings_filepath):
-            shutil.copy(embeddings_filepath, self.log_dir)
+        # copy the embeddings files to the log dir so we can download them from tensorport
+        for saved_file in save_embeddings(embeddings_filepath, normalized_embeddings):
+            shutil.copy(saved_file, self.log_dir)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,45 @@
+import os
+import numpy as np
+import pytest
+
+pytest.importorskip('tensorflow')
+
+from src.manifest import create_manifest, load_manifest, manifest_path
+
+
+def _write(filepath, lines):
+    with open(filepath, 'w') as f:
+        for line in lines:
+            f.write(line + '\n')
+
+
+def test_manifest_of_a_set(tmpdir):
+    filepath = str(tmpdir.join('train_set'))
+    _write(filepath, ['1 || 5 || 3 || 10 11 12', '', ' || 6 || 4 || 13'])
+    manifest = create_manifest(filepath)
+    assert os.path.exists(manifest_path(filepath))
+    assert manifest.num_records == 2
+    np.testing.assert_array_equal(manifest.offsets, [0, 25])
+    np.testing.assert_array_equal(manifest.lengths, [3, 1])
+    np.testing.assert_array_equal(manifest.classes, [1, -1])
+    assert manifest.data_size == os.path.getsize(filepath)
+
+
+def test_manifest_is_recreated_when_the_file_changes(tmpdir):
+    filepath = str(tmpdir.join('train_set'))
+    _write(filepath, ['a b c', 'd e'])
+    create_manifest(filepath)
+    assert load_manifest(filepath).num_records == 2
+
+    # same size, different content and modification time
+    _write(filepath, ['a b', 'c d e'])
+    stat = os.stat(filepath)
+    os.utime(filepath, (stat.st_atime, stat.st_mtime + 10))
+    manifest = load_manifest(filepath)
+    np.testing.assert_array_equal(manifest.offsets, [0, 4])
+    np.testing.assert_array_equal(manifest.lengths, [2, 3])
+
+    # the manifest saved by load_manifest is valid for the new file and it is reused
+    manifest_mtime = os.stat(manifest_path(filepath)).st_mtime
+    assert load_manifest(filepath).num_records == 2
+    assert os.stat(manifest_path(filepath)).st_mtime == manifest_mtime
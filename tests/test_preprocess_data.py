@@ -0,0 +1,30 @@
+import collections
+import numpy as np
+import pytest
+
+preprocess_data = pytest.importorskip('src.preprocess_data')
+
+
+def test_space_saving_count_error_bound():
+    random = np.random.RandomState(0)
+    elements = [str(e) for e in random.zipf(1.3, 20000)]
+    capacity = 100
+    counts, errors, total = preprocess_data.space_saving_count(iter(elements), capacity)
+    exact = collections.Counter(elements)
+    assert total == len(elements)
+    assert len(counts) <= capacity
+    for element, count in counts.items():
+        # never underestimated and overestimated at most by the error
+        assert count - errors[element] <= exact[element] <= count
+        assert errors[element] <= float(total) / capacity
+    for element, count in exact.items():
+        if count > float(total) / capacity:
+            assert element in counts
+
+
+def test_space_saving_count_is_exact_within_capacity():
+    elements = ['a', 'b', 'a', 'c', 'a', 'b']
+    counts, errors, total = preprocess_data.space_saving_count(elements, 3)
+    assert counts == {'a': 3, 'b': 2, 'c': 1}
+    assert errors == {'a': 0, 'b': 0, 'c': 0}
+    assert total == 6
@@ -0,0 +1,63 @@
+import os
+import numpy as np
+import pytest
+
+pytest.importorskip('tensorflow')
+
+from src.records import convert_to_records, records_exist, Records
+
+LINES = [
+    '1 || 5 || 3 4 || 10 11 2 12 2',
+    '9 || 6 ||  || 13 14 15',
+    ' || 7 || 8 || 16 2 17',
+]
+
+
+def _write_set(filepath, lines):
+    with open(filepath, 'w') as f:
+        for line in lines:
+            f.write(line + '\n')
+
+
+def test_records_round_trip(tmpdir):
+    set_filepath = str(tmpdir.join('train_set'))
+    _write_set(set_filepath, LINES)
+    assert not records_exist(set_filepath)
+    assert convert_to_records(set_filepath, num_shards=2, sentence_split=2) == 3
+    assert records_exist(set_filepath)
+
+    records = Records(set_filepath)
+    assert len(records) == 3
+    np.testing.assert_array_equal(records.doc_tokens(0), [10, 11, 2, 12, 2])
+    np.testing.assert_array_equal(records.doc_variant(1), [])
+    np.testing.assert_array_equal(records.classes, [0, 8, -1])
+    np.testing.assert_array_equal(records.genes, [5, 6, 7])
+    sentences = records.doc_sentences(0)
+    assert [list(s) for s in sentences] == [[10, 11], [12]]
+
+
+def test_records_stale_after_the_set_changes(tmpdir):
+    set_filepath = str(tmpdir.join('train_set'))
+    _write_set(set_filepath, LINES)
+    convert_to_records(set_filepath, num_shards=1)
+    assert records_exist(set_filepath)
+
+    # same size but a different modification time
+    stat = os.stat(set_filepath)
+    os.utime(set_filepath, (stat.st_atime, stat.st_mtime + 10))
+    assert not records_exist(set_filepath)
+
+    convert_to_records(set_filepath, num_shards=1)
+    assert records_exist(set_filepath)
+    _write_set(set_filepath, LINES[:2])
+    assert not records_exist(set_filepath)
+
+
+def test_records_subsets_of_shards(tmpdir):
+    set_filepath = str(tmpdir.join('train_set'))
+    _write_set(set_filepath, LINES)
+    convert_to_records(set_filepath, num_shards=3)
+    subsets = [Records(set_filepath, shard_index=i, num_shards=2) for i in range(2)]
+    doc_ids = np.concatenate([records.doc_ids for records in subsets])
+    np.testing.assert_array_equal(np.sort(doc_ids), [0, 1, 2])
+    assert [len(records) for records in subsets] == [2, 1]
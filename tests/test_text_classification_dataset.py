@@ -0,0 +1,76 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('tensorflow')
+
+from src.rnn.text_classification_dataset import bucket_batch_sizes, bucket_num_batches, \
+    balanced_sample
+
+
+def _group_by_window(keys, batch_sizes, window_size):
+    """Batches of the keys as tf.contrib.data group_by_window with a batch per key"""
+    windows = {}
+    batches = []
+
+    def _flush(key):
+        window = windows.pop(key)
+        for start in range(0, len(window), batch_sizes[key]):
+            batches.append(window[start:start + batch_sizes[key]])
+
+    for key in keys:
+        windows.setdefault(key, []).append(key)
+        if len(windows[key]) == window_size:
+            _flush(key)
+    for key in list(windows.keys()):
+        _flush(key)
+    return batches
+
+
+@pytest.mark.parametrize('boundaries,max_length,token_budget', [
+    ([300, 600, 1200, 2400], 3000, 10000),
+    ([100, 250, 400], 1000, 4000),
+    ([7, 13], 29, 100),
+])
+def test_bucket_batch_sizes_divide_the_window(boundaries, max_length, token_budget):
+    batch_sizes, window_size = bucket_batch_sizes(boundaries, max_length, 32, token_budget)
+    upper_bounds = boundaries + [max_length]
+    for batch_size, length in zip(batch_sizes, upper_bounds):
+        assert window_size % batch_size == 0
+        assert batch_size * length <= max(token_budget, length)
+
+
+def test_bucket_batch_sizes_without_token_budget():
+    assert bucket_batch_sizes([10, 20], 30, 16) == ([16, 16, 16], 16)
+
+
+def test_bucket_num_batches_counts_the_incomplete_batches():
+    random = np.random.RandomState(0)
+    batch_sizes, window_size = bucket_batch_sizes([7, 13], 29, 32, 100)
+    keys = random.randint(0, len(batch_sizes), 1000)
+    batches = _group_by_window(keys, batch_sizes, window_size)
+    counts = np.bincount(keys, minlength=len(batch_sizes))
+    assert bucket_num_batches(counts, batch_sizes, window_size) == len(batches)
+    # every batch except the last one of every bucket is complete
+    incomplete = [b for b in batches if len(b) < batch_sizes[b[0]]]
+    assert len(incomplete) <= len(batch_sizes)
+
+
+def test_balanced_sample_counts_per_class():
+    random = np.random.RandomState(0)
+    classes = np.asarray([0] * 50 + [1] * 7 + [2] * 23 + [3])
+    indexes = np.arange(len(classes)) + 100
+    epoch = balanced_sample(random, indexes, classes, oversampling=2)
+    epoch_classes = classes[epoch - 100]
+    # every class has twice the documents of the largest class
+    assert np.bincount(epoch_classes).tolist() == [100] * 4
+    # every document of a class is sampled as evenly as possible
+    for c, count in enumerate(np.bincount(classes)):
+        reads = np.bincount(epoch[epoch_classes == c] - 100, minlength=len(classes))[classes == c]
+        assert reads.min() >= 100 // count
+        assert reads.max() <= -(-100 // count)
+
+
+def test_balanced_sample_empty():
+    random = np.random.RandomState(0)
+    empty = np.asarray([], dtype=np.int64)
+    assert len(balanced_sample(random, empty, empty)) == 0
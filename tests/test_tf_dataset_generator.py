@@ -0,0 +1,44 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('tensorflow')
+
+from src.tf_dataset_generator import _rebatch
+
+
+def _blocks(sizes):
+    first = 0
+    for size in sizes:
+        values = np.arange(first, first + size)
+        yield values, values * 10
+        first += size
+
+
+@pytest.mark.parametrize('sizes,batch_size', [
+    ([3, 0, 5, 1, 7], 4),
+    ([10], 3),
+    ([1, 1, 1], 5),
+    ([8, 8], 4),
+])
+def test_rebatch_keeps_the_order(sizes, batch_size):
+    batches = list(_rebatch(_blocks(sizes), batch_size))
+    values = np.concatenate([batch[0] for batch in batches])
+    np.testing.assert_array_equal(values, np.arange(sum(sizes)))
+    for batch in batches:
+        np.testing.assert_array_equal(batch[1], batch[0] * 10)
+    assert all(len(batch[0]) == batch_size for batch in batches[:-1])
+    assert 0 < len(batches[-1][0]) <= batch_size
+
+
+def test_rebatch_shuffles_only_inside_the_blocks():
+    sizes = [6, 4, 9]
+    random = np.random.RandomState(0)
+    batches = list(_rebatch(_blocks(sizes), 5, random))
+    values = np.concatenate([batch[0] for batch in batches])
+    first = 0
+    for size in sizes:
+        np.testing.assert_array_equal(np.sort(values[first:first + size]),
+                                      np.arange(first, first + size))
+        first += size
+    for batch in batches:
+        np.testing.assert_array_equal(batch[1], batch[0] * 10)